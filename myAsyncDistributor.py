@@ -0,0 +1,560 @@
+import asyncio
+import contextlib
+import json
+import os
+import time
+from multiprocessing import Process
+from threading import Lock
+
+import aiohttp
+from aiohttp import web
+
+from myConnectionPool import ConnectionPool
+from myHealth import HealthMonitor
+from myKVServer import (LoadTracker, MyDistributor, SCAN_LIMIT, create_server, json_object, ring_hash,
+                        scan_arguments, start_server, ttl_argument, valid_items, valid_keys)
+from myMetrics import CONTENT_TYPE
+from myBinaryProtocol import BinaryFrontend, BinaryServer
+from myRebalancer import Rebalancer
+
+
+class MyAsyncDistributor:
+    """
+    An asyncio version of MyDistributor built on aiohttp. It serves the same API
+    (/put, /get, /del, /mput, /mget, /mdel, /add_server, /remove_server) and routes
+    keys with the same HashRing, but forwards requests to the MyKVStore servers with
+    non-blocking I/O, so thousands of in-flight requests are handled by one event
+    loop instead of one OS thread each.
+
+    self.sessions: an aiohttp ClientSession (and its keep-alive connector) per kv store,
+                   shared by all forwarding handlers and created on first use. When the
+                   circuit breaker of a kv store opens, its session is closed, which fails
+                   the requests still waiting on it
+    self.loop: the event loop of the handlers, set when the server starts
+    self.replicas / self.read_quorum / self.write_quorum / self.cache / self.metrics /
+    self.binary_offset / self.loads / self.shared / self.health: as in MyDistributor; the binary
+                                                  protocol is served on the same event loop
+    self._background: requests to replicas that are still running after their quorum
+                      answered, referenced here so they are not garbage collected
+    self.rebalancer: moves keys after topology changes in its own thread, like in
+                     MyDistributor, with a blocking ConnectionPool (self.pool)
+    """
+    def __init__(self, ring, server_tracker, kv_stores, pool_size=32, connect_timeout=1.0, read_timeout=5.0,
+                 store_options=None, rebalance_options=None, replicas=1, read_quorum=1, write_quorum=1,
+                 cache=None, log_sample=0.0, binary_offset=0, bounded_load=0.0, shared=None, health_options=None):
+        self.app = web.Application()
+        self.HashRing = ring
+        self.added_servers = []
+        self.server_tracker = server_tracker
+        self.kv_server_instances = kv_stores
+        self.store_options = store_options or {}
+        self.replicas = replicas
+        self.read_quorum = read_quorum
+        self.write_quorum = write_quorum
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.sessions = dict()
+        self.loop = None
+        self.pool = ConnectionPool(max_size=pool_size, connect_timeout=connect_timeout, read_timeout=read_timeout)
+        self.shared = shared
+        self.ring_version = 0
+        self._ring_sync_lock = Lock()
+        self.rebalancer = Rebalancer(self.pool, ring_hash, deletes=shared.deletes if shared is not None else None,
+                                     **(rebalance_options or {}))
+        self.topology_lock = asyncio.Lock()
+        self._background = set()
+        self.cache = cache
+        self.binary_offset = binary_offset
+        self.loads = LoadTracker(bounded_load) if bounded_load > 0 else None
+        self.health = None
+        if health_options is not None:
+            self.health = HealthMonitor(lambda: self.HashRing.nodes, **health_options)
+            self.health.on_open = self._on_open
+            self.health.on_recover = self._hand_off
+        self._register_metrics(log_sample)
+
+    async def _start_session(self, app):
+        self.loop = asyncio.get_running_loop()
+        if self.binary_offset:
+            frontend = BinaryFrontend(self, self.binary_offset, self.pool.connect_timeout, self.pool.read_timeout)
+            await BinaryServer(frontend.handle, port=5000 + self.binary_offset,
+                               reuse_port=self.shared is not None).start()
+
+    async def _close_session(self, app):
+        for session in list(self.sessions.values()):
+            await session.close()
+
+    def _session(self, node):
+        session = self.sessions.get(node)
+        if session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            session = self.sessions[node] = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return session
+
+    # called from the health check thread
+    def _on_open(self, node):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._abort, node)
+
+    # close the connections to a kv store whose breaker opened; the next request opens a new session
+    def _abort(self, node):
+        session = self.sessions.pop(node, None)
+        if session is not None:
+            task = asyncio.ensure_future(session.close())
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+
+    # send a request to a kv store. Returns (node, status, response_data, error)
+    async def _request(self, node, method, path, params):
+        started = time.perf_counter()
+        if self.loads is not None:
+            self.loads.begin(node)
+        try:
+            async with self._session(node).request(method, f"http://127.0.0.1:{node}{path}", params=params) as response:
+                text = await response.text()
+                try:
+                    response_data = json.loads(text)
+                except ValueError:
+                    response_data = {'error': 'Invalid JSON response', 'response_text': text}
+                self._observe_backend(node, started, response.status >= 500)
+                if response.status >= 500:
+                    self._hint_write(node, method, params, None)
+                return node, response.status, response_data, None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self._observe_backend(node, started, True)
+            self._hint_write(node, method, params, None)
+            return node, None, None, e
+        finally:
+            if self.loads is not None:
+                self.loads.end(node)
+
+    # forward a request to a kv store and relay its answer
+    async def _forward(self, node, method, path, params):
+        node, status, response_data, error = await self._request(node, method, path, params)
+        if error is not None:
+            return web.json_response({'error': f"server at port {node} is unavailable: {error}"}, status=503)
+        return web.json_response(response_data, status=status)
+
+    # let the requests that are not needed for a quorum finish on their own
+    def _detach(self, tasks):
+        for task in tasks:
+            if not task.done():
+                self._background.add(task)
+                task.add_done_callback(self._background.discard)
+
+    # send a request to all replicas of a key concurrently and stop waiting once quorum of
+    # them answered. Returns (answers, errors) like MyDistributor._send_to_replicas, with
+    # (node, status, response_data) answers
+    async def _send_to_replicas(self, nodes, method, path, params, quorum, balanced=False):
+        answers = []
+        errors = dict()
+        for wave in self._replica_waves(nodes, quorum, balanced):
+            tasks = [asyncio.ensure_future(self._request(node, method, path, params)) for node in wave]
+            for next_answer in asyncio.as_completed(tasks):
+                node, status, response_data, error = await next_answer
+                if error is not None:
+                    errors[node] = f"server at port {node} is unavailable: {error}"
+                    continue
+                if status >= 500:
+                    errors[node] = f"server at port {node} answered {status}"
+                    continue
+                answers.append((node, status, response_data))
+                if len(answers) >= quorum:
+                    break
+            self._detach(tasks)
+            if len(answers) >= quorum:
+                break
+        return answers, errors
+
+    def _quorum_answer(self, answers, errors, quorum):
+        if not answers or len(answers) < quorum:
+            return web.json_response({'error': f"{len(answers)} of {quorum} replicas answered", 'errors': errors}, status=503)
+        for _, status, response_data in answers:
+            if status == 200:
+                return web.json_response(response_data, status=status)
+        _, status, response_data = answers[0]
+        return web.json_response(response_data, status=status)
+
+    # key grouping, quorum accounting, failure reporting, the cache helpers, the metrics, the
+    # bounded load and health aware routing and ring changes are shared with the Flask
+    # distributor. Hand-offs run in the thread of the HealthMonitor, with self.pool
+    _register_metrics = MyDistributor._register_metrics
+    _observe_backend = MyDistributor._observe_backend
+    _replica_waves = MyDistributor._replica_waves
+    _change_ring = MyDistributor._change_ring
+    _publish_ring = MyDistributor._publish_ring
+    _publish_when_done = MyDistributor._publish_when_done
+    _sync_ring = MyDistributor._sync_ring
+    _parse_weight = staticmethod(MyDistributor._parse_weight)
+    _preference_list = MyDistributor._preference_list
+    _route_around = MyDistributor._route_around
+    _hand_off = MyDistributor._hand_off
+    _hint_write = MyDistributor._hint_write
+    _group_by_node = MyDistributor._group_by_node
+    _scan_merge = MyDistributor._scan_merge
+    _scan_answer = MyDistributor._scan_answer
+    _group_by_previous_owner = MyDistributor._group_by_previous_owner
+    _answered = staticmethod(MyDistributor._answered)
+    _add_failures = staticmethod(MyDistributor._add_failures)
+    _cache_lookup = MyDistributor._cache_lookup
+    _cache_fill = MyDistributor._cache_fill
+    _put_params = staticmethod(MyDistributor._put_params)
+    _mput_body = staticmethod(MyDistributor._mput_body)
+    _cache_invalidate = MyDistributor._cache_invalidate
+    _shutdown_server = MyDistributor._shutdown_server
+    _finish_removal = MyDistributor._finish_removal
+
+    # with workers, a topology change also takes the lock of all workers, without blocking
+    # the event loop: while another worker changes the topology, this yields False
+    @contextlib.asynccontextmanager
+    async def _topology_change(self):
+        async with self.topology_lock:
+            if self.shared is None:
+                yield True
+            elif self.shared.topology_lock.acquire(block=False):
+                try:
+                    self._sync_ring()
+                    yield True
+                finally:
+                    self.shared.topology_lock.release()
+            else:
+                yield False
+
+    # create and start the process of a new kv store; this opens its files and forks, so it
+    # runs in the executor of the event loop instead of stalling the requests in flight
+    def _launch_server(self, port):
+        new_server = create_server(port, **self.store_options)
+        new_server_process = Process(target=start_server, args=(new_server,))
+        new_server_process.start()
+        return new_server_process
+
+    # wait until a newly started kv store answers, so the ring never routes to a closed port
+    async def _wait_until_up(self, node, timeout=10.0):
+        deadline = asyncio.get_running_loop().time() + timeout
+        while asyncio.get_running_loop().time() < deadline:
+            try:
+                async with self._session(node).get(f"http://127.0.0.1:{node}/ping") as response:
+                    if response.status == 200:
+                        return True
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                await asyncio.sleep(0.1)
+        return False
+
+    async def _request_json(self, node, method, path, body):
+        started = time.perf_counter()
+        if self.loads is not None:
+            self.loads.begin(node)
+        try:
+            async with self._session(node).request(method, f"http://127.0.0.1:{node}{path}", json=body) as response:
+                self._observe_backend(node, started, response.status >= 500)
+                if response.status != 200:
+                    self._hint_write(node, method, None, body)
+                    return node, (None, f"server at port {node} answered {response.status}")
+                return node, (await response.json(content_type=None), None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            self._observe_backend(node, started, True)
+            self._hint_write(node, method, None, body)
+            return node, (None, str(e))
+        finally:
+            if self.loads is not None:
+                self.loads.end(node)
+
+    # send one batched request per kv store concurrently, until every key reached its quorum.
+    # Returns {node: (response_data, error)} with exactly one of the two set, for the kv
+    # stores that answered by then
+    async def _fan_out(self, method, path, bodies, replicas=None, quorum=None):
+        tasks = [asyncio.ensure_future(self._request_json(node, method, path, body)) for node, body in bodies.items()]
+        results = dict()
+        for next_answer in asyncio.as_completed(tasks):
+            node, result = await next_answer
+            results[node] = result
+            if quorum is not None and result[0] is not None \
+                    and len(self._answered(replicas, results, quorum)) == len(replicas):
+                break
+        self._detach(tasks)
+        return results
+
+    # all routing methods
+    def routes(self):
+        # count and time every request for /metrics, labelled by route like MyDistributor
+        @web.middleware
+        async def observe_request(request, handler):
+            started = time.perf_counter()
+            self._sync_ring()
+            resource = request.match_info.route.resource
+            route = resource.canonical if resource is not None else 'unmatched'
+            try:
+                response = await handler(request)
+            except web.HTTPException as e:
+                self.request_metrics.observe(route, request.method, e.status, time.perf_counter() - started)
+                raise
+            except Exception:
+                self.request_metrics.observe(route, request.method, 500, time.perf_counter() - started)
+                raise
+            self.request_metrics.observe(route, request.method, response.status, time.perf_counter() - started)
+            return response
+
+        async def put_value(request):
+            if request.query.get('key') is None or request.query.get('value') is None:
+                return web.json_response({'error': 'Expected the parameters key and value'}, status=400)
+            try:
+                params = self._put_params(request.query)
+            except ValueError:
+                return web.json_response({'error': 'ttl must be a positive number of seconds'}, status=400)
+            key = params['key']
+            nodes = self._preference_list(key, hint=True)
+            quorum = min(self.write_quorum, len(nodes))
+            self._cache_invalidate([key])
+            answers, errors = await self._send_to_replicas(nodes, 'PUT', '/put', params, quorum)
+            self._cache_invalidate([key])
+            return self._quorum_answer(answers, errors, quorum)
+
+        async def get_value(request):
+            key = request.query.get('key')
+            if key is None:
+                return web.json_response({'error': 'Expected the parameter key'}, status=400)
+            values, tokens = self._cache_lookup([key])
+            if values:
+                return web.json_response({'value': values[key]}, status=200)
+            nodes = self._preference_list(key)
+            quorum = min(self.read_quorum, len(nodes))
+            answers, errors = await self._send_to_replicas(nodes, 'GET', '/get', {"key": key}, quorum, balanced=True)
+            response = self._quorum_answer(answers, errors, quorum)
+            # during a rebalance the key may not have reached its new owner yet
+            if response.status == 404:
+                previous = self.rebalancer.previous_owner(key)
+                if previous is not None:
+                    answers, errors = await self._send_to_replicas([previous], 'GET', '/get', {"key": key}, 1)
+                    response = self._quorum_answer(answers, errors, 1)
+            if response.status == 200:
+                found = next(data for _, status, data in answers if status == 200)
+                self._cache_fill({key: found['value']}, tokens, {key: found['expires_at']} if 'expires_at' in found else None)
+            return response
+
+        async def del_value(request):
+            key = request.query.get('key')
+            if key is None:
+                return web.json_response({'error': 'Expected the parameter key'}, status=400)
+            nodes = self._preference_list(key, hint=True)
+            quorum = min(self.write_quorum, len(nodes))
+            self.rebalancer.record_delete(key)
+            self._cache_invalidate([key])
+            answers, errors = await self._send_to_replicas(nodes, 'DEL', '/del', {"key": key}, quorum)
+            response = self._quorum_answer(answers, errors, quorum)
+            # during a rebalance the key may still be on its previous owner as well
+            previous = self.rebalancer.previous_owner(key)
+            if previous is not None:
+                previous_response = await self._forward(previous, 'DEL', '/del', {"key": key})
+                if response.status == 404:
+                    response = previous_response
+            self._cache_invalidate([key])
+            return response
+
+        async def read_json(request):
+            try:
+                return json_object(await request.json())
+            except ValueError:
+                return {}
+
+        async def mput_values(request):
+            body = await read_json(request)
+            items = body.get('items')
+            if not valid_items(items):
+                return web.json_response({'error': 'Expected a JSON body {"items": {key: value}} of strings'},
+                                         status=400)
+            try:
+                ttl = ttl_argument(body.get('ttl'))
+            except (TypeError, ValueError):
+                return web.json_response({'error': 'ttl must be a positive number of seconds'}, status=400)
+            replicas, groups = self._group_by_node(items, hint=True)
+            self._cache_invalidate(items)
+            results = await self._fan_out('PUT', '/mput', {
+                node: self._mput_body({key: items[key] for key in keys}, ttl) for node, keys in groups.items()
+            }, replicas, self.write_quorum)
+            self._cache_invalidate(items)
+            stored = len(self._answered(replicas, results, self.write_quorum))
+            merged = {'message': f"{stored} values stored successfully"}
+            return web.json_response(self._add_failures(merged, replicas, results, self.write_quorum), status=200)
+
+        async def mget_values(request):
+            keys = (await read_json(request)).get('keys')
+            if not valid_keys(keys):
+                return web.json_response({'error': 'Expected a JSON body {"keys": [key, ...]} of strings'},
+                                         status=400)
+            cached, tokens = self._cache_lookup(keys)
+            if cached:
+                keys = [key for key in keys if key not in cached]
+            replicas, groups = self._group_by_node(keys)
+            results = await self._fan_out('POST', '/mget', {node: {'keys': keys} for node, keys in groups.items()},
+                                          replicas, self.read_quorum)
+            values = dict()
+            expires = dict()
+            for data, _ in results.values():
+                if data is not None:
+                    values.update(data['values'])
+                    expires.update(data.get('expires', {}))
+            answered = self._answered(replicas, results, self.read_quorum)
+            missing = [key for key in replicas if key not in values and key in answered]
+            previous_groups = self._group_by_previous_owner(missing)
+            if previous_groups:
+                previous_results = await self._fan_out('POST', '/mget', {node: {'keys': keys} for node, keys in previous_groups.items()})
+                for data, _ in previous_results.values():
+                    if data is not None:
+                        values.update(data['values'])
+                        expires.update(data.get('expires', {}))
+                missing = [key for key in missing if key not in values]
+            self._cache_fill(values, tokens, expires)
+            values.update(cached)
+            merged = {'values': values, 'missing': missing}
+            return web.json_response(self._add_failures(merged, replicas, results, self.read_quorum, found=values), status=200)
+
+        async def mdel_values(request):
+            keys = (await read_json(request)).get('keys')
+            if not valid_keys(keys):
+                return web.json_response({'error': 'Expected a JSON body {"keys": [key, ...]} of strings'},
+                                         status=400)
+            for key in keys:
+                self.rebalancer.record_delete(key)
+            self._cache_invalidate(keys)
+            replicas, groups = self._group_by_node(keys, hint=True)
+            results = await self._fan_out('DEL', '/mdel', {node: {'keys': keys} for node, keys in groups.items()},
+                                          replicas, self.write_quorum)
+            deleted = set()
+            for data, _ in results.values():
+                if data is not None:
+                    deleted.update(data['deleted'])
+            previous_groups = self._group_by_previous_owner(keys)
+            if previous_groups:
+                previous_results = await self._fan_out('DEL', '/mdel', {node: {'keys': keys} for node, keys in previous_groups.items()})
+                for data, _ in previous_results.values():
+                    if data is not None:
+                        deleted.update(data['deleted'])
+            self._cache_invalidate(keys)
+            answered = self._answered(replicas, results, self.write_quorum)
+            merged = {
+                'deleted': [key for key in replicas if key in deleted],
+                'missing': [key for key in replicas if key not in deleted and key in answered],
+            }
+            return web.json_response(self._add_failures(merged, replicas, results, self.write_quorum, found=deleted), status=200)
+
+        async def scan_values(request):
+            try:
+                prefix, start, limit = scan_arguments(request.query)
+            except ValueError:
+                return web.json_response({'error': f"limit must be a number between 1 and {SCAN_LIMIT}"}, status=400)
+            merge = self._scan_merge(prefix, start, limit)
+            merge.merge()
+            while not merge.done:
+                pages = await asyncio.gather(*(
+                    self._request(node, 'GET', '/scan', {'prefix': prefix, 'start': page_start,
+                                                         'limit': str(merge.page_size)})
+                    for node, page_start in merge.wanted().items()
+                ))
+                for node, status, response_data, error in pages:
+                    if error is not None:
+                        merge.add_error(node, str(error))
+                    elif status != 200:
+                        merge.add_error(node, f"server at port {node} answered {status}")
+                    else:
+                        merge.add_page(node, response_data['items'], response_data['next'])
+                merge.merge()
+            answer, status = self._scan_answer(merge)
+            return web.json_response(answer, status=status)
+
+        async def add_server(request):
+            port = request.query.get('port')
+            try:
+                weight = self._parse_weight(request.query.get('weight'))
+            except ValueError:
+                return web.json_response({'message': "weight must be a positive number"}, status=400)
+            async with self._topology_change() as changing:
+                if not changing:
+                    return web.json_response({'message': "another distributor worker is changing the topology"}, status=409)
+                if self.rebalancer.running:
+                    return web.json_response({'message': "keys from the last topology change are still moving"}, status=409)
+                if port is not None:
+                    if port not in self.HashRing.nodes:
+                        return web.json_response({'message': f"server at port {port} is not on the ring, "
+                                                             f"new servers get the next free port"}, status=400)
+                    if weight is None:
+                        return web.json_response({'message': f"a new weight for server at port {port} is needed"},
+                                                 status=400)
+                    ranges = self._change_ring(lambda ring: ring.set_weight(port, weight))
+                    return web.json_response({'message': f"weight of server at port {port} set to {weight}, "
+                                                         f"moving the keys of {len(ranges)} hash ranges"}, status=200)
+                new_server_node = f"500{self.server_tracker}"
+                loop = asyncio.get_running_loop()
+                new_server_process = await loop.run_in_executor(None, self._launch_server, int(new_server_node))
+                # the port is only used up, and the process only tracked, once the server is up
+                if not await self._wait_until_up(new_server_node):
+                    new_server_process.terminate()
+                    await loop.run_in_executor(None, new_server_process.join, 5)
+                    return web.json_response({'message': f"server at port {new_server_node} did not start"}, status=500)
+                self.server_tracker += 1
+                self.added_servers.append(new_server_process)
+                ranges = self._change_ring(lambda ring: ring.add_node(new_server_node, weight))
+            return web.json_response({'message': f"new server added to port {new_server_node}, "
+                                                 f"moving the keys of {len(ranges)} hash ranges to it"}, status=200)
+
+        async def remove_server(request):
+            port = request.query.get('port')
+            port = int(port) if port is not None else 0
+            async with self._topology_change() as changing:
+                if not changing:
+                    return web.json_response({'message': "another distributor worker is changing the topology"}, status=409)
+                if str(port) not in self.HashRing.nodes:
+                    return web.json_response({'message': f"something went wrong1, server at {port} doesn't exist"}, status=400)
+                if len(self.HashRing.nodes) == 1:
+                    return web.json_response({'message': f"server at port {port} is the last server"}, status=400)
+                if self.rebalancer.running:
+                    return web.json_response({'message': "keys from the last topology change are still moving"}, status=409)
+                ranges = self._change_ring(lambda ring: ring.remove_node(str(port)), self._finish_removal(port))
+            return web.json_response({'message': f"server at port {port} has been removed from the ring, "
+                                                 f"moving the keys of {len(ranges)} hash ranges away from it"}, status=200)
+
+        async def rebalance_status(request):
+            return web.json_response(self.rebalancer.status(), status=200)
+
+        async def cache_stats(request):
+            if self.cache is None:
+                return web.json_response({'enabled': False}, status=200)
+            return web.json_response(self.cache.stats(), status=200)
+
+        async def health_status(request):
+            if self.health is None:
+                return web.json_response({'enabled': False}, status=200)
+            return web.json_response(self.health.status(), status=200)
+
+        async def metrics(request):
+            return web.Response(body=self.metrics.render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+
+        self.app.router.add_route('PUT', '/put', put_value)
+        self.app.router.add_route('GET', '/get', get_value)
+        self.app.router.add_route('DEL', '/del', del_value)
+        self.app.router.add_route('DELETE', '/del', del_value)
+        self.app.router.add_route('PUT', '/mput', mput_values)
+        self.app.router.add_route('POST', '/mget', mget_values)
+        self.app.router.add_route('DEL', '/mdel', mdel_values)
+        self.app.router.add_route('DELETE', '/mdel', mdel_values)
+        self.app.router.add_route('GET', '/scan', scan_values)
+        self.app.router.add_route('POST', '/add_server', add_server)
+        self.app.router.add_route('POST', '/remove_server', remove_server)
+        self.app.router.add_route('GET', '/rebalance_status', rebalance_status)
+        self.app.router.add_route('GET', '/cache_stats', cache_stats)
+        self.app.router.add_route('GET', '/health_status', health_status)
+        self.app.router.add_route('GET', '/metrics', metrics)
+        self.app.middlewares.append(observe_request)
+        self.app.on_startup.append(self._start_session)
+        self.app.on_cleanup.append(self._close_session)
+
+    # run the main server and clean up newly added kv store servers after shutdowm
+    def run_server(self):
+        print("The async distributor is running" if self.shared is None
+              else f"Async distributor worker {os.getpid()} is running")
+        self.routes()
+        if self.health is not None:
+            self.health.start()
+        web.run_app(self.app, host='127.0.0.1', port=5000, access_log=None, print=None,
+                    reuse_port=self.shared is not None)
+        for server in self.added_servers:
+            server.join()
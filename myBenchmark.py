@@ -0,0 +1,605 @@
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import platform
+import random
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+import aiohttp
+
+from myBinaryProtocol import AsyncBinaryClient, BinaryProtocolError, HTTP_STATUS, OP_DEL, OP_GET, OP_PUT
+from myPersistence import LayeredStore
+from myStorage import ENGINES, create_engine
+
+BASE_URL = "http://127.0.0.1:5000"
+BINARY_URL = "tcp://127.0.0.1:6000"
+
+# YCSB core workloads: operation proportions and the distribution of the keys they use
+WORKLOADS = {
+    'a': ({'read': 0.5, 'update': 0.5}, 'zipfian'),
+    'b': ({'read': 0.95, 'update': 0.05}, 'zipfian'),
+    'c': ({'read': 1.0}, 'zipfian'),
+    'd': ({'read': 0.95, 'insert': 0.05}, 'latest'),
+    'e': ({'scan': 0.95, 'insert': 0.05}, 'zipfian'),
+    'f': ({'read': 0.5, 'rmw': 0.5}, 'zipfian'),
+}
+OPERATIONS = ('read', 'update', 'insert', 'scan', 'rmw', 'delete')
+DISTRIBUTIONS = ('uniform', 'zipfian', 'latest')
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of an already sorted list
+    """
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+class LatencyHistogram:
+    """
+    An HDR-style histogram of latencies in microseconds. Values below 2 * sub_buckets
+    are counted exactly, larger ones in sub_buckets / 2 buckets per power of two, so a
+    reported percentile is off by less than 2 / sub_buckets (1.6% by default) while the
+    memory used only grows with the logarithm of the largest latency.
+    """
+    def __init__(self, sub_buckets=128):
+        self.half = sub_buckets // 2
+        self.bits = sub_buckets.bit_length() - 1
+        self.counts = dict()
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def _index(self, value):
+        shift = value.bit_length() - self.bits
+        if shift <= 0:
+            return value
+        return shift * self.half + (value >> shift)
+
+    # the largest value counted in a bucket
+    def _value(self, index):
+        if index < 2 * self.half:
+            return index
+        shift = index // self.half - 1
+        return ((index - shift * self.half + 1) << shift) - 1
+
+    def record(self, seconds):
+        value = int(seconds * 1e6)
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, fraction):
+        if not self.count:
+            return 0
+        rank = max(1, round(fraction * self.count))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self._value(index), self.max)
+        return self.max
+
+    def summary(self, buckets=False):
+        result = {
+            'count': self.count,
+            'mean_us': round(self.total / self.count, 1) if self.count else 0,
+            'p50_us': self.percentile(0.50),
+            'p90_us': self.percentile(0.90),
+            'p99_us': self.percentile(0.99),
+            'p999_us': self.percentile(0.999),
+            'max_us': self.max,
+        }
+        if buckets:
+            result['buckets'] = [[self._value(index), self.counts[index]] for index in sorted(self.counts)]
+        return result
+
+
+class ZipfianGenerator:
+    """
+    Zipfian ranks in [0, items), rank 0 being the most popular, drawn in constant time
+    as YCSB does (Gray et al., "Quickly generating billion-record synthetic databases")
+    """
+    def __init__(self, items, rnd, theta=0.99):
+        self.items = items
+        self.rnd = rnd
+        self.theta = theta
+        self.alpha = 1 / (1 - theta)
+        self.zetan = sum(1 / (i ** theta) for i in range(1, items + 1))
+        zeta2 = 1 + 0.5 ** theta
+        self.eta = (1 - (2 / items) ** (1 - theta)) / (1 - zeta2 / self.zetan)
+
+    def next(self):
+        u = self.rnd.random()
+        uz = u * self.zetan
+        if uz < 1:
+            return 0
+        if uz < 1 + 0.5 ** self.theta:
+            return 1
+        return min(self.items - 1, int(self.items * (self.eta * u - self.eta + 1) ** self.alpha))
+
+
+class Workload:
+    """
+    Picks the operations, keys and values of a run from one seeded random generator.
+
+    self.proportions: {operation: share}, operations from OPERATIONS
+    self.distribution: 'uniform', 'zipfian' (user0 is the hottest key) or 'latest'
+                       (the most recently inserted keys are the hottest)
+    self.inserted: the keys are user0 ... user{inserted - 1}; the first record_count
+                   are loaded before the run, and inserts append new ones
+    self.value_min / self.value_max: value lengths are drawn uniformly from this range
+    self.scan_length: keys read by one scan
+    """
+    def __init__(self, proportions, distribution, record_count, value_size, scan_length, seed):
+        self.rnd = random.Random(seed)
+        self.proportions = proportions
+        self._operations = list(proportions)
+        self._weights = list(itertools.accumulate(proportions[op] for op in self._operations))
+        self.distribution = distribution
+        self.record_count = record_count
+        self.inserted = record_count
+        low, _, high = str(value_size).partition('-')
+        self.value_min = int(low)
+        self.value_max = int(high or low)
+        self.scan_length = scan_length
+        self.zipfian = ZipfianGenerator(record_count, self.rnd) if distribution != 'uniform' else None
+
+    def next_operation(self):
+        return self.rnd.choices(self._operations, cum_weights=self._weights)[0]
+
+    def _next_number(self):
+        if self.distribution == 'uniform':
+            return self.rnd.randrange(self.inserted)
+        if self.distribution == 'latest':
+            return max(0, self.inserted - 1 - self.zipfian.next())
+        return self.zipfian.next()
+
+    def next_key(self):
+        return f"user{self._next_number()}"
+
+    def next_insert_key(self):
+        self.inserted += 1
+        return f"user{self.inserted - 1}"
+
+    def next_scan(self):
+        first = self._next_number()
+        return [f"user{number}" for number in range(first, first + self.scan_length)]
+
+    def value(self):
+        size = self.rnd.randint(self.value_min, self.value_max)
+        return ''.join(self.rnd.choices('abcdefghijklmnopqrstuvwxyz', k=size))
+
+
+class Recorder:
+    """
+    Latency histograms and error counts per operation, of the operations that started
+    at or after measure_from (the end of the warmup)
+    """
+    def __init__(self, measure_from):
+        self.measure_from = measure_from
+        self.histograms = {op: LatencyHistogram() for op in OPERATIONS}
+        self.errors = {op: 0 for op in OPERATIONS}
+        self.not_found = 0
+
+    def record(self, op, started, latency, status):
+        if started < self.measure_from:
+            return
+        if status is None or status >= 500:
+            self.errors[op] += 1
+            return
+        if status == 404:
+            self.not_found += 1
+        self.histograms[op].record(latency)
+
+    def summary(self, duration, buckets=False):
+        overall = LatencyHistogram()
+        operations = dict()
+        for op, histogram in self.histograms.items():
+            if histogram.count or self.errors[op]:
+                overall.merge(histogram)
+                operations[op] = histogram.summary(buckets)
+                operations[op]['errors'] = self.errors[op]
+        result = overall.summary(buckets)
+        result['errors'] = sum(self.errors.values())
+        result['not_found'] = self.not_found
+        result['throughput_ops'] = round(overall.count / duration, 2)
+        result['operations'] = operations
+        return result
+
+
+class HttpTransport:
+    """
+    Sends the operations of a workload to the HTTP API through one aiohttp session.
+    Every method returns the HTTP status of the answer.
+    """
+    def __init__(self, session, base_url):
+        self.session = session
+        self.base_url = base_url
+
+    async def _send(self, method, path, **kwargs):
+        async with self.session.request(method, self.base_url + path, **kwargs) as response:
+            await response.read()
+            return response.status
+
+    async def get(self, key):
+        return await self._send('GET', "/get", params={"key": key})
+
+    async def put(self, key, value):
+        return await self._send('PUT', "/put", params={"key": key, "value": value})
+
+    async def delete(self, key):
+        return await self._send('DELETE', "/del", params={"key": key})
+
+    # a range scan of len(keys) keys in key order from the first one, like YCSB's
+    async def scan(self, keys):
+        return await self._send('GET', "/scan", params={"start": keys[0], "limit": str(len(keys))})
+
+    async def put_many(self, items):
+        return await self._send('PUT', "/mput", json={"items": items})
+
+
+class BinaryTransport:
+    """
+    Sends the operations of a workload over the binary protocol, spread round robin over
+    a few pipelined connections. Answers are mapped to the HTTP status with the same
+    meaning, and scans and batches become pipelined single key requests.
+    """
+    def __init__(self, clients):
+        self.clients = itertools.cycle(clients)
+
+    async def _send(self, opcode, key, value=b''):
+        status, _, _ = await next(self.clients).request(opcode, key, value)
+        return HTTP_STATUS[status]
+
+    async def get(self, key):
+        return await self._send(OP_GET, key)
+
+    async def put(self, key, value):
+        return await self._send(OP_PUT, key, value)
+
+    async def delete(self, key):
+        return await self._send(OP_DEL, key)
+
+    # the status of a group of requests: a server error if any of them failed, otherwise 200
+    async def _all(self, requests):
+        status = max(await asyncio.gather(*requests))
+        return status if status >= 500 else 200
+
+    async def scan(self, keys):
+        return await self._all([self.get(key) for key in keys])
+
+    async def put_many(self, items):
+        return await self._all([self.put(key, value) for key, value in items.items()])
+
+
+@contextlib.asynccontextmanager
+async def open_transport(url, protocol, connections):
+    """
+    A transport to url: an aiohttp session with up to `connections` HTTP connections, or
+    `connections` binary protocol connections to a tcp://host:port url
+    """
+    if protocol == 'binary':
+        address = urllib.parse.urlsplit(url)
+        clients = [AsyncBinaryClient(address.hostname, address.port) for _ in range(connections)]
+        try:
+            yield BinaryTransport(clients)
+        finally:
+            for client in clients:
+                client.close()
+    else:
+        connector = aiohttp.TCPConnector(limit=connections)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            yield HttpTransport(session, url)
+
+
+async def perform(transport, workload, recorder, op, started):
+    """
+    Send one operation of the workload and record its latency from `started`, which is
+    when the operation should have been sent. The keys and values are chosen before the
+    first await, so the same seed always produces the same sequence of requests.
+    """
+    try:
+        if op == 'read':
+            status = await transport.get(workload.next_key())
+        elif op == 'update':
+            status = await transport.put(workload.next_key(), workload.value())
+        elif op == 'insert':
+            status = await transport.put(workload.next_insert_key(), workload.value())
+        elif op == 'scan':
+            status = await transport.scan(workload.next_scan())
+        elif op == 'rmw':
+            key, value = workload.next_key(), workload.value()
+            status = await transport.get(key)
+            if status < 500:
+                status = await transport.put(key, value)
+        else:
+            status = await transport.delete(workload.next_key())
+    except (aiohttp.ClientError, asyncio.TimeoutError, BinaryProtocolError):
+        status = None
+    recorder.record(op, started, time.perf_counter() - started, status)
+
+
+async def load(url, protocol, workload, batch_size=500, concurrency=8):
+    """
+    Store the workload's record_count keys in batches before the run
+    """
+    numbers = iter(range(workload.record_count))
+    async with open_transport(url, protocol, concurrency) as transport:
+        async def loader():
+            while True:
+                batch = list(itertools.islice(numbers, batch_size))
+                if not batch:
+                    return
+                status = await transport.put_many({f"user{number}": workload.value() for number in batch})
+                if status != 200:
+                    raise RuntimeError(f"loading keys failed with status {status}")
+        await asyncio.gather(*[loader() for _ in range(concurrency)])
+
+
+async def closed_loop(url, protocol, connections, workload, concurrency, warmup, duration):
+    """
+    Closed-loop load: `concurrency` clients each send their next request as soon as the
+    previous one was answered, for warmup + duration seconds, all from one event loop.
+    """
+    start = time.perf_counter()
+    end = start + warmup + duration
+    recorder = Recorder(start + warmup)
+    async with open_transport(url, protocol, connections or concurrency) as transport:
+        async def client():
+            while time.perf_counter() < end:
+                await perform(transport, workload, recorder, workload.next_operation(), time.perf_counter())
+        await asyncio.gather(*[client() for _ in range(concurrency)])
+    return recorder
+
+
+async def open_loop(url, protocol, connections, workload, rate, warmup, duration):
+    """
+    Open-loop load: requests are sent at a fixed rate whether or not the earlier ones were
+    answered, as independent users would. Latencies are measured from the time a request
+    was due, so a server falling behind shows up as growing latency rather than as a
+    lower request rate (no coordinated omission). Requests beyond the connection limit
+    queue in the client, which also counts as latency.
+    """
+    start = time.perf_counter()
+    recorder = Recorder(start + warmup)
+    tasks = set()
+    async with open_transport(url, protocol, connections) as transport:
+        for number in range(int(rate * (warmup + duration))):
+            due = start + number / rate
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            task = asyncio.ensure_future(perform(transport, workload, recorder, workload.next_operation(), due))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+    return recorder
+
+
+def run_benchmark(args, proportions, distribution, concurrency=None, rate=None):
+    """
+    One measured run with a fresh workload of the same seed, so runs of a sweep (and of
+    two invocations with the same flags) send the same sequence of requests
+    """
+    workload = Workload(proportions, distribution, args.record_count, args.value_size, args.scan_length, args.seed)
+    if rate is not None:
+        connections = args.connections or args.max_inflight
+        recorder = asyncio.run(open_loop(args.url, args.protocol, connections, workload, rate, args.warmup, args.duration))
+        result = {'mode': 'open', 'rate': rate}
+    else:
+        recorder = asyncio.run(closed_loop(args.url, args.protocol, args.connections, workload, concurrency,
+                                           args.warmup, args.duration))
+        result = {'mode': 'closed', 'concurrency': concurrency}
+    result.update(recorder.summary(args.duration, args.histogram))
+    return result
+
+
+def compare(base_path, new_path):
+    """
+    The relative change of every overall number between the runs of two result files
+    """
+    with open(base_path) as file:
+        base = json.load(file)
+    with open(new_path) as file:
+        new = json.load(file)
+    changes = []
+    for base_run, new_run in zip(base['runs'], new['runs']):
+        change = {key: new_run[key] for key in ('mode', 'concurrency', 'rate') if key in new_run}
+        for key, value in new_run.items():
+            old = base_run.get(key)
+            if key in change or not isinstance(value, (int, float)) or not isinstance(old, (int, float)):
+                continue
+            change[key] = {'base': old, 'new': value, 'change': round((value - old) / old, 4) if old else None}
+        changes.append(change)
+    return changes
+
+
+def run_storage_benchmark(engine, threads, num_keys, seconds, write_percentage, save_interval):
+    """
+    In-process micro-benchmark of a MyKVStore storage engine: `threads` threads get and
+    put random keys of a LayeredStore on the engine while another thread keeps iterating
+    point-in-time views of it, like the background save does. The tail latency of the
+    foreground operations shows how long the saves hold them up. The memory the engine
+    takes per key is traced while the keys are loaded.
+    """
+    store = LayeredStore(create_engine(engine))
+    tracemalloc.start()
+    for i in range(num_keys):
+        store[f"key-{i}"] = f"value-{i}"
+    loaded_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    stop = threading.Event()
+    latencies = [[] for _ in range(threads)]
+    saves = []
+
+    def worker(index):
+        rnd = random.Random(index)
+        record = latencies[index].append
+        while not stop.is_set():
+            key = f"key-{rnd.randrange(num_keys)}"
+            start = time.perf_counter()
+            if rnd.random() < write_percentage:
+                store[key] = f"value-{start}"
+            else:
+                store.get(key)
+            record(time.perf_counter() - start)
+
+    def saver():
+        while not stop.wait(save_interval):
+            start = time.perf_counter()
+            for _ in store.items():
+                pass
+            saves.append(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    workers.append(threading.Thread(target=saver))
+    for thread in workers:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in workers:
+        thread.join()
+
+    merged = sorted(latency for thread_latencies in latencies for latency in thread_latencies)
+    return {
+        'engine': engine,
+        'threads': threads,
+        'keys': num_keys,
+        'ops': len(merged),
+        'throughput_ops': round(len(merged) / seconds, 2),
+        'latency_p50_us': round(1e6 * percentile(merged, 0.50), 2),
+        'latency_p99_us': round(1e6 * percentile(merged, 0.99), 2),
+        'latency_p999_us': round(1e6 * percentile(merged, 0.999), 2),
+        'latency_max_ms': round(1000 * merged[-1], 3) if merged else 0.0,
+        'saves': len(saves),
+        'bytes_per_key': round(loaded_bytes / num_keys, 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load generator and benchmark for the distributor or a single MyKVStore")
+    parser.add_argument('--url', help="the distributor (default), or a MyKVStore such as http://127.0.0.1:5001")
+    parser.add_argument('--workload', choices=sorted(WORKLOADS) + ['custom'], default='b',
+                        help="a YCSB core workload, or custom mixes of the --<operation> proportions")
+    for op in OPERATIONS:
+        parser.add_argument(f"--{op}", type=float, default=0.0, help=f"share of {op} operations in a custom workload")
+    parser.add_argument('--distribution', choices=DISTRIBUTIONS, help="key distribution, overrides the workload's")
+    parser.add_argument('--record-count', type=int, default=10000, help="keys stored before the run")
+    parser.add_argument('--value-size', default='100', help="value length, fixed ('100') or a uniform range ('10-1000')")
+    parser.add_argument('--scan-length', type=int, default=10, help="consecutive keys read by a scan")
+    parser.add_argument('--skip-load', action='store_true', help="the keys are already stored")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 100],
+                        help="closed loop: numbers of concurrent clients to run, one benchmark each")
+    parser.add_argument('--rate', type=float, nargs='+',
+                        help="open loop: requests per second to run, one benchmark each, instead of --concurrency")
+    parser.add_argument('--max-inflight', type=int, default=1000, help="open loop: HTTP connection limit")
+    parser.add_argument('--protocol', choices=['http', 'binary'], default='http',
+                        help="binary uses the binary protocol, with a tcp://host:port --url (default port 6000)")
+    parser.add_argument('--connections', type=int,
+                        help="connections to open, by default one per client (HTTP) or 4 (binary)")
+    parser.add_argument('--warmup', type=float, default=2, help="seconds of load before measuring")
+    parser.add_argument('--duration', type=float, default=10, help="seconds measured per benchmark")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--histogram', action='store_true', help="include the latency buckets in the results")
+    parser.add_argument('--label', default='', help="e.g. the distributor mode under test")
+    parser.add_argument('--output', help="write the JSON results to this file")
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'),
+                        help="print the changes between two result files instead of running")
+    parser.add_argument('--storage', action='store_true',
+                        help="run the in-process storage engine micro-benchmark instead")
+    parser.add_argument('--engines', nargs='+', choices=sorted(ENGINES), default=sorted(ENGINES))
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--keys', type=int, default=500000)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--write-percentage', type=float, default=0.5)
+    parser.add_argument('--save-interval', type=float, default=0.5,
+                        help="pause between two iterations of the whole store")
+    args = parser.parse_args()
+
+    if args.url is None:
+        args.url = BINARY_URL if args.protocol == 'binary' else BASE_URL
+    if args.protocol == 'binary' and args.connections is None:
+        args.connections = 4
+
+    if args.compare:
+        print(json.dumps(compare(*args.compare), indent=2, sort_keys=True))
+        raise SystemExit
+
+    if args.storage:
+        for threads in args.threads:
+            for engine in args.engines:
+                result = run_storage_benchmark(engine, threads, args.keys, args.seconds,
+                                               args.write_percentage, args.save_interval)
+                print(json.dumps(result))
+        raise SystemExit
+
+    if args.workload == 'custom':
+        proportions = {op: getattr(args, op) for op in OPERATIONS if getattr(args, op) > 0}
+        if not proportions:
+            parser.error("a custom workload needs at least one of --" + ", --".join(OPERATIONS))
+        distribution = 'uniform'
+    else:
+        proportions, distribution = WORKLOADS[args.workload]
+    distribution = args.distribution or distribution
+
+    if not args.skip_load:
+        workload = Workload(proportions, distribution, args.record_count, args.value_size, args.scan_length, args.seed)
+        asyncio.run(load(args.url, args.protocol, workload))
+    runs = []
+    for setting in args.rate or args.concurrency:
+        if args.rate:
+            result = run_benchmark(args, proportions, distribution, rate=setting)
+        else:
+            result = run_benchmark(args, proportions, distribution, concurrency=setting)
+        print(f"{result['mode']} loop {setting}: {result['throughput_ops']} ops/s, "
+              f"p50 {result['p50_us']} us, p99 {result['p99_us']} us, errors {result['errors']}", file=sys.stderr)
+        runs.append(result)
+
+    results = {
+        'label': args.label,
+        'config': {
+            'url': args.url,
+            'protocol': args.protocol,
+            'workload': args.workload,
+            'proportions': proportions,
+            'distribution': distribution,
+            'record_count': args.record_count,
+            'value_size': args.value_size,
+            'scan_length': args.scan_length,
+            'warmup_s': args.warmup,
+            'duration_s': args.duration,
+            'seed': args.seed,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'runs': runs,
+    }
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
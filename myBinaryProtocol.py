@@ -0,0 +1,542 @@
+import asyncio
+import itertools
+import math
+import socket
+import struct
+import threading
+import time
+
+# A frame is a 4 byte big endian length followed by that many bytes: a header of
+# code (1 byte), request id (4 bytes) and key length (4 bytes), then the key and the value.
+# Requests carry an opcode as code, responses a status, the request id of the request
+# they answer and an empty key. Responses on a connection may arrive in any order.
+_LENGTH = struct.Struct('>I')
+_HEADER = struct.Struct('>BII')
+MAX_FRAME = 64 * 1024 * 1024
+
+OP_GET = 1
+OP_PUT = 2
+OP_DEL = 3
+OP_PING = 4
+OPCODE_NAMES = {OP_GET: 'get', OP_PUT: 'put', OP_DEL: 'del', OP_PING: 'ping'}
+
+# With this bit set in the code, an expiry time (an 8 byte big endian float, seconds since
+# the epoch) follows the header, before the key: a PUT stores its value until then, and
+# the OK answer of a GET carries the expiry time of its value. Without it, a PUT stores
+# a value that does not expire, and a GET answer means the value does not expire.
+FLAG_EXPIRES = 0x80
+_EXPIRES = struct.Struct('>d')
+
+STATUS_OK = 0
+STATUS_NOT_FOUND = 1
+STATUS_ERROR = 2
+# the HTTP status with the same meaning, for metrics and for clients mixing both protocols
+HTTP_STATUS = {STATUS_OK: 200, STATUS_NOT_FOUND: 404, STATUS_ERROR: 503}
+
+
+class BinaryProtocolError(Exception):
+    """
+    Raised when a binary connection fails or a peer sends a malformed frame.
+    """
+
+
+def encode_frame(code, request_id, key=b'', value=b'', expires_at=None):
+    if expires_at is None:
+        return (_LENGTH.pack(_HEADER.size + len(key) + len(value)) + _HEADER.pack(code, request_id, len(key))
+                + key + value)
+    return (_LENGTH.pack(_HEADER.size + _EXPIRES.size + len(key) + len(value))
+            + _HEADER.pack(code | FLAG_EXPIRES, request_id, len(key)) + _EXPIRES.pack(expires_at) + key + value)
+
+
+def split_frames(buffer):
+    """
+    Remove the complete frames from the start of buffer (a bytearray) and return them as
+    (code, request_id, key, value, expires_at) tuples, code without FLAG_EXPIRES and
+    expires_at None without it; an incomplete frame stays in the buffer.
+    """
+    frames = []
+    start = 0
+    size = len(buffer)
+    while size - start >= _LENGTH.size:
+        length = _LENGTH.unpack_from(buffer, start)[0]
+        if length < _HEADER.size or length > MAX_FRAME:
+            raise BinaryProtocolError(f"invalid frame length {length}")
+        end = start + _LENGTH.size + length
+        if end > size:
+            break
+        code, request_id, key_length = _HEADER.unpack_from(buffer, start + _LENGTH.size)
+        key_start = start + _LENGTH.size + _HEADER.size
+        expires_at = None
+        if code & FLAG_EXPIRES:
+            if length < _HEADER.size + _EXPIRES.size:
+                raise BinaryProtocolError(f"invalid frame length {length} with an expiry time")
+            code &= ~FLAG_EXPIRES
+            expires_at = _EXPIRES.unpack_from(buffer, key_start)[0]
+            key_start += _EXPIRES.size
+        frames.append((code, request_id, bytes(buffer[key_start:key_start + key_length]),
+                       bytes(buffer[key_start + key_length:end]), expires_at))
+        start = end
+    if start:
+        del buffer[:start]
+    return frames
+
+
+class _ServerProtocol(asyncio.Protocol):
+    """
+    One client connection of a BinaryServer. Every frame that arrived in one read is
+    handled before the answers are written back with a single write, so a pipelining
+    client gets its answers in batches. Async handlers run concurrently, each answer
+    written as soon as it is ready.
+    """
+    def __init__(self, handler, concurrent):
+        self.handler = handler
+        self.concurrent = concurrent
+        self.buffer = bytearray()
+        self.transport = None
+        self.tasks = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        for task in self.tasks:
+            task.cancel()
+
+    def data_received(self, data):
+        self.buffer += data
+        try:
+            frames = split_frames(self.buffer)
+        except BinaryProtocolError:
+            self.transport.close()
+            return
+        answers = []
+        for code, request_id, key, value, expires_at in frames:
+            if self.concurrent:
+                task = asyncio.ensure_future(self._answer(code, request_id, key, value, expires_at))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+                continue
+            try:
+                status, result, expires_at = self.handler(code, key, value, expires_at)
+            except Exception as e:
+                status, result, expires_at = STATUS_ERROR, str(e).encode('utf-8'), None
+            answers.append(encode_frame(status, request_id, b'', result, expires_at))
+        if answers:
+            self.transport.write(b''.join(answers))
+
+    async def _answer(self, code, request_id, key, value, expires_at):
+        try:
+            status, result, expires_at = await self.handler(code, key, value, expires_at)
+        except Exception as e:
+            status, result, expires_at = STATUS_ERROR, str(e).encode('utf-8'), None
+        if not self.transport.is_closing():
+            self.transport.write(encode_frame(status, request_id, b'', result, expires_at))
+
+
+class BinaryServer:
+    """
+    Serves the binary protocol on host:port. handler(opcode, key, value, expires_at)
+    returns (status, value, expires_at) with bytes keys and values, and the expiry times
+    of the request and of the answer or None; a coroutine function handler is run
+    concurrently for the pipelined requests of a connection, a plain function inline.
+    With reuse_port, other processes (distributor workers) may serve the same port.
+    """
+    def __init__(self, handler, host='127.0.0.1', port=6000, reuse_port=False):
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.reuse_port = reuse_port
+        self.server = None
+
+    async def start(self):
+        concurrent = asyncio.iscoroutinefunction(self.handler)
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(lambda: _ServerProtocol(self.handler, concurrent),
+                                               self.host, self.port, reuse_address=True,
+                                               reuse_port=self.reuse_port or None)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+    # serve from a new daemon thread with its own event loop, for the threaded servers
+    def start_in_thread(self):
+        async def serve():
+            await self.start()
+            await self.server.serve_forever()
+        thread = threading.Thread(target=asyncio.run, args=(serve(),), daemon=True)
+        thread.start()
+        return thread
+
+
+class BinaryClient:
+    """
+    A blocking client of the binary protocol over one TCP connection, which is opened on
+    first use and reopened after a failure.
+
+        client = BinaryClient('127.0.0.1', 6000)
+        client.put('key', 'value')
+        client.put('session', 'data', ttl=60)   # deleted after 60 seconds
+        client.get('key')                       # 'value', or None if missing
+        with client.pipeline() as pipe:         # one round trip for all requests
+            pipe.put('a', '1')
+            pipe.get('b')
+        pipe.results                            # [(status, value), ...] in request order
+
+    get/put/delete raise BinaryProtocolError when the server answers with STATUS_ERROR.
+    """
+    def __init__(self, host='127.0.0.1', port=6000, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = bytearray()
+        self._ids = itertools.count(1)
+
+    def _connection(self):
+        if self.sock is None:
+            self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.buffer = bytearray()
+        return self.sock
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def execute(self, requests):
+        """
+        Send (opcode, key, value) or (opcode, key, value, expires_at) requests in one write,
+        pipelined, and return their (status, value) answers in the same order, values as bytes
+        """
+        ids = []
+        frames = []
+        for opcode, key, value, *expires_at in requests:
+            request_id = next(self._ids) & 0xFFFFFFFF
+            ids.append(request_id)
+            frames.append(encode_frame(opcode, request_id, _to_bytes(key), _to_bytes(value),
+                                       expires_at[0] if expires_at else None))
+        try:
+            sock = self._connection()
+            sock.sendall(b''.join(frames))
+            answers = dict()
+            while len(answers) < len(ids):
+                data = sock.recv(256 * 1024)
+                if not data:
+                    raise BinaryProtocolError("the server closed the connection")
+                self.buffer += data
+                for status, request_id, _, value, _ in split_frames(self.buffer):
+                    answers[request_id] = (status, value)
+        except (OSError, BinaryProtocolError) as e:
+            self.close()
+            raise BinaryProtocolError(f"request to {self.host}:{self.port} failed: {e}") from e
+        return [answers[request_id] for request_id in ids]
+
+    def pipeline(self):
+        return _Pipeline(self)
+
+    def _single(self, opcode, key, value=b'', expires_at=None):
+        status, result = self.execute([(opcode, key, value, expires_at)])[0]
+        if status == STATUS_ERROR:
+            raise BinaryProtocolError(result.decode('utf-8', errors='replace'))
+        return status, result
+
+    def get(self, key):
+        status, value = self._single(OP_GET, key)
+        return value.decode('utf-8') if status == STATUS_OK else None
+
+    # ttl: seconds until the value is deleted, None to keep it
+    def put(self, key, value, ttl=None):
+        self._single(OP_PUT, key, value, expires_time(ttl))
+
+    # True if the key existed
+    def delete(self, key):
+        return self._single(OP_DEL, key)[0] == STATUS_OK
+
+    def ping(self):
+        return self._single(OP_PING, b'')[0] == STATUS_OK
+
+
+class _Pipeline:
+    """
+    Requests collected by BinaryClient.pipeline() and sent together when the block ends.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.requests = []
+        self.results = None
+
+    def get(self, key):
+        self.requests.append((OP_GET, key, b''))
+
+    def put(self, key, value, ttl=None):
+        self.requests.append((OP_PUT, key, value, expires_time(ttl)))
+
+    def delete(self, key):
+        self.requests.append((OP_DEL, key, b''))
+
+    def execute(self):
+        self.results = self.client.execute(self.requests)
+        self.requests = []
+        return self.results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.execute()
+
+
+def _to_bytes(value):
+    return value.encode('utf-8') if isinstance(value, str) else value
+
+
+# the expiry time of a value stored for ttl seconds, None without a ttl
+def expires_time(ttl):
+    return time.time() + ttl if ttl is not None else None
+
+
+class _ClientProtocol(asyncio.Protocol):
+    def __init__(self, pending):
+        self.pending = pending
+        self.buffer = bytearray()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        try:
+            frames = split_frames(self.buffer)
+        except BinaryProtocolError:
+            self.transport.close()
+            return
+        for status, request_id, _, value, expires_at in frames:
+            future = self.pending.pop(request_id, None)
+            if future is not None and not future.done():
+                future.set_result((status, value, expires_at))
+
+    def connection_lost(self, exc):
+        error = BinaryProtocolError(f"connection lost: {exc}" if exc else "the server closed the connection")
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.pending.clear()
+
+
+class AsyncBinaryClient:
+    """
+    An asyncio client of the binary protocol. All concurrent requests share one
+    connection: each is written as soon as it is made and matched to its answer by
+    request id, so any number of requests can be in flight at once. The connection is
+    opened on first use and reopened after it failed.
+    """
+    def __init__(self, host='127.0.0.1', port=6000, connect_timeout=1.0, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.transport = None
+        self.pending = dict()
+        self._ids = itertools.count(1)
+        self._connecting = None
+
+    async def _connection(self):
+        if self.transport is not None and not self.transport.is_closing():
+            return self.transport
+        # concurrent requests wait for the same connection attempt
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._connect())
+        try:
+            return await asyncio.shield(self._connecting)
+        finally:
+            if self._connecting is not None and self._connecting.done():
+                self._connecting = None
+
+    async def _connect(self):
+        self.pending = dict()
+        loop = asyncio.get_running_loop()
+        try:
+            transport, _ = await asyncio.wait_for(
+                loop.create_connection(lambda: _ClientProtocol(self.pending), self.host, self.port),
+                self.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise BinaryProtocolError(f"cannot connect to {self.host}:{self.port}: {e}") from e
+        self.transport = transport
+        return transport
+
+    async def request(self, opcode, key=b'', value=b'', expires_at=None):
+        """
+        Send one request, a PUT with expires_at storing a value until then, and return its
+        (status, value, expires_at) answer, value as bytes and expires_at the expiry time
+        of the value of a GET, or None.
+        Raises BinaryProtocolError if the connection fails or the answer times out.
+        """
+        transport = await self._connection()
+        request_id = next(self._ids) & 0xFFFFFFFF
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        transport.write(encode_frame(opcode, request_id, _to_bytes(key), _to_bytes(value), expires_at))
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError as e:
+            self.pending.pop(request_id, None)
+            raise BinaryProtocolError(f"request to {self.host}:{self.port} timed out") from e
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+
+class BinaryFrontend:
+    """
+    The binary protocol endpoint of a distributor (MyDistributor or MyAsyncDistributor),
+    serving GET, PUT and DEL with the same replication, quorums, hot key cache and
+    rebalance fallbacks as the HTTP routes. Requests are forwarded to the binary ports
+    of the kv stores (their HTTP port + offset) over one pipelined AsyncBinaryClient
+    each, and the answers of replicas beyond the quorum are not waited for.
+    """
+    def __init__(self, distributor, offset, connect_timeout=1.0, read_timeout=5.0):
+        self.distributor = distributor
+        self.offset = offset
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.clients = dict()
+        self._background = set()
+
+    def _client(self, node):
+        client = self.clients.get(node)
+        if client is None:
+            client = self.clients[node] = AsyncBinaryClient(port=int(node) + self.offset,
+                                                            connect_timeout=self.connect_timeout,
+                                                            timeout=self.read_timeout)
+        return client
+
+    async def _request(self, node, opcode, key, value, expires_at=None):
+        started = time.perf_counter()
+        loads = self.distributor.loads
+        if loads is not None:
+            loads.begin(node)
+        try:
+            status, result, expires_at = await self._client(node).request(opcode, key, value, expires_at)
+        except BinaryProtocolError as e:
+            self.distributor._observe_backend(node, started, True)
+            self._hint_write(node, opcode, key)
+            return node, None, e, None
+        finally:
+            if loads is not None:
+                loads.end(node)
+        self.distributor._observe_backend(node, started, status == STATUS_ERROR)
+        if status == STATUS_ERROR:
+            self._hint_write(node, opcode, key)
+        return node, status, result, expires_at
+
+    def _hint_write(self, node, opcode, key):
+        if opcode in (OP_PUT, OP_DEL):
+            self.distributor._hint_write(node, 'PUT' if opcode == OP_PUT else 'DEL',
+                                         {'key': key.decode('utf-8')}, None)
+
+    # the binary version of MyDistributor._send_to_replicas: (answers, errors) with
+    # (node, status, value, expires_at) answers
+    async def _send_to_replicas(self, nodes, opcode, key, value, quorum, balanced=False, expires_at=None):
+        answers = []
+        errors = []
+        for wave in self.distributor._replica_waves(nodes, quorum, balanced):
+            tasks = [asyncio.ensure_future(self._request(node, opcode, key, value, expires_at)) for node in wave]
+            for next_answer in asyncio.as_completed(tasks):
+                node, status, result, expires_at = await next_answer
+                if status is None or status == STATUS_ERROR:
+                    errors.append(f"server at port {node} failed: {result}")
+                    continue
+                answers.append((node, status, result, expires_at))
+                if len(answers) >= quorum:
+                    break
+            for task in tasks:
+                if not task.done():
+                    self._background.add(task)
+                    task.add_done_callback(self._background.discard)
+            if len(answers) >= quorum:
+                break
+        return answers, errors
+
+    @staticmethod
+    def _quorum_answer(answers, errors, quorum):
+        if not answers or len(answers) < quorum:
+            return (STATUS_ERROR, f"{len(answers)} of {quorum} replicas answered: {'; '.join(errors)}".encode('utf-8'),
+                    None)
+        for _, status, result, expires_at in answers:
+            if status == STATUS_OK:
+                return status, result, expires_at
+        return answers[0][1:]
+
+    async def handle(self, opcode, key, value, expires_at):
+        started = time.perf_counter()
+        self.distributor._sync_ring()
+        if opcode == OP_GET:
+            status, result, expires_at = await self._get(key)
+        elif opcode == OP_PUT:
+            status, result, expires_at = await self._put(key, value, expires_at)
+        elif opcode == OP_DEL:
+            status, result, expires_at = await self._delete(key)
+        elif opcode == OP_PING:
+            status, result, expires_at = STATUS_OK, b'', None
+        else:
+            status, result, expires_at = STATUS_ERROR, f"unknown opcode {opcode}".encode('utf-8'), None
+        route = f"binary:{OPCODE_NAMES.get(opcode, 'unknown')}"
+        self.distributor.request_metrics.observe(route, 'BINARY', HTTP_STATUS[status], time.perf_counter() - started)
+        return status, result, expires_at
+
+    async def _get(self, key):
+        distributor = self.distributor
+        name = key.decode('utf-8')
+        values, tokens = distributor._cache_lookup([name])
+        if values:
+            return STATUS_OK, values[name].encode('utf-8'), None
+        nodes = distributor._preference_list(name)
+        quorum = min(distributor.read_quorum, len(nodes))
+        answers, errors = await self._send_to_replicas(nodes, OP_GET, key, b'', quorum, balanced=True)
+        status, result, expires_at = self._quorum_answer(answers, errors, quorum)
+        # during a rebalance the key may not have reached its new owner yet
+        if status == STATUS_NOT_FOUND:
+            previous = distributor.rebalancer.previous_owner(name)
+            if previous is not None:
+                answers, errors = await self._send_to_replicas([previous], OP_GET, key, b'', 1)
+                status, result, expires_at = self._quorum_answer(answers, errors, 1)
+        if status == STATUS_OK:
+            distributor._cache_fill({name: result.decode('utf-8')}, tokens,
+                                    {name: expires_at} if expires_at is not None else None)
+        return status, result, expires_at
+
+    async def _put(self, key, value, expires_at):
+        if expires_at is not None and not math.isfinite(expires_at):
+            return STATUS_ERROR, b'the expiry time must be a finite number', None
+        distributor = self.distributor
+        name = key.decode('utf-8')
+        nodes = distributor._preference_list(name, hint=True)
+        quorum = min(distributor.write_quorum, len(nodes))
+        distributor._cache_invalidate([name])
+        answers, errors = await self._send_to_replicas(nodes, OP_PUT, key, value, quorum, expires_at=expires_at)
+        distributor._cache_invalidate([name])
+        return self._quorum_answer(answers, errors, quorum)
+
+    async def _delete(self, key):
+        distributor = self.distributor
+        name = key.decode('utf-8')
+        nodes = distributor._preference_list(name, hint=True)
+        quorum = min(distributor.write_quorum, len(nodes))
+        distributor.rebalancer.record_delete(name)
+        distributor._cache_invalidate([name])
+        answers, errors = await self._send_to_replicas(nodes, OP_DEL, key, b'', quorum)
+        status, result, expires_at = self._quorum_answer(answers, errors, quorum)
+        # during a rebalance the key may still be on its previous owner as well
+        previous = distributor.rebalancer.previous_owner(name)
+        if previous is not None:
+            _, previous_status, previous_result, _ = await self._request(previous, OP_DEL, key, b'')
+            if status == STATUS_NOT_FOUND and previous_status is not None:
+                status, result = previous_status, previous_result
+        distributor._cache_invalidate([name])
+        return status, result, expires_at
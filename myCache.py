@@ -0,0 +1,274 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class _LRUPolicy:
+    """
+    Plain least recently used eviction over one OrderedDict, most recent on the right.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    # store an entry and return the (key, entry) pairs evicted to make room for it
+    def put(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        evicted = []
+        while len(self.entries) > self.max_entries:
+            evicted.append(self.entries.popitem(last=False))
+        return evicted
+
+    def remove(self, key):
+        return self.entries.pop(key, None)
+
+    # the next entry to give up when the cache is over its byte budget
+    def pop_victim(self):
+        return self.entries.popitem(last=False) if self.entries else None
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class _FrequencySketch:
+    """
+    A count-min sketch of 4 rows of 4 bit counters estimating how often keys were
+    accessed. All counters are halved every sample_size increments, so the estimates
+    follow the recent popularity of keys.
+    """
+    def __init__(self, max_entries):
+        width = 16
+        while width < 4 * max_entries:
+            width *= 2
+        self.mask = width - 1
+        self.rows = [bytearray(width) for _ in range(4)]
+        self.sample_size = 10 * max_entries
+        self.additions = 0
+
+    def _indexes(self, key):
+        hash_val = hash(key)
+        step = (hash_val >> 17) | 1
+        return [(hash_val + i * step) & self.mask for i in range(4)]
+
+    def increment(self, key):
+        for row, index in zip(self.rows, self._indexes(key)):
+            if row[index] < 15:
+                row[index] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            for row in self.rows:
+                for index in range(len(row)):
+                    row[index] >>= 1
+            self.additions //= 2
+
+    def frequency(self, key):
+        return min(row[index] for row, index in zip(self.rows, self._indexes(key)))
+
+
+class _TinyLFUPolicy:
+    """
+    W-TinyLFU eviction: new keys enter a small LRU window (1% of the entries); keys
+    leaving the window only displace the oldest key of the main area if the frequency
+    sketch says they are accessed more often. The main area is a segmented LRU, where
+    keys hit again on probation are promoted to the protected segment (80% of the main
+    area). One-off reads of cold keys therefore cannot flush the hot keys of a skewed
+    workload out of the cache, as they do with plain LRU.
+    """
+    def __init__(self, max_entries):
+        self.window_size = max(1, max_entries // 100)
+        self.main_size = max(1, max_entries - self.window_size)
+        self.protected_size = max(1, int(self.main_size * 0.8))
+        self.window = OrderedDict()
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        self.sketch = _FrequencySketch(max_entries)
+
+    def get(self, key):
+        self.sketch.increment(key)
+        entry = self.window.get(key)
+        if entry is not None:
+            self.window.move_to_end(key)
+            return entry
+        entry = self.protected.get(key)
+        if entry is not None:
+            self.protected.move_to_end(key)
+            return entry
+        entry = self.probation.pop(key, None)
+        if entry is not None:
+            self.protected[key] = entry
+            if len(self.protected) > self.protected_size:
+                demoted, demoted_entry = self.protected.popitem(last=False)
+                self.probation[demoted] = demoted_entry
+        return entry
+
+    def put(self, key, entry):
+        for segment in (self.window, self.probation, self.protected):
+            if key in segment:
+                segment[key] = entry
+                segment.move_to_end(key)
+                return []
+        self.window[key] = entry
+        if len(self.window) <= self.window_size:
+            return []
+        candidate, candidate_entry = self.window.popitem(last=False)
+        if len(self.probation) + len(self.protected) < self.main_size:
+            self.probation[candidate] = candidate_entry
+            return []
+        if not self.probation:
+            return [(candidate, candidate_entry)]
+        victim = next(iter(self.probation))
+        if self.sketch.frequency(candidate) > self.sketch.frequency(victim):
+            victim_entry = self.probation.pop(victim)
+            self.probation[candidate] = candidate_entry
+            return [(victim, victim_entry)]
+        return [(candidate, candidate_entry)]
+
+    def remove(self, key):
+        for segment in (self.window, self.probation, self.protected):
+            entry = segment.pop(key, None)
+            if entry is not None:
+                return entry
+        return None
+
+    def pop_victim(self):
+        for segment in (self.probation, self.window, self.protected):
+            if segment:
+                return segment.popitem(last=False)
+        return None
+
+    def clear(self):
+        self.window.clear()
+        self.probation.clear()
+        self.protected.clear()
+
+    def __len__(self):
+        return len(self.window) + len(self.probation) + len(self.protected)
+
+
+POLICIES = {'lru': _LRUPolicy, 'tinylfu': _TinyLFUPolicy}
+
+
+class HotKeyCache:
+    """
+    A bounded in-process cache of the values read through the distributor, so reads of
+    hot keys are answered without a round trip to a MyKVStore.
+
+    max_entries / max_bytes: the cache evicts keys (by policy, 'lru' or 'tinylfu')
+                             once it holds more keys, or more key and value bytes
+    ttl: seconds a value may be served from the cache, 0 for no expiry; fill() can shorten
+         it for values that expire in the kv stores sooner
+
+    Writes invalidate keys, but a read that fetched the old value from a kv store
+    before the write could still store it after the invalidation. Every key hashes to
+    one of `stripes` generation counters that invalidate() increments: a read takes the
+    counter with begin_fill() before it forwards the request, and fill() only stores the
+    value if the counter has not moved since. clear() moves all of them.
+    """
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024, ttl=0, policy='tinylfu', stripes=64):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown cache policy {policy!r}, expected one of {sorted(POLICIES)}")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.policy_name = policy
+        self.policy = POLICIES[policy](max_entries)
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.generations = [0] * stripes
+        self.epoch = 0
+        self.counters = {
+            'hits': 0,
+            'misses': 0,
+            'fills': 0,
+            'stale_fills': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'invalidations': 0,
+            'flushes': 0,
+        }
+
+    def _stripe(self, key):
+        return hash(key) % len(self.generations)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.policy.get(key)
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            value, size, expires = entry
+            if expires and expires < time.monotonic():
+                self.policy.remove(key)
+                self.bytes -= size
+                self.counters['expirations'] += 1
+                self.counters['misses'] += 1
+                return None
+            self.counters['hits'] += 1
+            return value
+
+    def begin_fill(self, key):
+        return self.epoch, self.generations[self._stripe(key)]
+
+    def fill(self, key, value, token, ttl=0):
+        size = len(key) + len(value)
+        if size > self.max_bytes:
+            return
+        ttl = min(self.ttl, ttl) if self.ttl and ttl else self.ttl or ttl
+        expires = time.monotonic() + ttl if ttl else 0
+        with self.lock:
+            if token != (self.epoch, self.generations[self._stripe(key)]):
+                self.counters['stale_fills'] += 1
+                return
+            old = self.policy.remove(key)
+            if old is not None:
+                self.bytes -= old[1]
+            evicted = self.policy.put(key, (value, size, expires))
+            self.bytes += size - sum(entry[1] for _, entry in evicted)
+            while self.bytes > self.max_bytes:
+                victim = self.policy.pop_victim()
+                self.bytes -= victim[1][1]
+                evicted.append(victim)
+            self.counters['fills'] += 1
+            self.counters['evictions'] += len(evicted)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.generations[self._stripe(key)] += 1
+            entry = self.policy.remove(key)
+            if entry is not None:
+                self.bytes -= entry[1]
+                self.counters['invalidations'] += 1
+
+    def invalidate_many(self, keys):
+        for key in keys:
+            self.invalidate(key)
+
+    def clear(self):
+        with self.lock:
+            self.epoch += 1
+            self.policy.clear()
+            self.bytes = 0
+            self.counters['flushes'] += 1
+
+    def stats(self):
+        with self.lock:
+            result = dict(self.counters)
+            result['entries'] = len(self.policy)
+            result['bytes'] = self.bytes
+        lookups = result['hits'] + result['misses']
+        result['hit_ratio'] = round(result['hits'] / lookups, 4) if lookups else 0.0
+        result['policy'] = self.policy_name
+        result['max_entries'] = self.max_entries
+        result['max_bytes'] = self.max_bytes
+        result['ttl'] = self.ttl
+        return result
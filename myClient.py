@@ -1,28 +1,8 @@
-from csv import writer
-from math import fabs
-import socket
-import time
-import threading
-from urllib import response
-import urllib.parse
+import argparse
 import requests
-import json
-import random
-import csv
 
 BASE_URL = "http://127.0.0.1:5000"
 
-HOST, PORT = '127.0.0.1', 5000
-NUM_REQUESTS = 1000  # Number of requests to send per client
-NUM_CLIENTS = 10    # Number of concurrent clients
-READ_PERCENTAGE = 0.95  # Percent of Read
-ALL_METHODS = False  # Flag for testing all three methods from each client
-TEST_DISTRUBUTION = True   # Flag for testing two methods (read and write) from each client
-
-TEST_ADD_OR_REMOVE = False # Flag for testing adding/removing server behavior with a benefit of Consistent hashing
-# Please change NUM_REQUESTS and NUM_CLIENTS to 1 to pervent chaostic behavior
-
-
 def put_value(key, value):
     """
     Client side put request function
@@ -58,7 +38,7 @@ def del_value(key):
     Client side del method request function
     """
     try:
-        response = requests.request("DEL", BASE_URL + "/del", params={"key": key})
+        response = requests.request("DELETE", BASE_URL + "/del", params={"key": key})
         if response.status_code == 200:
             print("DELETE successful:", response.json())
         elif response.status_code == 404:
@@ -69,6 +49,48 @@ def del_value(key):
         print("Error occurred:", e)
         
         
+def mput_values(items):
+    """
+    Client side batch put request function, items is a {key: value} dict
+    """
+    try:
+        response = requests.put(BASE_URL + "/mput", json={"items": items})
+        if response.status_code == 200:
+            print("MPUT successful:", response.json())
+        else:
+            print("Failed to MPUT:", response.text)
+    except Exception as e:
+        print("Error occurred:", e)
+
+
+def mget_values(keys):
+    """
+    Client side batch get request function
+    """
+    try:
+        response = requests.post(BASE_URL + "/mget", json={"keys": keys})
+        if response.status_code == 200:
+            print("MGET successful:", response.json())
+        else:
+            print("Failed to MGET:", response.text)
+    except Exception as e:
+        print("Error occurred:", e)
+
+
+def mdel_values(keys):
+    """
+    Client side batch del request function
+    """
+    try:
+        response = requests.request("DELETE", BASE_URL + "/mdel", json={"keys": keys})
+        if response.status_code == 200:
+            print("MDEL successful:", response.json())
+        else:
+            print("Failed to MDEL:", response.text)
+    except Exception as e:
+        print("Error occurred:", e)
+        
+        
 def add_server():
     """
     Client side function to send a add server request to the main distrubutor server
@@ -85,88 +107,47 @@ def add_server():
 
 def remove_server(port):
     """
-    Client side function to send a add server request to the main distrubutor server
+    Client side function to send a remove server request to the main distrubutor server
     """
     try:
         response = requests.post(BASE_URL + "/remove_server", params={"port": port})
         if response.status_code == 200:
-            print("Adding server successful:", response.json())
+            print("Removing server successful:", response.json())
         else:
             print("Removing server failed", response.text)
     except Exception as e:
         print("Error occurred:", e)
-        
-
-# compute reasonable csv file name containing Latency/Throughput pairs  
-if (ALL_METHODS):
-    filename = f"Latency_over_Throughput_with_all_three_methods_{NUM_CLIENTS}_clients.csv" 
-elif TEST_DISTRUBUTION:
-    filename = "Latency_over_Throughput_with_read_and_write.csv" 
-else:
-    filename = f"Latency_over_Throughput_with_{READ_PERCENTAGE}_read.csv" 
 
 
-def should_read():
-    """
-    Function for percentage of read and write 
-    """
-    return random.random() < READ_PERCENTAGE
-
-# example program from professor Annwar to generate Latency/Throughput
-def client_thread(client_id):
-    start_time = time.time()
-    
-    if (ALL_METHODS):
-        number_of_methods = 3
-    elif (TEST_DISTRUBUTION):
-        number_of_methods = 2
-    else:
-        number_of_methods = 1
-    
-    for i in range(NUM_REQUESTS):
-        key = f"key-{client_id}-{i}"
-        value = f"value-{client_id}-{i}"
-        port = "5001"
-        
-        if (ALL_METHODS):
-            put_value(key, value)
-            get_value(key)
-            del_value(key)
-        elif (TEST_DISTRUBUTION):
-            put_value(key, value)
-            get_value(key)
-        elif (TEST_ADD_OR_REMOVE):
-            add_server()
-            remove_server(port)
-        else:
-            if should_read():
-                get_value(key)
-            else:
-                put_value(key, value)
-    
-    # End time
-    end_time = time.time()
-    elapsed_time = end_time - start_time
-    throughput = NUM_REQUESTS * number_of_methods / elapsed_time  
-    latency = elapsed_time / (NUM_REQUESTS * number_of_methods)
-
-    print(f"Client-{client_id} | Throughput: {throughput:.2f} req/s | Average Latency: {latency:.6f} seconds")
-    
-    # list of Latency/Throughput pair
-    LT = [f"{latency:.6f}", f"{throughput:.2f}"]
-    with open(filename, 'a') as file:
-        writer = csv.writer(file)
-        writer.writerow(LT)
-
+# load testing moved to myBenchmark.py, this only sends single requests by hand
 if __name__ == "__main__":
-    clients = []
-
-    for i in range(NUM_CLIENTS):
-        t = threading.Thread(target=client_thread, args=(i,))
-        clients.append(t)
-        t.start()
-
-    for t in clients:
-        t.join()
-
-    print("Testing completed.")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Send single requests to the distributor, see myBenchmark.py for load tests")
+    parser.add_argument('--url', default=BASE_URL)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('put').add_argument('key_value', nargs=2, metavar=('KEY', 'VALUE'))
+    commands.add_parser('get').add_argument('key')
+    commands.add_parser('del').add_argument('key')
+    commands.add_parser('mput').add_argument('pairs', nargs='+', metavar='KEY=VALUE')
+    commands.add_parser('mget').add_argument('keys', nargs='+')
+    commands.add_parser('mdel').add_argument('keys', nargs='+')
+    commands.add_parser('add_server')
+    commands.add_parser('remove_server').add_argument('port', type=int)
+    args = parser.parse_args()
+    BASE_URL = args.url
+
+    if args.command == 'put':
+        put_value(*args.key_value)
+    elif args.command == 'get':
+        get_value(args.key)
+    elif args.command == 'del':
+        del_value(args.key)
+    elif args.command == 'mput':
+        mput_values(dict(pair.split('=', 1) for pair in args.pairs))
+    elif args.command == 'mget':
+        mget_values(args.keys)
+    elif args.command == 'mdel':
+        mdel_values(args.keys)
+    elif args.command == 'add_server':
+        add_server()
+    else:
+        remove_server(args.port)
@@ -0,0 +1,283 @@
+import http.client
+import json
+import select
+import socket
+import threading
+import time
+import urllib.parse
+from collections import deque
+
+# the methods whose requests may be sent again after their response was lost
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class ConnectionPoolError(Exception):
+    """
+    Raised when a backend cannot be reached through the pool, either because no
+    connection slot became free in time or because the connection attempt failed.
+    """
+
+
+class BackendResponse:
+    """
+    A small response object returned by ConnectionPool.request. It mirrors the parts
+    of requests.Response the distributor relies on (status_code, text and json()).
+    """
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.content = body
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class _NodePool:
+    """
+    The idle connections and counters of one backend.
+    self.slots bounds the number of open (idle + in use) connections to the backend.
+    self.idle holds (connection, last_used) pairs, most recently used on the right.
+    self.active holds the connections in use, and self.aborted the ones abort() cut off.
+    """
+    def __init__(self, max_size):
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.idle = deque()
+        self.active = set()
+        self.aborted = set()
+        self.lock = threading.Lock()
+        self.stats = {
+            'requests': 0,
+            'hits': 0,
+            'misses': 0,
+            'waits': 0,
+            'wait_timeouts': 0,
+            'reconnects': 0,
+            'evictions': 0,
+            'errors': 0,
+            'aborts': 0,
+        }
+
+
+class ConnectionPool:
+    """
+    A per-backend pool of keep-alive HTTP connections owned by MyDistributor.
+    Instead of opening a new TCP connection to 127.0.0.1:{node} for every forwarded
+    request, connections are checked out of the backend's pool and returned after the
+    response is read, so the connect/teardown cost is paid once per connection.
+
+    max_size: the maximum number of open connections per backend; callers wait
+              up to wait_timeout seconds for a free slot once it is reached
+    connect_timeout / read_timeout: socket timeouts for connecting and for each read
+    max_idle: idle connections older than this (in seconds) are closed instead of reused
+
+    Idle connections are also checked before reuse; a connection the backend has
+    already closed is evicted, and a reused connection that fails mid-request is
+    replaced by a fresh one and the request retried once (counted as a reconnect).
+    Only a request that was not completely sent, or one of SAFE_METHODS, is retried,
+    since the backend may have run a write whose response was lost.
+    """
+    def __init__(self, host='127.0.0.1', max_size=32, connect_timeout=1.0,
+                 read_timeout=5.0, wait_timeout=5.0, max_idle=30.0):
+        self.host = host
+        self.max_size = max_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.wait_timeout = wait_timeout
+        self.max_idle = max_idle
+        self._pools = dict()
+        self._lock = threading.Lock()
+
+    def _node_pool(self, node):
+        pool = self._pools.get(node)
+        if pool is None:
+            with self._lock:
+                pool = self._pools.setdefault(node, _NodePool(self.max_size))
+        return pool
+
+    def _connect(self, node, read_timeout):
+        conn = http.client.HTTPConnection(self.host, int(node), timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(read_timeout)
+        return conn
+
+    # an idle connection is unusable if the backend closed it (the socket becomes
+    # readable with EOF) or sent something unexpected while it was idle
+    @staticmethod
+    def _is_alive(conn):
+        if conn.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    # take a healthy idle connection if there is one, evicting stale ones on the way
+    def _checkout_idle(self, pool):
+        now = time.monotonic()
+        with pool.lock:
+            while pool.idle:
+                conn, last_used = pool.idle.pop()
+                if now - last_used <= self.max_idle and self._is_alive(conn):
+                    pool.stats['hits'] += 1
+                    return conn
+                pool.stats['evictions'] += 1
+                conn.close()
+            pool.stats['misses'] += 1
+        return None
+
+    def _release(self, pool, conn, reusable):
+        with pool.lock:
+            pool.active.discard(conn)
+            pool.aborted.discard(conn)
+            if reusable:
+                pool.idle.append((conn, time.monotonic()))
+        if not reusable:
+            conn.close()
+        pool.slots.release()
+
+    def _acquire_slot(self, pool):
+        if pool.slots.acquire(blocking=False):
+            return
+        with pool.lock:
+            pool.stats['waits'] += 1
+        if not pool.slots.acquire(timeout=self.wait_timeout):
+            with pool.lock:
+                pool.stats['wait_timeouts'] += 1
+            raise ConnectionPoolError("timed out waiting for a free connection")
+
+    @staticmethod
+    def _send(conn, method, url, body, headers):
+        conn.request(method, url, body=body, headers=headers)
+        response = conn.getresponse()
+        return response, response.read()
+
+    @staticmethod
+    def _prepare(path, params, json_body):
+        url = path
+        if params:
+            url += '?' + urllib.parse.urlencode(params)
+        body = None
+        headers = {}
+        if json_body is not None:
+            body = json.dumps(json_body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        return url, body, headers
+
+    def request(self, node, method, path, params=None, json_body=None, timeout=None):
+        """
+        Send one request to the backend listening on port node and return a
+        BackendResponse. Raises ConnectionPoolError if the backend is unreachable.
+        """
+        node = str(node)
+        pool = self._node_pool(node)
+        read_timeout = timeout if timeout is not None else self.read_timeout
+        url, body, headers = self._prepare(path, params, json_body)
+
+        self._acquire_slot(pool)
+        with pool.lock:
+            pool.stats['requests'] += 1
+        conn = self._checkout_idle(pool)
+        reused = conn is not None
+        try:
+            if conn is None:
+                conn = self._connect(node, read_timeout)
+            else:
+                conn.sock.settimeout(read_timeout)
+            with pool.lock:
+                pool.active.add(conn)
+            sent = False
+            try:
+                conn.request(method, url, body=body, headers=headers)
+                sent = True
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError,
+                    BrokenPipeError, http.client.BadStatusLine):
+                # a kept-alive connection can be closed by the backend at any time;
+                # only retry when the failed connection was a reused one
+                with pool.lock:
+                    pool.active.discard(conn)
+                    if not reused or conn in pool.aborted or (sent and method not in SAFE_METHODS):
+                        raise
+                    pool.stats['reconnects'] += 1
+                conn.close()
+                conn = self._connect(node, read_timeout)
+                with pool.lock:
+                    pool.active.add(conn)
+                response, data = self._send(conn, method, url, body, headers)
+        except (OSError, http.client.HTTPException) as e:
+            with pool.lock:
+                pool.stats['errors'] += 1
+                pool.active.discard(conn)
+                pool.aborted.discard(conn)
+            if conn is not None:
+                conn.close()
+            pool.slots.release()
+            raise ConnectionPoolError(f"request to backend {node} failed: {e}") from e
+
+        self._release(pool, conn, not response.will_close and conn not in pool.aborted)
+        return BackendResponse(response.status, data)
+
+    def stream_lines(self, node, method, path, params=None, json_body=None, timeout=None):
+        """
+        Send one request to the backend on a dedicated connection and yield the lines of
+        the response body as they arrive, so long streamed responses neither have to fit
+        in memory nor hold one of the backend's pooled connections.
+        Raises ConnectionPoolError if the backend is unreachable or does not answer 200.
+        """
+        read_timeout = timeout if timeout is not None else self.read_timeout
+        url, body, headers = self._prepare(path, params, json_body)
+        conn = None
+        try:
+            conn = self._connect(node, read_timeout)
+            conn.request(method, url, body=body, headers=headers)
+            response = conn.getresponse()
+            if response.status != 200:
+                raise ConnectionPoolError(f"backend {node} answered {response.status}")
+            yield from response
+        except (OSError, http.client.HTTPException) as e:
+            raise ConnectionPoolError(f"streaming from backend {node} failed: {e}") from e
+        finally:
+            if conn is not None:
+                conn.close()
+
+    # fail the requests in flight to a backend right away instead of at their read timeout,
+    # so the threads waiting on a hung backend are freed (they raise ConnectionPoolError)
+    def abort(self, node):
+        pool = self._pools.get(str(node))
+        if pool is None:
+            return
+        with pool.lock:
+            for conn in pool.active:
+                if conn.sock is not None and conn not in pool.aborted:
+                    pool.aborted.add(conn)
+                    pool.stats['aborts'] += 1
+                    try:
+                        conn.sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+
+    # close the idle connections of one backend (or of all backends)
+    def close(self, node=None):
+        nodes = [str(node)] if node is not None else list(self._pools)
+        for name in nodes:
+            pool = self._pools.get(name)
+            if pool is None:
+                continue
+            with pool.lock:
+                while pool.idle:
+                    conn, _ = pool.idle.pop()
+                    conn.close()
+
+    def stats(self):
+        result = dict()
+        for node, pool in list(self._pools.items()):
+            with pool.lock:
+                node_stats = dict(pool.stats)
+                node_stats['idle'] = len(pool.idle)
+            result[node] = node_stats
+        return result
@@ -0,0 +1,120 @@
+import threading
+import time
+
+
+class TimerWheel:
+    """
+    The expiry times of the keys of a MyKVStore, in a hierarchical timer wheel, so the keys
+    that are due can be found without looking at the ones that are not. Time is cut into
+    ticks of tick seconds. Level 0 has one slot per tick for the next 2**bits ticks, and
+    every slot of level n + 1 holds as many ticks as all of level n. A key goes into the
+    lowest level whose slots reach its deadline. When the clock enters a new slot of a
+    level, the keys of that slot are spread over the lower levels (cascaded), and when it
+    leaves a slot of level 0, the keys of that slot are due. Deadlines beyond the last
+    level wait in an overflow slot. Adding, moving and removing a key costs O(1), and a
+    tick only touches the keys of the slots it passes.
+
+    self.deadlines: {key: expiry time (seconds since the epoch)}, read without the lock
+    self.current: the tick the clock is at; the ticks before it have been processed
+    self.ready: {key: deadline} of the keys that are due but were not taken by due() yet
+    """
+    def __init__(self, tick=0.1, bits=6, levels=4):
+        self.tick = tick
+        self.bits = bits
+        self.levels = levels
+        self.mask = (1 << bits) - 1
+        self.slots = [[dict() for _ in range(1 << bits)] for _ in range(levels)]
+        self.overflow = dict()
+        self.ready = dict()
+        self.deadlines = dict()
+        self._slot_of = dict()
+        self.current = int(time.time() / tick)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    # the slot of a deadline: the lowest level whose current rotation holds its tick
+    def _slot(self, deadline):
+        target = int(deadline / self.tick)
+        if target < self.current:
+            return self.ready
+        for level in range(self.levels):
+            shift = self.bits * (level + 1)
+            if target >> shift == self.current >> shift:
+                return self.slots[level][(target >> (shift - self.bits)) & self.mask]
+        return self.overflow
+
+    def _place(self, key, deadline):
+        slot = self._slot(deadline)
+        slot[key] = deadline
+        self._slot_of[key] = slot
+
+    def schedule(self, key, deadline):
+        with self.lock:
+            self._remove(key)
+            self.deadlines[key] = deadline
+            self._place(key, deadline)
+
+    def _remove(self, key):
+        slot = self._slot_of.pop(key, None)
+        if slot is not None:
+            del slot[key]
+
+    def cancel(self, key):
+        with self.lock:
+            if self.deadlines.pop(key, None) is not None:
+                self._remove(key)
+
+    # whether key has a deadline that has passed
+    def expired(self, key, now):
+        deadline = self.deadlines.get(key)
+        return deadline is not None and deadline <= now
+
+    def _cascade(self, slot):
+        entries = list(slot.items())
+        slot.clear()
+        for key, deadline in entries:
+            self._place(key, deadline)
+
+    def _advance(self, target):
+        while self.current < target:
+            due = self.slots[0][self.current & self.mask]
+            for key in due:
+                self._slot_of[key] = self.ready
+            self.ready.update(due)
+            due.clear()
+            self.current += 1
+            # entering a new slot of a level spreads its keys over the levels below,
+            # the highest level first so its keys can fall through all of them
+            for level in range(self.levels, 0, -1):
+                shift = self.bits * level
+                if self.current & ((1 << shift) - 1) == 0:
+                    if level == self.levels:
+                        self._cascade(self.overflow)
+                    else:
+                        self._cascade(self.slots[level][(self.current >> shift) & self.mask])
+
+    def due(self, now, limit):
+        """
+        Up to limit keys whose deadline has passed by now. The keys stay scheduled until they
+        are cancelled, so a key that was given a new deadline in the meantime can be told
+        apart; the ones over the limit are returned by the next calls.
+        """
+        with self.lock:
+            self._advance(int(now / self.tick))
+            keys = []
+            for key, deadline in self.ready.items():
+                if len(keys) == limit:
+                    break
+                if deadline <= now:
+                    keys.append(key)
+            for key in keys:
+                del self.ready[key]
+                del self._slot_of[key]
+            return keys
+
+    # a copy of the deadlines, for a snapshot
+    def copy(self):
+        with self.lock:
+            return dict(self.deadlines)
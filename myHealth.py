@@ -0,0 +1,217 @@
+import threading
+import time
+
+from myConnectionPool import ConnectionPool, ConnectionPoolError
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """
+    The circuit breaker of one kv store. It is closed while the kv store works and opens
+    after failure_threshold consecutive failed requests or pings, which takes the kv store
+    out of the routing. Once it has been open for reset_timeout seconds it is half open:
+    the next ping is a trial that closes it again if it succeeds and reopens it otherwise.
+
+    self.failures: consecutive failures while closed
+    self.opened_at: time.monotonic() of the last opening
+    self.trips: how often the breaker opened
+    """
+    def __init__(self, failure_threshold=3, reset_timeout=5.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+
+    # the outcome of a request or ping while closed; True if it opened the breaker
+    def record(self, ok):
+        if self.state != CLOSED:
+            return False
+        if ok:
+            self.failures = 0
+            return False
+        self.failures += 1
+        if self.failures < self.failure_threshold:
+            return False
+        self.open()
+        return True
+
+    def open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.trips += 1
+
+    def close(self):
+        self.state = CLOSED
+        self.failures = 0
+
+    # whether a trial is due, in which case the breaker is half open until it is decided
+    def try_half_open(self):
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+            return True
+        return False
+
+
+class HealthMonitor:
+    """
+    Active and passive health checking of the kv stores of a distributor. Every forwarded
+    request reports its outcome (record), and a thread pings each kv store on the ring
+    every interval seconds with a timeout of its own, so a hung kv store is noticed without
+    waiting for the read timeout of client requests. The kv stores whose CircuitBreaker is
+    not closed are down(): the distributor leaves them out of the preference lists, the next
+    nodes on the ring take their place, and the keys written meanwhile are hinted for them.
+    When a trial ping succeeds, on_recover(node, keys) hands the hinted keys off to the kv
+    store, and only then is it routed to again (reinstate).
+
+    self.nodes: a function returning the nodes on the ring
+    self.breakers: {node: CircuitBreaker}, created on first use
+    self.hints: {node: keys written to other kv stores while node was down}, at most
+                max_hints per node; self.lost_hints counts the keys that did not fit
+    self.on_open: called with the kv store whose breaker opened, to fail the requests still
+                  waiting on it
+    self.on_recover: set by the distributor, returns False if the hand-off failed, which
+                     keeps the kv store out of the routing until the next trial
+    self.pool: the ConnectionPool of the pings
+    """
+    def __init__(self, nodes, interval=0.5, timeout=0.5, failure_threshold=3, reset_timeout=5.0,
+                 max_hints=100000, host='127.0.0.1'):
+        self.nodes = nodes
+        self.interval = interval
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_hints = max_hints
+        self.breakers = dict()
+        self.hints = dict()
+        self.lost_hints = 0
+        self.on_open = None
+        self.on_recover = None
+        self.pool = ConnectionPool(host=host, max_size=1, connect_timeout=timeout, read_timeout=timeout,
+                                   wait_timeout=timeout)
+        self.lock = threading.Lock()
+        self._down = frozenset()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _breaker(self, node):
+        breaker = self.breakers.get(node)
+        if breaker is None:
+            breaker = self.breakers[node] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+        return breaker
+
+    def _update_down(self):
+        self._down = frozenset(node for node, breaker in self.breakers.items() if breaker.state != CLOSED)
+
+    # the kv stores the distributor routes around, read without the lock on every request
+    def down(self):
+        return self._down
+
+    def record(self, node, ok):
+        breaker = self.breakers.get(node)
+        # the common case: a healthy kv store answered
+        if ok and (breaker is None or breaker.failures == 0):
+            return
+        with self.lock:
+            opened = self._breaker(node).record(ok)
+            if opened:
+                self._update_down()
+        if opened:
+            print(f"Server at port {node} failed {self.failure_threshold} times in a row, routing around it")
+            if self.on_open is not None:
+                self.on_open(node)
+
+    # remember keys written to other kv stores in place of nodes
+    def hint(self, nodes, keys):
+        with self.lock:
+            for node in nodes:
+                hinted = self.hints.setdefault(node, set())
+                for key in keys:
+                    if len(hinted) < self.max_hints or key in hinted:
+                        hinted.add(key)
+                    else:
+                        self.lost_hints += 1
+
+    def reinstate(self, node):
+        with self.lock:
+            breaker = self._breaker(node)
+            if breaker.state != CLOSED:
+                breaker.close()
+                self._update_down()
+                print(f"Server at port {node} is healthy again, routing to it")
+
+    def _ping(self, node):
+        try:
+            return self.pool.request(node, 'GET', '/ping').status_code == 200
+        except ConnectionPoolError:
+            return False
+
+    # ping a kv store if it is closed or due for a trial, and hand off its hinted keys when
+    # it is back (or when hints arrived after it was reinstated)
+    def check(self, node):
+        with self.lock:
+            breaker = self._breaker(node)
+            trial = breaker.try_half_open()
+            if breaker.state == OPEN:
+                return
+            if trial:
+                self._update_down()
+        ok = self._ping(node)
+        if not trial:
+            self.record(node, ok)
+            if not ok or not self.hints.get(node):
+                return
+        elif not ok:
+            with self.lock:
+                breaker.open()
+            return
+        with self.lock:
+            keys = self.hints.pop(node, set())
+        if not keys or self.on_recover is None or self.on_recover(node, keys):
+            self.reinstate(node)
+            return
+        self.hint([node], keys)
+        with self.lock:
+            if breaker.state == HALF_OPEN:
+                breaker.open()
+
+    # forget the kv stores that left the ring
+    def _prune(self, nodes):
+        with self.lock:
+            for node in set(self.breakers).difference(nodes):
+                del self.breakers[node]
+                self.hints.pop(node, None)
+            self._update_down()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            nodes = list(self.nodes())
+            self._prune(nodes)
+            for node in nodes:
+                try:
+                    self.check(node)
+                except Exception as e:
+                    print(f"Health check of server at port {node} failed: {e}")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def status(self):
+        with self.lock:
+            nodes = {
+                node: {
+                    'state': breaker.state,
+                    'failures': breaker.failures,
+                    'trips': breaker.trips,
+                    'hinted_keys': len(self.hints.get(node, ())),
+                }
+                for node, breaker in self.breakers.items()
+            }
+            return {'enabled': True, 'nodes': nodes, 'lost_hints': self.lost_hints}
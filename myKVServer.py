@@ -1,181 +1,880 @@
 from flask import Flask, g, request, jsonify, Response
-from threading import Thread
+from waitress import serve
+from werkzeug.serving import make_server
+from threading import Event, Thread, Lock
 import json
 import time
 import logging
-import requests
 import hashlib
 import bisect
+import functools
+import math
+import struct
 from multiprocessing import Process
 import os
 import signal
+import argparse
+import collections
+import heapq
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from myConnectionPool import ConnectionPool, ConnectionPoolError
+import myPersistence
+from myPersistence import AppendOnlyLog, LayeredStore
+from myRebalancer import Rebalancer, RangeSet
+from myCache import HotKeyCache, POLICIES
+from myStorage import ENGINES, StripedLock, create_engine
+from myMetrics import CONTENT_TYPE, DURATION_BUCKETS, Registry, RequestMetrics
+from myWorkers import SharedRingState, reuse_port_socket
+from myHealth import HealthMonitor
+import myBinaryProtocol
+from myBinaryProtocol import (BinaryFrontend, BinaryServer, HTTP_STATUS, OPCODE_NAMES, STATUS_ERROR, STATUS_NOT_FOUND,
+                              STATUS_OK)
+
+# md5 only places keys on the ring, it is not used for security
+_md5 = functools.partial(hashlib.md5, usedforsecurity=False)
+_unpack_prefix = struct.Struct('>Q').unpack_from
+HASH_SPACE = 1 << 128
+
+
+# the position of a key on the ring, shared by the ring and by the kv stores exporting
+# the keys of moved hash ranges
+def ring_hash(key):
+    # k = 128
+    return int.from_bytes(_md5(key.encode('utf-8')).digest(), 'big')
+
+
+# count and time every request of a Flask app for /metrics. The route label is the URL
+# rule rather than the URL, so keys never become label values
+def instrument(app, request_metrics):
+    @app.before_request
+    def start_timer():
+        g.started = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        started = g.get('started', time.perf_counter())
+        request_metrics.observe(route, request.method, response.status_code, time.perf_counter() - started)
+        return response
 
 
 class HashRing:
     """
     A hash ring class that utilizes hashlib and bisect library 
-    (mp5 hash value, which create a key space of 2 ^ 126).
-    The initializor takes optional parameters, a list of physical nodes 
-    and a number of virtual nodes for each physical node.  
+    (mp5 hash value, which create a key space of 2 ^ 128).
+    The initializor takes optional parameters, a list of physical nodes, 
+    a number of virtual nodes for each physical node, the size of the lookup cache and
+    the weights of the nodes.
     
     Each physical node is repersented by a server's port number.
-    self.vnodes tracks the number virtual nodes each physical node has.
-    self.ring maps the vnodes to its corresponding physical node.
-    self._sorted_keys contains all keys from self.ring in a ascending order to
-    achieve the formation of a ring.  
+    self.vnodes tracks the number virtual nodes a physical node of weight 1 has.
+    self.weights holds the relative capacity of the nodes (1 if missing): a node gets
+    round(vnodes * weight) virtual nodes, and so a proportional share of the keys.
+    self.ring maps the (full 128 bit) vnode hashes to their corresponding physical node.
+    self._table holds the lookup tables, built with a single sort and replaced (never
+    modified in place) on every topology change:
+        points: the top 64 bits of every vnode hash in ascending order
+        owners: the physical node of each entry of points
+        full:   the full 128 bit hashes in the same order, only used to break ties 
+                between equal 64 bit prefixes, which keeps lookups identical to a ring
+                of full md5 values
+    self._lookup is an LRU cache of key -> node lookups that is replaced whenever the
+    topology changes, and self._lookup_preference the same for preference lists.
+    self._successors caches, per replica count n, the preference list of every vnode:
+    the next n distinct physical nodes clockwise from it.
     """
-    def __init__(self, nodes=None, vnodes=100):
+    def __init__(self, nodes=None, vnodes=100, cache_size=65536, weights=None):
         self.vnodes = vnodes
+        self.weights = dict(weights or {})
         self.ring = dict()
-        self._sorted_keys = []
+        self.cache_size = cache_size
+        self._table = ([], [], [])
+        self._lookup = None
+        self._lookup_preference = None
+        self._successors = dict()
         
-        self.nodes = nodes or []
-        for node in self.nodes:
-            self.add_node(node)
+        self.nodes = []
+        for node in nodes or []:
+            if node not in self.nodes:
+                self.nodes.append(node)
+                self.ring.update(self._vnode_hashes(node))
+        self._rebuild(sorted(self.ring))
     
     def _hash(self, key):
-        hashValue = hashlib.md5()
-        # k = 128
-        hashValue.update(key.encode('utf-8'))
-        return int(hashValue.hexdigest(), 16)
-    
-    # add a new node to nodes and generate its virtual nodes with the loop
-    def add_node(self, node):
-        if node not in self.nodes:
-            self.nodes.append(nodes)
-            
-        for i in range(self.vnodes):
-            key = self._hash(f"{node}_{i}")
-            self.ring[key] = node
-            bisect.insort(self._sorted_keys, key)
+        return ring_hash(key)
+    
+    # the number of virtual nodes of a node, proportional to its weight
+    def vnode_count(self, node):
+        return max(1, round(self.vnodes * self.weights.get(node, 1)))
+    
+    # the hashes of the virtual nodes start ... end - 1 of a node, by default all of them
+    def _vnode_hashes(self, node, start=0, end=None):
+        end = self.vnode_count(node) if end is None else end
+        return {self._hash(f"{node}_{i}"): node for i in range(start, end)}
+    
+    # swap in new lookup tables, then a new cache, so that no lookup made against the old
+    # tables can end up in the new cache
+    def _swap(self, points, owners, full):
+        self._table = (points, owners, full)
+        self._successors = dict()
+        self._lookup = functools.lru_cache(maxsize=self.cache_size)(self._find_node)
+        self._lookup_preference = functools.lru_cache(maxsize=self.cache_size)(self._find_preference)
+    
+    # bulk construction: one sort of all vnode hashes
+    def _rebuild(self, sorted_keys):
+        self._swap([key >> 64 for key in sorted_keys], list(map(self.ring.__getitem__, sorted_keys)), sorted_keys)
     
-    # remove a node from nodes and its corresponding virtual nodes from sorted key list
+    # add a new node to nodes and generate its virtual nodes; adding a node that is already
+    # on the ring changes its weight if one is given
+    def add_node(self, node, weight=None):
+        if node in self.nodes:
+            if weight is not None:
+                self.set_weight(node, weight)
+            return
+        if weight is not None:
+            self.weights[node] = weight
+        self.nodes.append(node)
+        self._insert_vnodes(node, self._vnode_hashes(node))
+    
+    # change the weight of a node by adding or removing only its last virtual nodes, so
+    # only the keys of those move
+    def set_weight(self, node, weight):
+        old_count = self.vnode_count(node)
+        self.weights[node] = weight
+        new_count = self.vnode_count(node)
+        if new_count > old_count:
+            self._insert_vnodes(node, self._vnode_hashes(node, old_count, new_count))
+        elif new_count < old_count:
+            self._remove_vnodes(node, self._vnode_hashes(node, new_count, old_count))
+    
+    # remove a node from nodes and its corresponding virtual nodes
     def remove_node(self, node):
-        # try/except block is used for testing
-        try:
-            for i in range(self.vnodes):
-                key = self._hash(f"{node}_{i}")
-            
-                if key in self.ring:
-                    self.ring.pop(key)
-                    
-                index = bisect.bisect_left(self._sorted_keys, key)
-                
-                if index < len(self._sorted_keys):
-                    if self._sorted_keys[index] == key:
-                        del self._sorted_keys[index]
+        if node in self.nodes:
+            self.nodes.remove(node)
+        self._remove_vnodes(node, self._vnode_hashes(node))
+        self.weights.pop(node, None)
+    
+    # Each new vnode is placed with a binary search, and the new tables are assembled from
+    # slices of the old ones, which are left untouched for lookups running concurrently
+    def _insert_vnodes(self, node, hashes):
+        points, owners, full = self._table
+        new_keys = sorted(key for key in hashes if key not in self.ring)
+        new_points, new_owners, new_full = [], [], []
+        start = 0
+        for key in new_keys:
+            self.ring[key] = node
+            index = bisect.bisect(full, key, start)
+            new_points += points[start:index]
+            new_owners += owners[start:index]
+            new_full += full[start:index]
+            new_points.append(key >> 64)
+            new_owners.append(node)
+            new_full.append(key)
+            start = index
+        self._swap(new_points + points[start:], new_owners + owners[start:], new_full + full[start:])
+    
+    # each removed vnode is found with a binary search and cut out of the new tables
+    def _remove_vnodes(self, node, hashes):
+        points, owners, full = self._table
+        old_keys = sorted(key for key in hashes if self.ring.get(key) == node)
+        new_points, new_owners, new_full = [], [], []
+        start = 0
+        for key in old_keys:
+            self.ring.pop(key)
+            index = bisect.bisect_left(full, key, start)
+            new_points += points[start:index]
+            new_owners += owners[start:index]
+            new_full += full[start:index]
+            start = index + 1
+        self._swap(new_points + points[start:], new_owners + owners[start:], new_full + full[start:])
+    
+    # a copy of the ring to compare against after a topology change; the lookup tables
+    # are never modified in place, so they are shared
+    def copy(self):
+        ring = HashRing(vnodes=self.vnodes, cache_size=self.cache_size, weights=self.weights)
+        ring.ring = dict(self.ring)
+        ring.nodes = list(self.nodes)
+        ring._swap(*self._table)
+        return ring
+    
+    # the preference lists of all vnodes of table for n replicas, built once per topology
+    def _successor_table(self, table, n):
+        cached = self._successors.get(n)
+        if cached is not None and cached[0] is table:
+            return cached[1]
+        owners = table[1]
+        size = len(owners)
+        n = min(n, len(set(owners)))
+        successors = []
+        for index in range(size):
+            nodes = []
+            step = index
+            while len(nodes) < n:
+                if owners[step] not in nodes:
+                    nodes.append(owners[step])
+                step = step + 1 if step + 1 < size else 0
+            successors.append(tuple(nodes))
+        self._successors[n] = (table, successors)
+        return successors
+    
+    # the index in the tables of the vnode owning a position of the hash space
+    @staticmethod
+    def _index_at(table, hash_val):
+        index = bisect.bisect(table[2], hash_val)
+        return index if index < len(table[2]) else 0
+    
+    # the node owning a position of the hash space
+    def node_at(self, hash_val):
+        table = self._table
+        if not table[1]:
+            return None
+        return table[1][self._index_at(table, hash_val)]
+    
+    # the n replicas of a position of the hash space
+    def preference_at(self, hash_val, n):
+        table = self._table
+        if not table[1]:
+            return ()
+        return self._successor_table(table, n)[self._index_at(table, hash_val)]
+    
+    @staticmethod
+    def changed_ranges(old, new, replicas=1):
+        """
+        The parts of the hash space whose replicas differ between the rings old and new, as a
+        list of (start, end, source, target, delete_source) with start inclusive and end
+        exclusive: the keys of the range have to be copied from source to target, and removed
+        from source if it no longer holds a replica of them.
+        A key belongs to the first vnode with a larger hash, so its replicas are constant
+        between two consecutive vnode hashes of the union of both rings and only those arcs
+        are checked. Adding or removing one node changes at most one replica per arc, so a
+        new replica takes over the data of the dropped one, or is copied from the primary.
+        """
+        bounds = sorted(set(old._table[2]).union(new._table[2]))
+        if not bounds:
+            return []
+        arcs = list(zip(bounds, bounds[1:]))
+        arcs += [(bounds[-1], HASH_SPACE), (0, bounds[0])]
+        ranges = []
+        last = dict()
+        for start, end in arcs:
+            if start == end:
+                continue
+            old_nodes, new_nodes = old.preference_at(start, replicas), new.preference_at(start, replicas)
+            if not old_nodes or not new_nodes or set(old_nodes) == set(new_nodes):
+                continue
+            dropped = [node for node in old_nodes if node not in new_nodes]
+            for target in new_nodes:
+                if target in old_nodes:
+                    continue
+                move = (dropped.pop(0), target, True) if dropped else (old_nodes[0], target, False)
+                # merge neighbouring arcs with the same move
+                index = last.get(move)
+                if index is not None and ranges[index][1] == start:
+                    ranges[index] = (ranges[index][0], end) + move
                 else:
-                    del self._sorted_keys[0]
-        except Exception as e:
-            print(f"An error occurred while removing the node {node}: {e}")
-        
+                    last[move] = len(ranges)
+                    ranges.append((start, end) + move)
+        return ranges
+    
+    def _find_preference(self, key, n):
+        table = self._table
+        if not table[1]:
+            return ()
+        return self._successor_table(table, n)[self._index_at(table, ring_hash(key))]
+    
+    def _find_node(self, key):
+        points, owners, full = self._table
+        if not owners:
+            return None
+        digest = _md5(key.encode('utf-8')).digest()
+        hash_val = _unpack_prefix(digest)[0]
+        index = bisect.bisect(points, hash_val)
+        # equal 64 bit prefixes are ordered by the full hash
+        if index and points[index - 1] == hash_val:
+            index = bisect.bisect(full, int.from_bytes(digest, 'big'))
+        return owners[index if index < len(owners) else 0]
+    
     # map a key on the ring and get the closest server node to the right (higher hash value)
     def get_node(self, key):
-        if not self.ring:
-            return None
-        hash_val = self._hash(key)
-        index = bisect.bisect(self._sorted_keys, hash_val)
-        index = index if index < len(self.ring) else 0
-        return self.ring[self._sorted_keys[index]]
+        return self._lookup(key)
+    
+    # the preference list of a key: the n distinct physical nodes that hold its replicas,
+    # starting with the node get_node returns (fewer if the ring has fewer nodes)
+    def get_preference_list(self, key, n):
+        if n == 1:
+            node = self._lookup(key)
+            return (node,) if node is not None else ()
+        return self._lookup_preference(key, n)
+    
+    # batch version of get_preference_list
+    def get_preference_lists(self, keys, n):
+        if n == 1:
+            return [(node,) for node in self.get_nodes(keys)]
+        table = self._table
+        if not table[1]:
+            return [()] * len(keys)
+        successors = self._successor_table(table, n)
+        index_at = self._index_at
+        return [successors[index_at(table, ring_hash(key))] for key in keys]
+    
+    # batch version of get_node for routing many keys at once: hashes and bisects the keys
+    # in one loop against a single view of the tables, bypassing the cache
+    def get_nodes(self, keys):
+        points, owners, full = self._table
+        if not owners:
+            return [None] * len(keys)
+        md5 = _md5
+        unpack_prefix = _unpack_prefix
+        bisect_right = bisect.bisect
+        size = len(owners)
+        result = []
+        append = result.append
+        for key in keys:
+            digest = md5(key.encode('utf-8')).digest()
+            hash_val = unpack_prefix(digest)[0]
+            index = bisect_right(points, hash_val)
+            if index and points[index - 1] == hash_val:
+                index = bisect_right(full, int.from_bytes(digest, 'big'))
+            append(owners[index if index < size else 0])
+        return result
+
+
+class LoadTracker:
+    """
+    Consistent hashing with bounded loads: the distributor counts its in-flight requests
+    per kv store, and a kv store is full once it has ceil((1 + epsilon) * its share) of
+    them, its share being the average load scaled by its weight on the ring, counting the
+    request being routed. A read then skips the full replicas
+    of its preference list for the next ones, so a hot key spreads over its replicas
+    instead of queueing on the first of them. Writes still go to all replicas, and keys are
+    never routed outside their preference list, where the kv stores do not hold them.
+    
+    self.epsilon: how far above the average load a kv store may go
+    self.inflight: the number of requests in flight per kv store
+    self.spills: reads that skipped a full replica
+    """
+    def __init__(self, epsilon=0.25):
+        self.epsilon = epsilon
+        self.inflight = dict()
+        self.total = 0
+        self.spills = 0
+        self.lock = Lock()
+    
+    def begin(self, node):
+        with self.lock:
+            self.inflight[node] = self.inflight.get(node, 0) + 1
+            self.total += 1
+    
+    def end(self, node):
+        with self.lock:
+            self.inflight[node] -= 1
+            self.total -= 1
+    
+    # the number of in-flight requests that makes a kv store of the ring full
+    def bound(self, node, ring):
+        total_weight = sum(ring.weights.get(other, 1) for other in ring.nodes) or 1
+        return math.ceil((1 + self.epsilon) * (self.total + 1) * ring.weights.get(node, 1) / total_weight)
+    
+    # the first count candidates, in preference order, that are not full, topped up with the
+    # least loaded full ones when too few are left
+    def choose(self, candidates, count, ring):
+        inflight = self.inflight
+        chosen = [node for node in candidates if inflight.get(node, 0) < self.bound(node, ring)][:count]
+        if len(chosen) < count:
+            full = sorted((node for node in candidates if node not in chosen), key=lambda node: inflight.get(node, 0))
+            chosen += full[:count - len(chosen)]
+        if chosen != candidates[:count]:
+            with self.lock:
+                self.spills += 1
+        return chosen
+
+
+# the largest page of a /scan
+SCAN_LIMIT = 1000
+
+
+# the JSON body of a batch route, or {} if it is missing or not an object
+def json_object(body):
+    return body if isinstance(body, dict) else {}
+
+
+# whether the items of an /mput map strings to strings, checked before any of them is stored
+def valid_items(items):
+    return isinstance(items, dict) and all(isinstance(key, str) and isinstance(value, str)
+                                           for key, value in items.items())
+
+
+# whether the keys of an /mget or /mdel are a list of strings
+def valid_keys(keys):
+    return isinstance(keys, list) and all(isinstance(key, str) for key in keys)
+
+
+# the prefix, start and limit of a /scan request; raises ValueError for a bad limit
+def scan_arguments(args):
+    limit = int(args.get('limit', 100))
+    if not 0 < limit <= SCAN_LIMIT:
+        raise ValueError(f"limit must be between 1 and {SCAN_LIMIT}")
+    return args.get('prefix', ''), args.get('start', ''), limit
+
+
+# the ttl of a /put or /mput in seconds, or None without one; raises ValueError unless it is
+# a positive number
+def ttl_argument(value):
+    if value is None:
+        return None
+    ttl = float(value)
+    if not 0 < ttl < float('inf'):
+        raise ValueError(f"ttl must be a positive number of seconds, not {value}")
+    return ttl
+
+
+# the expiry times of an /mput as {key: time}, or None without them; raises ValueError unless
+# every time is a finite number, since the times are logged before they are applied
+def expires_argument(value):
+    if value is None:
+        return None
+    expires = {key: float(expires_at) for key, expires_at in value.items()}
+    if not all(math.isfinite(expires_at) for expires_at in expires.values()):
+        raise ValueError(f"expiry times must be finite numbers, not {value}")
+    return expires
+
+
+class ScanMerge:
+    """
+    A distributor /scan: merges the sorted /scan pages of every kv store into one page of
+    limit distinct keys, holding at most one page per kv store. A key found on several
+    replicas is taken from the first of them in its preference list (rank), and the keys
+    found on kv stores that hold no replica of them (accept), like leftovers of a move, are
+    skipped. The distributor fetches the pages: wanted() are the (node, start) pages the
+    merge needs before it can go on, which are handed in with add_page() or add_error(),
+    and merge() goes on until it needs more pages or the page is done.
+
+    self.cursors: {node: (the page items not merged yet, the start of its next page)}
+    self.items / self.next: the page being built, and the key the next page starts at
+    self.errors: {node: why its page could not be fetched}
+    """
+    def __init__(self, nodes, prefix, start, limit, accept, rank):
+        self.prefix = prefix
+        self.limit = limit
+        self.page_size = min(limit + 1, SCAN_LIMIT)
+        self.accept = accept
+        self.rank = rank
+        self.cursors = dict()
+        self.heap = []
+        self.pending = {node: start for node in nodes}
+        self.items = []
+        self.next = None
+        self.errors = dict()
+        self.done = False
+        self._last = None
+
+    def wanted(self):
+        return dict(self.pending)
+
+    def add_page(self, node, items, next_start):
+        del self.pending[node]
+        self.cursors[node] = (collections.deque(items), next_start)
+        self._advance(node)
+
+    def add_error(self, node, error):
+        del self.pending[node]
+        self.errors[node] = error
+
+    # put the next accepted key of a kv store on the heap, or ask for its next page
+    def _advance(self, node):
+        items, next_start = self.cursors[node]
+        while items:
+            key, value = items.popleft()
+            if self.accept(node, key):
+                heapq.heappush(self.heap, (key, self.rank(node, key), node, value))
+                return
+        if next_start is not None:
+            self.pending[node] = next_start
+
+    def merge(self):
+        # the smallest key on the heap is only the next one once every kv store has a key on it
+        while not self.done and not self.pending:
+            if not self.heap:
+                self.done = True
+                break
+            key, _, node, value = heapq.heappop(self.heap)
+            self._advance(node)
+            if key == self._last:
+                continue
+            self._last = key
+            if len(self.items) == self.limit:
+                self.next = key
+                self.done = True
+                break
+            self.items.append((key, value))
 
 
 class MyKVStore:
     """
     A Key Value Store server class based on hwk1 code utilizing Flask.
-    Each MyKVStore instance has its local (dictionary) and disk (.json file) key-value store 
+    Each MyKVStore instance has its local (in-memory) and disk key-value store. On disk,
+    every change is appended to a write-ahead log (storage{port}.log.N segments) and the
+    log is periodically compacted into a binary snapshot (storage{port}.snap). At startup
+    the snapshot is memory-mapped rather than parsed, so the server can accept traffic
+    right away; reads are served from the mapping and hot keys are promoted into memory.
     
     self.app: an instance of Flask server
     self.serverName: the name of this KVStore server
-    self.storage: the name of its disk storage
+    self.storage: the name of its JSON storage from before snapshots, read if no snapshot exists
+    self.snapshot_path: the name of its disk snapshot
     self.port: the port number where the server is deploy at
-    self.server_kv_store: its local storage 
+    self.server_kv_store: its local storage, a LayeredStore over the mapped snapshot whose
+                          in-memory part is the storage engine named by engine: 'sharded'
+                          (lock-striped shards with copy-on-write snapshots), 'dict' or
+                          'compact' (bytes in an arena, configured by engine_options)
+    self.memory_pressure: set by a compact engine whose max_bytes is exceeded by changes that
+                          are not in the snapshot yet, which makes the store compact early
+    self.log: the AppendOnlyLog, with fsync_policy 'always', 'batched' or 'interval'
+    self.compact_bytes: the log size that triggers a compaction into a new snapshot
+    self.locks: per-key locks that make the log record the changes of each key in the order
+                they are applied; one stripe per engine shard
+    self.metrics: the Registry served by /metrics: request counts and latencies per route,
+                  the number of keys, the log size and the compaction durations
+    self.logger: logs a log_sample fraction of the requests at DEBUG level
+    self.binary_port: the port of the binary protocol (myBinaryProtocol.py), port + binary_offset,
+                      or None if binary_offset is 0
+    self.expire_batch: the most keys that expire_keys deletes per tick of the expiry wheel
+    self.expired: the number of keys deleted because their ttl ran out
     """
-    def __init__(self, serverName, storageName, port):
+    def __init__(self, serverName, storageName, port, fsync_policy='interval', compact_bytes=16 * 1024 * 1024,
+                 engine='sharded', log_sample=0.0, binary_offset=0, engine_options=None, expire_batch=1000):
         self.app = Flask(serverName)
         self.serverName = serverName
         self.storage = storageName
+        base = os.path.splitext(storageName)[0]
+        self.snapshot_path = base + '.snap'
         self.port = port
-        self.server_kv_store = {}
+        self.server_kv_store = LayeredStore(create_engine(engine, **(engine_options or {})))
+        self.memory_pressure = Event()
+        if hasattr(self.server_kv_store.memtable, 'on_pressure'):
+            self.server_kv_store.memtable.on_pressure = self.memory_pressure.set
+        self.log = AppendOnlyLog(base, fsync=fsync_policy)
+        self.compact_bytes = compact_bytes
+        self.locks = StripedLock(self.server_kv_store.memtable.shard_count)
+        self.logger = logging.getLogger(serverName)
+        self.metrics = Registry()
+        self.request_metrics = RequestMetrics(self.metrics, 'kv', self.logger, log_sample)
+        self.metrics.gauge('kv_keys', "Keys in the store", lambda: len(self.server_kv_store))
+        self.metrics.gauge('kv_log_bytes', "Size of the write-ahead log on disk", self.log.size)
+        self.compaction_duration = self.metrics.histogram('kv_compaction_duration_seconds',
+                                                          "Time to write a snapshot and drop the log it covers",
+                                                          buckets=DURATION_BUCKETS)
+        memtable = self.server_kv_store.memtable
+        if hasattr(memtable, 'memory_stats'):
+            self.metrics.gauge('kv_memtable_bytes', "Arena, table and index bytes of the in-memory entries",
+                               lambda: sum(memtable.memory_stats()[part]
+                                           for part in ('arena_bytes', 'table_bytes', 'index_bytes')))
+            self.metrics.gauge('kv_memtable_bytes_per_key', "Memory per in-memory entry, garbage included",
+                               lambda: memtable.memory_stats()['bytes_per_key'])
+            self.metrics.gauge('kv_memtable_compressed_values', "In-memory values stored compressed",
+                               lambda: memtable.compressed)
+            self.metrics.gauge('kv_memtable_evictions_total', "Snapshot values evicted from memory",
+                               lambda: memtable.evictions, kind='counter')
+        self.binary_port = int(port) + binary_offset if binary_offset else None
+        self.expire_batch = expire_batch
+        self.expired = 0
+        self.metrics.gauge('kv_expiring_keys', "Keys with a ttl", lambda: len(self.server_kv_store.expiry))
+        self.metrics.gauge('kv_expired_keys_total', "Keys deleted because their ttl ran out",
+                           lambda: self.expired, kind='counter')
         
         self.read_data_from_storage()
-        
-        # self.logger = logging.getLogger(serverName)
-        # logging.basicConfig(filename=f'{serverName}.log',
-        #             level=logging.DEBUG,
-        #             format='%(message)s')
     
-    # same I/O functions from Hwk1. Occationally saving data to disk in a seperate thread
+    # map the last snapshot (or load the JSON storage of older versions), then replay the
+    # log records written after it
     def read_data_from_storage(self):
-        try:
-            with open(self.storage, 'r') as file:
-                data = json.load(file)
-                print(f"reading kv_store from {self.storage}")
-                self.server_kv_store.update(data)
-        except Exception as e:
-            print(f"An error occurred while reading the file: {e}")
-            print(f"Creating loacl kv_store {self.storage}")
+        if os.path.exists(self.snapshot_path):
+            self.server_kv_store.open_snapshot(self.snapshot_path)
+            print(f"mapped {len(self.server_kv_store)} keys from {self.snapshot_path}")
+        else:
+            try:
+                with open(self.storage, 'r') as file:
+                    data = json.load(file)
+                    print(f"reading kv_store from {self.storage}")
+                    self.server_kv_store.update(data)
+            except Exception as e:
+                print(f"An error occurred while reading the file: {e}")
+                print(f"Creating loacl kv_store {self.snapshot_path}")
+        replayed = self.log.replay(self._apply_record)
+        if replayed:
+            print(f"replayed {replayed} log records into {self.serverName}")
+    
+    def _apply_record(self, op, key, value):
+        if op == myPersistence.OP_PUT:
+            self.server_kv_store[key] = value
+        elif op == myPersistence.OP_EXPIRE:
+            self.server_kv_store.set_expiry(key, float(value))
+        else:
+            self.server_kv_store.pop(key, None)
+    
+    # all changes go through these methods, which apply them and append them to the log.
+    # A value stored with an expiry time (seconds since the epoch) is deleted once it passes,
+    # one stored without keeps its key forever
+    def put(self, key, value, expires_at=None):
+        with self.locks.for_key(key):
+            self.log.append_put(key, value, expires_at)
+            self.server_kv_store.put(key, value, expires_at)
+    
+    # with only_missing, keys the store already holds keep their value; used for keys moved
+    # in by the rebalancer, which must not overwrite newer writes from clients. expires maps
+    # the keys that expire to their expiry times. Returns the number of values stored
+    def put_many(self, items, only_missing=False, expires=None):
+        with self.locks.for_keys(items):
+            if only_missing:
+                items = {key: value for key, value in items.items() if key not in self.server_kv_store}
+            expires = {key: expires[key] for key in items if key in expires} if expires else None
+            self.log.append_puts(items, expires)
+            for key, value in items.items():
+                self.server_kv_store.put(key, value, expires.get(key) if expires else None)
+        return len(items)
+    
+    # delete the keys whose expiry time has passed, except the ones written again since
+    def expire_many(self, keys, now):
+        with self.locks.for_keys(keys):
+            expired = [key for key in keys if self.server_kv_store.expiry.expired(key, now)]
+            for key in expired:
+                self.server_kv_store.pop(key, None)
+            self.log.append_deletes(expired)
+        self.expired += len(expired)
+        return expired
+    
+    def delete(self, key):
+        with self.locks.for_key(key):
+            if self.server_kv_store.pop(key, None) is None:
+                return False
+            self.log.append_delete(key)
+            return True
+    
+    def delete_many(self, keys):
+        deleted = []
+        missing = []
+        with self.locks.for_keys(keys):
+            for key in keys:
+                if self.server_kv_store.pop(key, None) is not None:
+                    deleted.append(key)
+                else:
+                    missing.append(key)
+            self.log.append_deletes(deleted)
+        return deleted, missing
+    
+    # Write a new snapshot and drop the log segments it covers. The log is rotated before
+    # the snapshot is taken, so every record of a closed segment is already in it, and
+    # changes made during the compaction go to the new segment.
+    def compact(self):
+        started = time.perf_counter()
+        closed = self.log.rotate()
+        self.server_kv_store.write_snapshot(self.snapshot_path)
+        self.log.remove_segments(closed)
+        # the JSON storage of older versions is now part of the snapshot
+        if os.path.exists(self.storage):
+            os.remove(self.storage)
+        self.compaction_duration.observe(time.perf_counter() - started)
+        print(f"Data saved to {self.snapshot_path}")
+    
+    # Delete the keys whose ttl ran out, at most expire_batch per tick of the expiry wheel so
+    # a burst of expiring keys does not hold up the writes waiting for the same locks. Reads
+    # do not see them even before they are deleted.
+    def expire_keys(self):
+        expiry = self.server_kv_store.expiry
+        while True:
+            try:
+                now = time.time()
+                keys = expiry.due(now, self.expire_batch)
+                if keys:
+                    self.expire_many(keys, now)
+                if len(keys) < self.expire_batch:
+                    time.sleep(expiry.tick)
+            except Exception as e:
+                print(f"An error occurred while expiring keys: {e}")
+                time.sleep(expiry.tick)
+    
+    # open the log for appending; called by run_server in the server's own process
+    def start_persistence(self):
+        self.log.open()
         
+    # Occationally compacting the log in a seperate thread, or right away when the memtable
+    # is over its memory limit
     def save_data_to_file(self):
         while True:
             try:
                 print(f"{self.serverName} is running... Number of keys in store: {len(self.server_kv_store)}")
-                with open(self.storage, 'w') as file:
-                    json.dump(self.server_kv_store, file)
-                    print(f"Data saved to {self.storage}")
-                time.sleep(10)  # Adding sleep to avoid high CPU utilization
+                if self.log.size() >= self.compact_bytes or self.memory_pressure.is_set():
+                    self.memory_pressure.clear()
+                    self.compact()
+                self.memory_pressure.wait(10)  # Adding sleep to avoid high CPU utilization
             except Exception as e:
                 print(f"An error occurred: {e}")
         
-    # Handling data migration after a server is being shutdown
-    # Being used to simulate adding/removing server nodes in hash ring
-    def migrate_data_from_another_storage(self, other):
-        print(f"Number of keys in {self.serverName} store before migration: {len(self.server_kv_store)}")
-        print(f"Number of keys in {other.serverName} store before migration: {len(other.server_kv_store)}")
-        
-        # instant save to improve fault tolerance
-        with open(self.storage, 'w') as file:
-            json.dump(self.server_kv_store, file)
-            print(f"Data saved to {self.storage}")
-            
-        other_data = other.server_kv_store
-        for key, value in other_data.items():
-            self.server_kv_store[key] = value
-                    
-        print(f"Number of keys in {self.serverName} store after migration: {len(self.server_kv_store)}")
-        print(f"Number of keys in {other.serverName} store after migration: {len(other.server_kv_store)}")
-        
-        # instant update to the disk
-        with open(self.storage, 'w') as file:
-            json.dump(self.server_kv_store, file)
-            print(f"Data saved to {self.storage}")
+    # the keys whose ring position falls into ranges (a RangeSet), as a stream of JSON lines
+    # [key, value] or [key, value, expiry time] sent in blocks of about block_size bytes
+    def export_ranges(self, ranges, block_size=64 * 1024):
+        block = []
+        block_bytes = 0
+        for key, value in self.server_kv_store.items():
+            if ring_hash(key) in ranges:
+                expires_at = self.server_kv_store.expires_at(key)
+                line = json.dumps([key, value] if expires_at is None else [key, value, expires_at]) + '\n'
+                block.append(line)
+                block_bytes += len(line)
+                if block_bytes >= block_size:
+                    yield ''.join(block)
+                    block = []
+                    block_bytes = 0
+        if block:
+            yield ''.join(block)
+    
+    # answer one request of the binary protocol, with the same semantics as the HTTP routes
+    def handle_binary(self, opcode, key, value, expires_at):
+        started = time.perf_counter()
+        key = key.decode('utf-8')
+        result_expires_at = None
+        if opcode == myBinaryProtocol.OP_GET:
+            found = self.server_kv_store.get(key)
+            status, result = (STATUS_OK, found.encode('utf-8')) if found is not None else (STATUS_NOT_FOUND, b'')
+            if found is not None:
+                result_expires_at = self.server_kv_store.expires_at(key)
+        elif opcode == myBinaryProtocol.OP_PUT:
+            if expires_at is not None and not math.isfinite(expires_at):
+                status, result = STATUS_ERROR, b'the expiry time must be a finite number'
+            else:
+                self.put(key, value.decode('utf-8'), expires_at)
+                status, result = STATUS_OK, b''
+        elif opcode == myBinaryProtocol.OP_DEL:
+            status, result = (STATUS_OK if self.delete(key) else STATUS_NOT_FOUND), b''
+        elif opcode == myBinaryProtocol.OP_PING:
+            status, result = STATUS_OK, str(len(self.server_kv_store)).encode('utf-8')
+        else:
+            status, result = STATUS_ERROR, f"unknown opcode {opcode}".encode('utf-8')
+        route = f"binary:{OPCODE_NAMES.get(opcode, 'unknown')}"
+        self.request_metrics.observe(route, 'BINARY', HTTP_STATUS[status], time.perf_counter() - started)
+        return status, result, result_expires_at
     
     # all routing methods
     def routes(self):
+        instrument(self.app, self.request_metrics)
+        
+        # ?ttl= deletes the key after that many seconds
         @self.app.route('/put', methods=['PUT'])
         def put_value():
             key = request.args.get('key')
             value = request.args.get('value')
-            self.server_kv_store[key] = value
+            if key is None or value is None:
+                return jsonify({'error': 'Expected the parameters key and value'}), 400
+            try:
+                ttl = ttl_argument(request.args.get('ttl'))
+            except ValueError:
+                return jsonify({'error': 'ttl must be a positive number of seconds'}), 400
+            self.put(key, value, time.time() + ttl if ttl is not None else None)
             return jsonify({'message': 'Value stored successfully'}), 200
 
         @self.app.route('/get', methods=['GET'])
         def get_value():
             key = request.args.get('key')
+            if key is None:
+                return jsonify({'error': 'Expected the parameter key'}), 400
             value = self.server_kv_store.get(key)
             if value is not None:
+                expires_at = self.server_kv_store.expires_at(key)
+                if expires_at is not None:
+                    return jsonify({'value': value, 'expires_at': expires_at}), 200
                 return jsonify({'value': value}), 200
             else:
                 return jsonify({'error': 'Key not found'}), 404
             
-        @self.app.route('/del', methods=['DEL'])
+        @self.app.route('/del', methods=['DEL', 'DELETE'])
         def del_value():
             key = request.args.get('key')
-            if key in self.server_kv_store:
-                del self.server_kv_store[key]
+            if key is None:
+                return jsonify({'error': 'Expected the parameter key'}), 400
+            if self.delete(key):
                 return jsonify({'message': 'Key deleted successfully'}), 200
             else:
                 return jsonify({'error': 'Key not found'}), 404
         
+        # batch routes: many keys in one JSON body instead of one request per key.
+        # An /mput may give all its keys a "ttl", or some of them expiry times in "expires"
+        @self.app.route('/mput', methods=['PUT'])
+        def mput_values():
+            body = json_object(request.get_json(silent=True))
+            items = body.get('items')
+            if not valid_items(items):
+                return jsonify({'error': 'Expected a JSON body {"items": {key: value}} of strings'}), 400
+            try:
+                ttl = ttl_argument(body.get('ttl'))
+                expires = expires_argument(body.get('expires'))
+            except (AttributeError, TypeError, ValueError):
+                return jsonify({'error': 'ttl must be a positive number of seconds, and expires a map of times'}), 400
+            if ttl is not None:
+                expires_at = time.time() + ttl
+                expires = {key: expires_at for key in items}
+            stored = self.put_many(items, only_missing=bool(body.get('only_missing')), expires=expires)
+            return jsonify({'message': f"{stored} values stored successfully"}), 200
+
+        @self.app.route('/mget', methods=['POST'])
+        def mget_values():
+            keys = json_object(request.get_json(silent=True)).get('keys')
+            if not valid_keys(keys):
+                return jsonify({'error': 'Expected a JSON body {"keys": [key, ...]} of strings'}), 400
+            values = dict()
+            expires = dict()
+            missing = []
+            for key in keys:
+                value = self.server_kv_store.get(key)
+                if value is not None:
+                    values[key] = value
+                    expires_at = self.server_kv_store.expires_at(key)
+                    if expires_at is not None:
+                        expires[key] = expires_at
+                else:
+                    missing.append(key)
+            if expires:
+                return jsonify({'values': values, 'missing': missing, 'expires': expires}), 200
+            return jsonify({'values': values, 'missing': missing}), 200
+
+        @self.app.route('/mdel', methods=['DEL', 'DELETE'])
+        def mdel_values():
+            keys = json_object(request.get_json(silent=True)).get('keys')
+            if not valid_keys(keys):
+                return jsonify({'error': 'Expected a JSON body {"keys": [key, ...]} of strings'}), 400
+            deleted, missing = self.delete_many(keys)
+            return jsonify({'deleted': deleted, 'missing': missing}), 200
+        
+        # a page of the keys starting with prefix, in key order from start on
+        @self.app.route('/scan', methods=['GET'])
+        def scan_values():
+            try:
+                prefix, start, limit = scan_arguments(request.args)
+            except ValueError:
+                return jsonify({'error': f"limit must be a number between 1 and {SCAN_LIMIT}"}), 400
+            items, next_key = self.server_kv_store.scan(prefix, start, limit)
+            return jsonify({'items': items, 'next': next_key}), 200
+        
+        # stream the keys of some hash ranges to the rebalancer,
+        # body {"ranges": [[start, end], ...]} with hex bounds
+        @self.app.route('/export', methods=['POST'])
+        def export_values():
+            ranges = json_object(request.get_json(silent=True)).get('ranges')
+            if not isinstance(ranges, list):
+                return jsonify({'error': 'Expected a JSON body {"ranges": [[start, end], ...]}'}), 400
+            try:
+                ranges = RangeSet.from_json(ranges)
+            except (TypeError, ValueError):
+                return jsonify({'error': 'Range bounds must be pairs of hex strings'}), 400
+            return Response(self.export_ranges(ranges), mimetype='application/x-ndjson')
+        
+        @self.app.route('/ping', methods=['GET'])
+        def ping():
+            return jsonify({'message': 'pong', 'keys': len(self.server_kv_store)}), 200
+        
+        @self.app.route('/metrics', methods=['GET'])
+        def metrics():
+            return Response(self.metrics.render(), content_type=CONTENT_TYPE)
+        
         # special shutdown route to simulate a server going down, using os.kill to kill the process
         @self.app.route('/shutdown', methods=['POST'])
         def shutdown():
@@ -185,13 +884,26 @@ class MyKVStore:
         
         self.app.add_url_rule('/put', view_func=put_value, methods=['PUT'])
         self.app.add_url_rule('/get', view_func=get_value, methods=['GET'])
-        self.app.add_url_rule('/del', view_func=del_value, methods=['DEL'])
+        self.app.add_url_rule('/del', view_func=del_value, methods=['DEL', 'DELETE'])
+        self.app.add_url_rule('/mput', view_func=mput_values, methods=['PUT'])
+        self.app.add_url_rule('/mget', view_func=mget_values, methods=['POST'])
+        self.app.add_url_rule('/mdel', view_func=mdel_values, methods=['DEL', 'DELETE'])
+        self.app.add_url_rule('/scan', view_func=scan_values, methods=['GET'])
+        self.app.add_url_rule('/export', view_func=export_values, methods=['POST'])
+        self.app.add_url_rule('/ping', view_func=ping, methods=['GET'])
+        self.app.add_url_rule('/metrics', view_func=metrics, methods=['GET'])
         self.app.add_url_rule('/shutdown', view_func=shutdown, methods=['POST'])
     
-    # run KVStore server on its port with forever running disk saving thread
-    def run_server(self):
+    # run KVStore server on its port with forever running disk saving thread.
+    # waitress is used instead of the Flask development server because the latter closes
+    # every connection, which defeats the distributor's keep-alive connection pool
+    def run_server(self, threads=16):
+        self.start_persistence()
         Thread(target=self.save_data_to_file, daemon=True).start()
-        self.app.run(threaded=True, host='127.0.0.1', port=self.port)
+        Thread(target=self.expire_keys, daemon=True).start()
+        if self.binary_port is not None:
+            BinaryServer(self.handle_binary, port=self.binary_port).start_in_thread()
+        serve(self.app, host='127.0.0.1', port=self.port, threads=threads, _quiet=True)
    
   
 class MyDistributor:
@@ -199,123 +911,849 @@ class MyDistributor:
     MyDistributor Class works as a main server (a load distrubutor) that uses the HashRing to
     determine which MyKVStore instance should handle a given request and forwars the 
     request accordingly.
+    
+    self.pool: the keep-alive ConnectionPool shared by all forwarding routes
+    self.store_options: keyword arguments for the MyKVStore servers started by /add_server
+    self.replicas: the number of kv stores holding each key (the first ones of its
+                   preference list on the HashRing)
+    self.read_quorum / self.write_quorum: the number of replicas that have to answer a read
+                   or a write (or delete) before the distributor answers the client. All
+                   replicas are asked in parallel, and the answer does not wait for the others,
+                   so with read_quorum 1 a read is served by the fastest replica
+    self.executor: the thread pool used to send requests to the replicas and per-node
+                   batches of /mget, /mput and /mdel to the kv stores in parallel
+    self.rebalancer: moves the keys of the hash ranges that changed owner after /add_server
+                     or /remove_server, configured by rebalance_options (chunk_size, rate_limit).
+                     While it runs, reads that miss on the new owner fall back to the old one
+    self.topology_lock: serializes /add_server and /remove_server
+    self.cache: an optional HotKeyCache consulted by /get and /mget before forwarding,
+                invalidated by the writes passing through the distributor and flushed
+                on topology changes (None disables it)
+    self.metrics: the Registry served by /metrics: request counts and latencies per route,
+                  forwarding latencies and errors per kv store, ring, rebalance and cache stats
+    self.logger: logs a log_sample fraction of the requests at DEBUG level
+    self.binary_offset: if not 0, the distributor also serves the binary protocol on port
+                        5000 + binary_offset and forwards it to the binary ports of the kv stores
+    self.loads: a LoadTracker if single key reads are routed with bounded loads (bounded_load
+                is its epsilon, 0 disables it); a read then asks only read_quorum replicas,
+                the first ones of its preference list that are not full, and the other
+                replicas only if those fail
+    self.shared: the SharedRingState of the distributor workers serving port 5000 together,
+                 or None for a single distributor. The worker that changes the topology
+                 publishes the new ring and moves the keys, and the other workers take the
+                 ring over on their next request and follow the move (self.ring_version is
+                 the version of self.HashRing)
+    self.health: a HealthMonitor configured by health_options (None disables it). Kv stores
+                 whose circuit breaker opened are left out of the preference lists until
+                 they answer pings again and got the writes they missed
     """
-    def __init__(self, ring, server_tracker, kv_stores):
+    def __init__(self, ring, server_tracker, kv_stores, pool=None, store_options=None, rebalance_options=None,
+                 replicas=1, read_quorum=1, write_quorum=1, cache=None, log_sample=0.0, binary_offset=0,
+                 bounded_load=0.0, shared=None, health_options=None):
         self.app = Flask(__name__)
         self.HashRing = ring
         self.added_servers = []
         self.server_tracker = server_tracker
         self.kv_server_instances = kv_stores
+        self.store_options = store_options or {}
+        self.replicas = replicas
+        self.read_quorum = read_quorum
+        self.write_quorum = write_quorum
+        self.pool = pool or ConnectionPool()
+        self.executor = ThreadPoolExecutor(max_workers=self.pool.max_size * replicas)
+        self.shared = shared
+        self.ring_version = 0
+        self._ring_sync_lock = Lock()
+        self.rebalancer = Rebalancer(self.pool, ring_hash, deletes=shared.deletes if shared is not None else None,
+                                     **(rebalance_options or {}))
+        self.topology_lock = shared.topology_lock if shared is not None else Lock()
+        self.cache = cache
+        self.binary_offset = binary_offset
+        self.loads = LoadTracker(bounded_load) if bounded_load > 0 else None
+        self.health = None
+        if health_options is not None:
+            self.health = HealthMonitor(lambda: self.HashRing.nodes, **health_options)
+            self.health.on_open = self.pool.abort
+            self.health.on_recover = self._hand_off
+        self._register_metrics(log_sample)
+
+    def _register_metrics(self, log_sample):
+        self.logger = logging.getLogger('MyDistributor')
+        self.metrics = Registry()
+        self.request_metrics = RequestMetrics(self.metrics, 'distributor', self.logger, log_sample)
+        self.backend_latency = self.metrics.histogram('distributor_backend_request_duration_seconds',
+                                                      "Latency of the requests forwarded to each kv store", ('node',))
+        self.backend_errors = self.metrics.counter('distributor_backend_errors_total',
+                                                   "Forwarded requests that failed or got a server error", ('node',))
+        self.metrics.gauge('distributor_ring_nodes', "Physical nodes on the hash ring", lambda: len(self.HashRing.nodes))
+        self.metrics.gauge('distributor_ring_vnodes', "Virtual nodes on the hash ring per physical node",
+                           lambda: {(node,): count for node, count in Counter(self.HashRing.ring.values()).items()},
+                           ('node',))
+        self.metrics.gauge('distributor_ring_weight', "Weight of each physical node on the hash ring",
+                           lambda: {(node,): self.HashRing.weights.get(node, 1) for node in self.HashRing.nodes},
+                           ('node',))
+        self.metrics.gauge('distributor_rebalance_running', "1 while keys are being moved after a topology change",
+                           lambda: int(self.rebalancer.running))
+        self.metrics.gauge('distributor_rebalance_keys_moved', "Keys moved by the last topology change",
+                           lambda: self.rebalancer.status()['keys_moved'])
+        if self.shared is not None:
+            self.metrics.gauge('distributor_ring_version', "Version of the ring shared by the distributor workers",
+                               lambda: self.ring_version)
+        if self.cache is not None:
+            self.metrics.gauge('distributor_cache_hits_total', "Reads answered by the hot key cache",
+                               lambda: self.cache.stats()['hits'], kind='counter')
+            self.metrics.gauge('distributor_cache_misses_total', "Reads the hot key cache could not answer",
+                               lambda: self.cache.stats()['misses'], kind='counter')
+            self.metrics.gauge('distributor_cache_evictions_total', "Keys evicted from the hot key cache",
+                               lambda: self.cache.stats()['evictions'], kind='counter')
+            self.metrics.gauge('distributor_cache_entries', "Keys in the hot key cache",
+                               lambda: self.cache.stats()['entries'])
+            self.metrics.gauge('distributor_cache_bytes', "Key and value bytes in the hot key cache",
+                               lambda: self.cache.stats()['bytes'])
+        if self.loads is not None:
+            self.metrics.gauge('distributor_inflight_requests', "Requests in flight to each kv store",
+                               lambda: {(node,): count for node, count in self.loads.inflight.items()}, ('node',))
+            self.metrics.gauge('distributor_load_spills_total', "Reads that skipped a full replica",
+                               lambda: self.loads.spills, kind='counter')
+        if self.health is not None:
+            health = self.health
+            self.metrics.gauge('distributor_backend_up', "1 while a kv store is routed to, 0 while its circuit breaker is open",
+                               lambda: {(node,): int(node not in health.down()) for node in self.HashRing.nodes}, ('node',))
+            self.metrics.gauge('distributor_breaker_trips_total', "Times the circuit breaker of a kv store opened",
+                               lambda: {(node,): breaker.trips for node, breaker in list(health.breakers.items())},
+                               ('node',), kind='counter')
+            self.metrics.gauge('distributor_hinted_keys', "Keys waiting to be handed off to a kv store that was down",
+                               lambda: {(node,): len(keys) for node, keys in list(health.hints.items())}, ('node',))
+
+    # every answer, failure and timeout also counts for the circuit breaker of the kv store
+    def _observe_backend(self, node, started, failed):
+        self.backend_latency.observe(time.perf_counter() - started, node)
+        if failed:
+            self.backend_errors.inc(node)
+        if self.health is not None:
+            self.health.record(node, not failed)
+
+    # a write that failed on a kv store (also after its quorum was reached) is handed off to
+    # it later, like the writes made while it was down
+    def _hint_write(self, node, method, params, json_body):
+        if self.health is None or method not in ('PUT', 'DEL'):
+            return
+        if params is not None and 'key' in params:
+            keys = [params['key']]
+        else:
+            keys = list((json_body or {}).get('items') or (json_body or {}).get('keys') or ())
+        self.health.hint([node], keys)
+
+    # a request to a kv store through the connection pool, timed per kv store for /metrics
+    def _backend_request(self, node, method, path, params=None, json_body=None):
+        started = time.perf_counter()
+        if self.loads is not None:
+            self.loads.begin(node)
+        try:
+            response = self.pool.request(node, method, path, params=params, json_body=json_body)
+        except ConnectionPoolError:
+            self._observe_backend(node, started, True)
+            self._hint_write(node, method, params, json_body)
+            raise
+        finally:
+            if self.loads is not None:
+                self.loads.end(node)
+        self._observe_backend(node, started, response.status_code >= 500)
+        if response.status_code >= 500:
+            self._hint_write(node, method, params, json_body)
+        return response
+
+    # the values of the keys found in the cache, and fill tokens for the others
+    def _cache_lookup(self, keys):
+        values = dict()
+        tokens = dict()
+        if self.cache is not None:
+            for key in keys:
+                value = self.cache.get(key)
+                if value is None:
+                    tokens[key] = self.cache.begin_fill(key)
+                else:
+                    values[key] = value
+        return values, tokens
+
+    # values that expire in the kv stores (expires, {key: expiry time}) are cached until then at most
+    def _cache_fill(self, values, tokens, expires=None):
+        if self.cache is not None:
+            now = time.time()
+            for key, token in tokens.items():
+                if key not in values:
+                    continue
+                ttl = 0
+                if expires and key in expires:
+                    ttl = expires[key] - now
+                    if ttl <= 0:
+                        continue
+                self.cache.fill(key, values[key], token, ttl)
+
+    # writes invalidate their keys before they are forwarded, so reads already in flight
+    # cannot cache the old value, and again once they are done, for reads that fetched
+    # the old value in the meantime
+    def _cache_invalidate(self, keys):
+        if self.cache is not None:
+            self.cache.invalidate_many(keys)
+
+    # relay the answer of a kv store
+    @staticmethod
+    def _relay(response):
+        try:
+            response_data = response.json()
+        except ValueError:
+            response_data = {'error': 'Invalid JSON response', 'response_text': response.text}
+        return jsonify(response_data), response.status_code
+
+    # forward a request to a kv store through the connection pool and relay its answer
+    def _forward(self, node, method, path, params):
+        try:
+            response = self._backend_request(node, method, path, params=params)
+        except ConnectionPoolError as e:
+            return jsonify({'error': f"server at port {node} is unavailable: {e}"}), 503
+        return self._relay(response)
+
+    # send a request to all replicas of a key in parallel and yield (node, response, error)
+    # in the order they answer; a single replica is asked from the calling thread
+    def _replica_responses(self, nodes, method, path, params):
+        if len(nodes) == 1:
+            try:
+                yield nodes[0], self._backend_request(nodes[0], method, path, params=params), None
+            except ConnectionPoolError as e:
+                yield nodes[0], None, e
+            return
+        futures = {self.executor.submit(self._backend_request, node, method, path, params=params): node for node in nodes}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except ConnectionPoolError as e:
+                yield futures[future], None, e
+
+    # the groups of replicas a request is sent to, one after the other while the quorum is
+    # not reached: all replicas at once, or for reads with bounded loads the chosen replicas
+    # first and the others only if those fail
+    def _replica_waves(self, nodes, quorum, balanced):
+        if not balanced or self.loads is None or quorum >= len(nodes):
+            return [nodes]
+        chosen = self.loads.choose(nodes, quorum, self.HashRing)
+        return [chosen, [node for node in nodes if node not in chosen]]
+
+    # stop waiting for the replicas once quorum of them answered. Returns (answers, errors):
+    # the (node, response) pairs received and why the replicas that failed did not answer
+    def _send_to_replicas(self, nodes, method, path, params, quorum, balanced=False):
+        answers = []
+        errors = dict()
+        for wave in self._replica_waves(nodes, quorum, balanced):
+            for node, response, error in self._replica_responses(wave, method, path, params):
+                if error is not None:
+                    errors[node] = f"server at port {node} is unavailable: {error}"
+                    continue
+                if response.status_code >= 500:
+                    errors[node] = f"server at port {node} answered {response.status_code}"
+                    continue
+                answers.append((node, response))
+                if len(answers) >= quorum:
+                    return answers, errors
+        return answers, errors
+
+    # the answer to a single key request once its replicas answered: the first answer that
+    # found the key if there is one, otherwise the first answer, or 503 without a quorum
+    def _quorum_answer(self, answers, errors, quorum):
+        if not answers or len(answers) < quorum:
+            return jsonify({'error': f"{len(answers)} of {quorum} replicas answered", 'errors': errors}), 503
+        for _, response in answers:
+            if response.status_code == 200:
+                return self._relay(response)
+        return self._relay(answers[0][1])
+
+    # the replicas of a key: its preference list, where the kv stores that are down are
+    # replaced by the next healthy nodes on the ring. Writes pass hint=True, so the replaced
+    # kv stores get the key once they are back
+    def _preference_list(self, key, hint=False):
+        nodes = self.HashRing.get_preference_list(key, self.replicas)
+        down = self.health.down() if self.health is not None else ()
+        if not down or down.isdisjoint(nodes):
+            return nodes
+        return self._route_around(key, nodes, down, hint)
+
+    def _route_around(self, key, nodes, down, hint):
+        extended = self.HashRing.get_preference_list(key, min(self.replicas + len(down), len(self.HashRing.nodes)))
+        healthy = [node for node in extended if node not in down][:self.replicas]
+        # with all of them down, the request fails on the usual replicas
+        if not healthy:
+            return nodes
+        if hint:
+            self.health.hint([node for node in nodes if node in down], [key])
+        return healthy
+
+    # the replicas of each key, and the keys each kv store holds a replica of
+    def _group_by_node(self, keys, hint=False):
+        keys = list(keys)
+        replicas = dict(zip(keys, self.HashRing.get_preference_lists(keys, self.replicas)))
+        down = self.health.down() if self.health is not None else ()
+        if down:
+            for key, nodes in replicas.items():
+                if not down.isdisjoint(nodes):
+                    replicas[key] = self._route_around(key, nodes, down, hint)
+        groups = dict()
+        for key, nodes in replicas.items():
+            for node in nodes:
+                groups.setdefault(node, []).append(key)
+        return replicas, groups
+
+    # the keys for which at least quorum of their replicas answered
+    @staticmethod
+    def _answered(replicas, results, quorum):
+        ok = {node for node, (data, _) in results.items() if data is not None}
+        return {key for key, nodes in replicas.items() if sum(node in ok for node in nodes) >= min(quorum, len(nodes))}
+
+    # send one batched request per kv store in parallel, until every key reached its quorum.
+    # Returns {node: (response_data, error)} with exactly one of the two set, for the kv
+    # stores that answered by then
+    def _fan_out(self, method, path, bodies, replicas=None, quorum=None):
+        futures = {
+            self.executor.submit(self._backend_request, node, method, path, json_body=body): node
+            for node, body in bodies.items()
+        }
+        results = dict()
+        for future in as_completed(futures):
+            node = futures[future]
+            try:
+                response = future.result()
+                if response.status_code == 200:
+                    results[node] = (response.json(), None)
+                else:
+                    results[node] = (None, f"server at port {node} answered {response.status_code}")
+            except (ConnectionPoolError, ValueError) as e:
+                results[node] = (None, str(e))
+            if quorum is not None and results[node][0] is not None \
+                    and len(self._answered(replicas, results, quorum)) == len(replicas):
+                break
+        return results
+
+    # group the keys that are still being moved away from their previous owner by that owner
+    def _group_by_previous_owner(self, keys):
+        groups = dict()
+        if self.rebalancer.running:
+            for key in keys:
+                node = self.rebalancer.previous_owner(key)
+                if node is not None:
+                    groups.setdefault(node, []).append(key)
+        return groups
+
+    # give a kv store the current version of the keys written while it was down or that
+    # failed on it: they are read from their other replicas, which include the kv stores
+    # standing in for it, and copied to it (or deleted on it). The kv store is then routed to
+    # again, and the copies on the kv stores that stood in for it are deleted. Returns False
+    # if the hand-off failed, and the kv store stays out of the routing
+    def _hand_off(self, node, keys):
+        # the ring may have changed since, and a failed write to the previous owner of a
+        # moving key is not for a replica
+        keys = [key for key in keys if node in self.HashRing.get_preference_list(key, self.replicas)]
+        stand_ins = dict()
+        for start in range(0, len(keys), self.rebalancer.chunk_size):
+            chunk = keys[start:start + self.rebalancer.chunk_size]
+            replicas, groups = self._group_by_node(chunk)
+            groups.pop(node, None)
+            values = dict()
+            expires = dict()
+            try:
+                for replica, replica_keys in groups.items():
+                    response = self.pool.request(replica, 'POST', '/mget', json_body={'keys': replica_keys})
+                    if response.status_code != 200:
+                        raise ConnectionPoolError(f"server at port {replica} answered {response.status_code}")
+                    data = response.json()
+                    values.update(data['values'])
+                    expires.update(data.get('expires', {}))
+                # a key without other replicas has nowhere to come from
+                deleted = [key for key in chunk if key not in values and set(replicas[key]) - {node}]
+                if values:
+                    response = self.pool.request(node, 'PUT', '/mput', json_body={'items': values, 'expires': expires})
+                    if response.status_code != 200:
+                        raise ConnectionPoolError(f"server at port {node} answered {response.status_code}")
+                if deleted:
+                    response = self.pool.request(node, 'DEL', '/mdel', json_body={'keys': deleted})
+                    if response.status_code != 200:
+                        raise ConnectionPoolError(f"server at port {node} answered {response.status_code}")
+            except (ConnectionPoolError, ValueError) as e:
+                print(f"Handing off {len(keys)} keys to server at port {node} failed: {e}")
+                return False
+            for key, nodes in replicas.items():
+                for replica in nodes:
+                    stand_ins.setdefault(replica, []).append(key)
+        self.health.reinstate(node)
+        print(f"Handed off {len(keys)} keys to server at port {node}")
+        # the copies the kv stores kept in its place are stale from now on
+        replicas, _ = self._group_by_node(keys)
+        for replica, replica_keys in stand_ins.items():
+            extra = [key for key in replica_keys if replica not in replicas[key]]
+            if extra:
+                try:
+                    self.pool.request(replica, 'DEL', '/mdel', json_body={'keys': extra})
+                except ConnectionPoolError as e:
+                    print(f"Could not delete the keys server at port {replica} kept for {node}: {e}")
+        return True
+
+    # wait until a newly started kv store answers, so the ring never routes to a closed port
+    def _wait_until_up(self, node, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                if self.pool.request(node, 'GET', '/ping').status_code == 200:
+                    return True
+            except ConnectionPoolError:
+                time.sleep(0.1)
+        return False
+
+    def _shutdown_server(self, port):
+        try:
+            response = self.pool.request(port, 'POST', '/shutdown')
+            if response.status_code == 200:
+                print(f"Server on port {port} is shutting down.")
+                return True
+            print(f"Server on port {port} answered {response.status_code} to the shutdown command")
+        except ConnectionPoolError as e:
+            print(f"Error shutting down server on port {port}: {e}")
+        finally:
+            # connections to the removed server are dead from now on
+            self.pool.close(port)
+        return False
+
+    # apply a change to the ring (with the topology lock held) and start moving the keys of
+    # the hash ranges that changed owner
+    def _change_ring(self, change, on_done=None):
+        old_ring = self.HashRing.copy()
+        change(self.HashRing)
+        ranges = HashRing.changed_ranges(old_ring, self.HashRing, self.replicas)
+        if self.shared is not None:
+            # the other workers learn about the move before it can end
+            self._publish_ring(old_ring, 'running')
+            on_done = self._publish_when_done(on_done)
+        self.rebalancer.start(ranges, on_done=on_done)
+        if self.cache is not None:
+            self.cache.clear()
+        return ranges
+
+    # publish the ring to the other distributor workers, with the ring before the change
+    # while its keys are moving
+    def _publish_ring(self, previous, rebalance):
+        state = {
+            'nodes': self.HashRing.nodes,
+            'weights': self.HashRing.weights,
+            'server_tracker': self.server_tracker,
+            'previous': {'nodes': previous.nodes, 'weights': previous.weights} if previous is not None else None,
+            'rebalance': rebalance,
+            'worker': os.getpid(),
+        }
+        with self._ring_sync_lock:
+            self.ring_version = self.shared.publish(state)
+
+    def _publish_when_done(self, on_done):
+        def finished(rebalancer):
+            if on_done is not None:
+                on_done(rebalancer)
+            self._publish_ring(None, rebalancer.state)
+        return finished
+
+    # take over the ring another distributor worker published since the last request
+    def _sync_ring(self):
+        if self.shared is None or self.shared.version == self.ring_version:
+            return
+        with self._ring_sync_lock:
+            version, state = self.shared.read()
+            if version == self.ring_version:
+                return
+            if state['worker'] != os.getpid():
+                ring = HashRing(state['nodes'], vnodes=self.HashRing.vnodes, cache_size=self.HashRing.cache_size,
+                                weights=state['weights'])
+                previous = state['previous']
+                if previous is not None:
+                    previous = HashRing(previous['nodes'], vnodes=ring.vnodes, cache_size=ring.cache_size,
+                                        weights=previous['weights'])
+                    self.rebalancer.follow(HashRing.changed_ranges(previous, ring, self.replicas))
+                else:
+                    self.rebalancer.stop_following(state['rebalance'])
+                self.server_tracker = state['server_tracker']
+                self.HashRing = ring
+                if self.cache is not None:
+                    self.cache.clear()
+            self.ring_version = version
+
+    # the weight parameter of /add_server: None if it is missing, a positive number otherwise
+    @staticmethod
+    def _parse_weight(value):
+        if value is None:
+            return None
+        weight = float(value)
+        if not 0 < weight < float('inf'):
+            raise ValueError(f"weight must be a positive number, not {value}")
+        return weight
+
+    # called by the rebalancer once the keys of a removed server have moved: the server is
+    # only shut down if none of its keys were left behind
+    def _finish_removal(self, port):
+        def on_done(rebalancer):
+            if rebalancer.succeeded:
+                self._shutdown_server(port)
+            else:
+                print(f"Server on port {port} keeps running, some of its keys could not be moved")
+        return on_done
+
+    # a /scan over the kv stores that are routed to and, while keys move, the ones they move
+    # from; a key is taken from its replicas, or its previous owner if it has not moved yet
+    def _scan_merge(self, prefix, start, limit):
+        down = self.health.down() if self.health is not None else ()
+        nodes = [node for node in self.HashRing.nodes if node not in down]
+        moving = self.rebalancer.running
+        if moving:
+            nodes += sorted({move.source for move in self.rebalancer.moves}.difference(nodes))
+
+        def accept(node, key):
+            return node in self._preference_list(key) or (moving and node == self.rebalancer.previous_owner(key))
+
+        def rank(node, key):
+            nodes = self._preference_list(key)
+            return nodes.index(node) if node in nodes else len(nodes)
+
+        return ScanMerge(nodes, prefix, start, limit, accept, rank)
+
+    # the page of a finished ScanMerge; without answers from as many kv stores as hold a
+    # replica of each key, keys may be missing
+    def _scan_answer(self, merge):
+        answer = {'items': merge.items, 'next': merge.next}
+        if merge.errors:
+            answer['errors'] = merge.errors
+            if len(merge.errors) >= self.replicas:
+                answer['error'] = f"{len(merge.errors)} servers did not answer, keys may be missing"
+                return answer, 503
+        return answer, 200
+
+    # the parameters of a /put for the replicas, with its ttl if it has a valid one
+    @staticmethod
+    def _put_params(args):
+        params = {"key": args.get('key'), "value": args.get('value')}
+        if ttl_argument(args.get('ttl')) is not None:
+            params['ttl'] = args.get('ttl')
+        return params
+
+    # the body of an /mput for one kv store
+    @staticmethod
+    def _mput_body(items, ttl):
+        return {'items': items} if ttl is None else {'items': items, 'ttl': ttl}
+
+    # keys without a quorum of answering replicas are reported under 'failed', except the
+    # ones in found, and the reasons per kv store under 'errors'
+    @classmethod
+    def _add_failures(cls, merged, replicas, results, quorum, found=()):
+        answered = cls._answered(replicas, results, quorum)
+        failed = [key for key in replicas if key not in answered and key not in found]
+        if failed:
+            merged['failed'] = failed
+        errors = {node: error for node, (_, error) in results.items() if error is not None}
+        if errors:
+            merged['errors'] = errors
+        return merged
 
     # all routing methods
     def routes(self):
+        instrument(self.app, self.request_metrics)
+        self.app.before_request(self._sync_ring)
+        
+        # every single key request goes to all replicas of the key in parallel and is answered
+        # once its quorum of replicas answered
         @self.app.route('/put', methods=['PUT'])
         def put_value():
-            key = request.args.get('key')
-            value = request.args.get('value')
-            print("recevied a put request")
-            node = self.HashRing.get_node(key)
-            response = requests.put(f"http://127.0.0.1:{node}" + "/put", params={"key": key, "value": value})
+            if request.args.get('key') is None or request.args.get('value') is None:
+                return jsonify({'error': 'Expected the parameters key and value'}), 400
             try:
-                response_data = response.json()
+                params = self._put_params(request.args)
             except ValueError:
-                response_data = {'error': 'Invalid JSON response', 'response_text': response.text}
-            return jsonify(response_data), response.status_code
+                return jsonify({'error': 'ttl must be a positive number of seconds'}), 400
+            key = params['key']
+            nodes = self._preference_list(key, hint=True)
+            quorum = min(self.write_quorum, len(nodes))
+            self._cache_invalidate([key])
+            answers, errors = self._send_to_replicas(nodes, 'PUT', '/put', params, quorum)
+            self._cache_invalidate([key])
+            return self._quorum_answer(answers, errors, quorum)
             
         @self.app.route('/get', methods=['GET'])
         def get_value():
             key = request.args.get('key')
-            print("recevied a get request")
-            node = self.HashRing.get_node(key)
-            response = requests.get(f"http://127.0.0.1:{node}" + "/get", params={"key": key})
-            try:
-                response_data = response.json()
-            except ValueError:
-                response_data = {'error': 'Invalid JSON response', 'response_text': response.text}
-            return jsonify(response_data), response.status_code           
+            if key is None:
+                return jsonify({'error': 'Expected the parameter key'}), 400
+            values, tokens = self._cache_lookup([key])
+            if values:
+                return jsonify({'value': values[key]}), 200
+            nodes = self._preference_list(key)
+            quorum = min(self.read_quorum, len(nodes))
+            answers, errors = self._send_to_replicas(nodes, 'GET', '/get', {"key": key}, quorum, balanced=True)
+            response = self._quorum_answer(answers, errors, quorum)
+            # during a rebalance the key may not have reached its new owner yet
+            if response[1] == 404:
+                previous = self.rebalancer.previous_owner(key)
+                if previous is not None:
+                    answers, errors = self._send_to_replicas([previous], 'GET', '/get', {"key": key}, 1)
+                    response = self._quorum_answer(answers, errors, 1)
+            if response[1] == 200:
+                found = next(answer for _, answer in answers if answer.status_code == 200).json()
+                self._cache_fill({key: found['value']}, tokens, {key: found['expires_at']} if 'expires_at' in found else None)
+            return response
             
-        @self.app.route('/del', methods=['DEL'])
+        @self.app.route('/del', methods=['DEL', 'DELETE'])
         def del_value():
             key = request.args.get('key')
-            print("recevied a del request")
-            node = self.HashRing.get_node(key)
-            response = requests.request("DEL", f"http://127.0.0.1:{node}" + "/del", params={"key": key})
+            if key is None:
+                return jsonify({'error': 'Expected the parameter key'}), 400
+            nodes = self._preference_list(key, hint=True)
+            quorum = min(self.write_quorum, len(nodes))
+            self.rebalancer.record_delete(key)
+            self._cache_invalidate([key])
+            answers, errors = self._send_to_replicas(nodes, 'DEL', '/del', {"key": key}, quorum)
+            response = self._quorum_answer(answers, errors, quorum)
+            # during a rebalance the key may still be on its previous owner as well
+            previous = self.rebalancer.previous_owner(key)
+            if previous is not None:
+                previous_response = self._forward(previous, 'DEL', '/del', {"key": key})
+                if response[1] == 404:
+                    response = previous_response
+            self._cache_invalidate([key])
+            return response
+                  
+        @self.app.route('/mput', methods=['PUT'])
+        def mput_values():
+            body = json_object(request.get_json(silent=True))
+            items = body.get('items')
+            if not valid_items(items):
+                return jsonify({'error': 'Expected a JSON body {"items": {key: value}} of strings'}), 400
+            try:
+                ttl = ttl_argument(body.get('ttl'))
+            except (TypeError, ValueError):
+                return jsonify({'error': 'ttl must be a positive number of seconds'}), 400
+            replicas, groups = self._group_by_node(items, hint=True)
+            self._cache_invalidate(items)
+            results = self._fan_out('PUT', '/mput', {
+                node: self._mput_body({key: items[key] for key in keys}, ttl) for node, keys in groups.items()
+            }, replicas, self.write_quorum)
+            self._cache_invalidate(items)
+            stored = len(self._answered(replicas, results, self.write_quorum))
+            merged = {'message': f"{stored} values stored successfully"}
+            return jsonify(self._add_failures(merged, replicas, results, self.write_quorum)), 200
+
+        @self.app.route('/mget', methods=['POST'])
+        def mget_values():
+            keys = json_object(request.get_json(silent=True)).get('keys')
+            if not valid_keys(keys):
+                return jsonify({'error': 'Expected a JSON body {"keys": [key, ...]} of strings'}), 400
+            cached, tokens = self._cache_lookup(keys)
+            if cached:
+                keys = [key for key in keys if key not in cached]
+            replicas, groups = self._group_by_node(keys)
+            results = self._fan_out('POST', '/mget', {node: {'keys': keys} for node, keys in groups.items()},
+                                    replicas, self.read_quorum)
+            values = dict()
+            expires = dict()
+            for data, _ in results.values():
+                if data is not None:
+                    values.update(data['values'])
+                    expires.update(data.get('expires', {}))
+            answered = self._answered(replicas, results, self.read_quorum)
+            missing = [key for key in replicas if key not in values and key in answered]
+            previous_groups = self._group_by_previous_owner(missing)
+            if previous_groups:
+                previous_results = self._fan_out('POST', '/mget', {node: {'keys': keys} for node, keys in previous_groups.items()})
+                for data, _ in previous_results.values():
+                    if data is not None:
+                        values.update(data['values'])
+                        expires.update(data.get('expires', {}))
+                missing = [key for key in missing if key not in values]
+            self._cache_fill(values, tokens, expires)
+            values.update(cached)
+            merged = {'values': values, 'missing': missing}
+            return jsonify(self._add_failures(merged, replicas, results, self.read_quorum, found=values)), 200
+
+        @self.app.route('/mdel', methods=['DEL', 'DELETE'])
+        def mdel_values():
+            keys = json_object(request.get_json(silent=True)).get('keys')
+            if not valid_keys(keys):
+                return jsonify({'error': 'Expected a JSON body {"keys": [key, ...]} of strings'}), 400
+            for key in keys:
+                self.rebalancer.record_delete(key)
+            self._cache_invalidate(keys)
+            replicas, groups = self._group_by_node(keys, hint=True)
+            results = self._fan_out('DEL', '/mdel', {node: {'keys': keys} for node, keys in groups.items()},
+                                    replicas, self.write_quorum)
+            deleted = set()
+            for data, _ in results.values():
+                if data is not None:
+                    deleted.update(data['deleted'])
+            previous_groups = self._group_by_previous_owner(keys)
+            if previous_groups:
+                previous_results = self._fan_out('DEL', '/mdel', {node: {'keys': keys} for node, keys in previous_groups.items()})
+                for data, _ in previous_results.values():
+                    if data is not None:
+                        deleted.update(data['deleted'])
+            self._cache_invalidate(keys)
+            answered = self._answered(replicas, results, self.write_quorum)
+            merged = {
+                'deleted': [key for key in replicas if key in deleted],
+                'missing': [key for key in replicas if key not in deleted and key in answered],
+            }
+            return jsonify(self._add_failures(merged, replicas, results, self.write_quorum, found=deleted)), 200
+                  
+        # a page of the keys starting with prefix from all kv stores, in key order from start on.
+        # The pages of the kv stores are fetched in parallel, and more of them only when the
+        # merge runs out of keys of a kv store
+        @self.app.route('/scan', methods=['GET'])
+        def scan_values():
             try:
-                response_data = response.json()
+                prefix, start, limit = scan_arguments(request.args)
             except ValueError:
-                response_data = {'error': 'Invalid JSON response', 'response_text': response.text}
-            return jsonify(response_data), response.status_code
+                return jsonify({'error': f"limit must be a number between 1 and {SCAN_LIMIT}"}), 400
+            merge = self._scan_merge(prefix, start, limit)
+            merge.merge()
+            while not merge.done:
+                futures = {
+                    self.executor.submit(self._backend_request, node, 'GET', '/scan',
+                                         params={'prefix': prefix, 'start': page_start, 'limit': str(merge.page_size)}): node
+                    for node, page_start in merge.wanted().items()
+                }
+                for future in as_completed(futures):
+                    node = futures[future]
+                    try:
+                        response = future.result()
+                        if response.status_code != 200:
+                            raise ValueError(f"server at port {node} answered {response.status_code}")
+                        data = response.json()
+                        merge.add_page(node, data['items'], data['next'])
+                    except (ConnectionPoolError, ValueError) as e:
+                        merge.add_error(node, str(e))
+                merge.merge()
+            answer, status = self._scan_answer(merge)
+            return jsonify(answer), status
                   
+        # start a new kv store, add it to the ring once it answers and move the keys it now owns.
+        # ?weight= sets its share of the keys (1 by default), and ?port=&weight= changes the
+        # weight of a kv store that is already on the ring
         @self.app.route('/add_server', methods=['POST'])
         def add_server():
-            new_server_node = f"500{self.server_tracker}"
-            self.server_tracker += 1
-            self.HashRing.add_node(new_server_node)
-            new_server = create_server(int(new_server_node))
-            new_server_process = Process(target=start_server, args=(new_server,))
-            self.added_servers.append(new_server_process)
-            new_server_process.start()
-            return jsonify({'message': "new server added to port"}), 200
+            port = request.args.get('port')
+            try:
+                weight = self._parse_weight(request.args.get('weight'))
+            except ValueError:
+                return jsonify({'message': "weight must be a positive number"}), 400
+            with self.topology_lock:
+                self._sync_ring()
+                if self.rebalancer.running:
+                    return jsonify({'message': "keys from the last topology change are still moving"}), 409
+                if port is not None:
+                    if port not in self.HashRing.nodes:
+                        return jsonify({'message': f"server at port {port} is not on the ring, "
+                                                   f"new servers get the next free port"}), 400
+                    if weight is None:
+                        return jsonify({'message': f"a new weight for server at port {port} is needed"}), 400
+                    ranges = self._change_ring(lambda ring: ring.set_weight(port, weight))
+                    return jsonify({'message': f"weight of server at port {port} set to {weight}, "
+                                               f"moving the keys of {len(ranges)} hash ranges"}), 200
+                new_server_node = f"500{self.server_tracker}"
+                new_server = create_server(int(new_server_node), **self.store_options)
+                new_server_process = Process(target=start_server, args=(new_server,))
+                new_server_process.start()
+                # the port is only used up, and the process only tracked, once the server is up
+                if not self._wait_until_up(new_server_node):
+                    new_server_process.terminate()
+                    new_server_process.join(5)
+                    return jsonify({'message': f"server at port {new_server_node} did not start"}), 500
+                self.server_tracker += 1
+                self.added_servers.append(new_server_process)
+                ranges = self._change_ring(lambda ring: ring.add_node(new_server_node, weight))
+            return jsonify({'message': f"new server added to port {new_server_node}, "
+                                       f"moving the keys of {len(ranges)} hash ranges to it"}), 200
 
+        # take a kv store out of the ring, move its keys to their new owners and shut it down
+        # when they have all moved; the progress is reported by /rebalance_status
         @self.app.route('/remove_server', methods=['POST'])
         def remove_server():
             port = request.args.get('port')
             port = int(port) if port is not None else 0
-            server_to_remove = None
-            for kv_server in self.kv_server_instances:
-                if (int(kv_server.port) == int(port) if port is not None else False):
-                    server_to_remove = kv_server 
-                    break
-            
-            if server_to_remove is None:
-                return jsonify({'message': f"something went wrong1, server at {port} doesn't exist"}), 400
-            
-            # the try/except blocks are for testing
-            try:
-                self.HashRing.remove_node(str(port))
-                data_from_server =  server_to_remove.server_kv_store
-                example_key = next(iter(data_from_server))
-                next_server_port = self.HashRing.get_node(example_key)
-                for kv_server in self.kv_server_instances:
-                    if (int(kv_server.port) == int(next_server_port)):
-                        next_server = kv_server 
-                        next_server.migrate_data_from_another_storage(server_to_remove)
-                        break
-            except Exception as e:
-                print(f"Error removing a server node: {e}")
-            
-            try:
-                response = requests.post(f"http://127.0.0.1:{port}/shutdown")
-                if response.status_code == 200:
-                    print(f"Server on port {port} is shutting down.")
-                    return jsonify({'message': f"server at port {port} has been removed"}), 200
-                else:
-                    return jsonify({'message': f"something went wrong2"}), 400
-            except requests.exceptions.RequestException as e:
-                print(f"Error shutting down server on port {server_to_remove}: {e}")
-                return jsonify({'message': f"something went wrong3"}), 400
+            with self.topology_lock:
+                self._sync_ring()
+                if str(port) not in self.HashRing.nodes:
+                    return jsonify({'message': f"something went wrong1, server at {port} doesn't exist"}), 400
+                if len(self.HashRing.nodes) == 1:
+                    return jsonify({'message': f"server at port {port} is the last server"}), 400
+                if self.rebalancer.running:
+                    return jsonify({'message': "keys from the last topology change are still moving"}), 409
+                ranges = self._change_ring(lambda ring: ring.remove_node(str(port)), self._finish_removal(port))
+            return jsonify({'message': f"server at port {port} has been removed from the ring, "
+                                       f"moving the keys of {len(ranges)} hash ranges away from it"}), 200
+        
+        @self.app.route('/rebalance_status', methods=['GET'])
+        def rebalance_status():
+            return jsonify(self.rebalancer.status()), 200
+                        
+        @self.app.route('/cache_stats', methods=['GET'])
+        def cache_stats():
+            if self.cache is None:
+                return jsonify({'enabled': False}), 200
+            return jsonify(self.cache.stats()), 200
+                        
+        @self.app.route('/pool_stats', methods=['GET'])
+        def pool_stats():
+            return jsonify(self.pool.stats()), 200
+                        
+        @self.app.route('/health_status', methods=['GET'])
+        def health_status():
+            if self.health is None:
+                return jsonify({'enabled': False}), 200
+            return jsonify(self.health.status()), 200
+                        
+        @self.app.route('/metrics', methods=['GET'])
+        def metrics():
+            return Response(self.metrics.render(), content_type=CONTENT_TYPE)
                         
                         
         self.app.add_url_rule('/put', view_func=put_value, methods=['PUT'])
         self.app.add_url_rule('/get', view_func=get_value, methods=['GET'])
-        self.app.add_url_rule('/del', view_func=del_value, methods=['DEL'])
+        self.app.add_url_rule('/del', view_func=del_value, methods=['DEL', 'DELETE'])
+        self.app.add_url_rule('/mput', view_func=mput_values, methods=['PUT'])
+        self.app.add_url_rule('/mget', view_func=mget_values, methods=['POST'])
+        self.app.add_url_rule('/mdel', view_func=mdel_values, methods=['DEL', 'DELETE'])
+        self.app.add_url_rule('/scan', view_func=scan_values, methods=['GET'])
         self.app.add_url_rule('/add_server', view_func=add_server, methods=['POST'])
         self.app.add_url_rule('/remove_server', view_func=remove_server, methods=['POST'])
+        self.app.add_url_rule('/rebalance_status', view_func=rebalance_status, methods=['GET'])
+        self.app.add_url_rule('/cache_stats', view_func=cache_stats, methods=['GET'])
+        self.app.add_url_rule('/pool_stats', view_func=pool_stats, methods=['GET'])
+        self.app.add_url_rule('/health_status', view_func=health_status, methods=['GET'])
+        self.app.add_url_rule('/metrics', view_func=metrics, methods=['GET'])
         
     
     # run the main server and clean up newly added kv store servers after shutdowm
     def run_server(self):
-        print("The distributor is running")
+        print("The distributor is running" if self.shared is None else f"Distributor worker {os.getpid()} is running")
         self.routes()
-        self.app.run(threaded=True, host='127.0.0.1', port=5000)
+        if self.health is not None:
+            self.health.start()
+        if self.binary_offset:
+            frontend = BinaryFrontend(self, self.binary_offset, self.pool.connect_timeout, self.pool.read_timeout)
+            BinaryServer(frontend.handle, port=5000 + self.binary_offset,
+                         reuse_port=self.shared is not None).start_in_thread()
+        if self.shared is None:
+            self.app.run(threaded=True, host='127.0.0.1', port=5000)
+        else:
+            # every worker listens on port 5000 with its own socket
+            sock = reuse_port_socket('127.0.0.1', 5000)
+            make_server('127.0.0.1', 5000, self.app, threaded=True, fd=sock.fileno()).serve_forever()
         for server in self.added_servers:
             server.join()
      
 # a function to create a new instance of kv store server
-def create_server(port):
+def create_server(port, **store_options):
     server_name = f'MyKVServer{port}'
     storage_name = f'storage{port}.json'
-    kv_store = MyKVStore(server_name, storage_name, port)
+    kv_store = MyKVStore(server_name, storage_name, port, **store_options)
     return kv_store
 
 # a function to run a server in a seperate process
@@ -325,6 +1763,93 @@ def start_server(kv_store):
         
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the kv store servers and the distributor")
+    parser.add_argument('--mode', choices=['flask', 'async'], default='flask',
+                        help="distributor engine: threaded Flask (default) or asyncio")
+    parser.add_argument('--python-http-parser', action='store_true',
+                        help="async mode: use aiohttp's pure Python HTTP parser, which accepts the DEL method "
+                             "of older clients but is slower")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="distributor processes sharing port 5000, each with a copy of the ring")
+    parser.add_argument('--pool-size', type=int, default=32,
+                        help="maximum number of keep-alive connections per kv store")
+    parser.add_argument('--connect-timeout', type=float, default=1.0)
+    parser.add_argument('--read-timeout', type=float, default=5.0)
+    parser.add_argument('--health-interval', type=float, default=0,
+                        help="seconds between two pings of every kv store, 0 (default) disables health "
+                             "checking; use it with --replicas above 1")
+    parser.add_argument('--health-timeout', type=float, default=0.5, help="timeout of a health check ping")
+    parser.add_argument('--failure-threshold', type=int, default=3,
+                        help="consecutive failed requests or pings that take a kv store out of the routing")
+    parser.add_argument('--breaker-reset', type=float, default=5.0,
+                        help="seconds before a kv store taken out of the routing is pinged again")
+    parser.add_argument('--fsync', choices=['always', 'batched', 'interval'], default='interval',
+                        help="when the kv stores fsync their append-only log")
+    parser.add_argument('--compact-mb', type=int, default=16,
+                        help="log size (in MB) that triggers a compaction into a snapshot")
+    parser.add_argument('--rebalance-chunk', type=int, default=500,
+                        help="number of keys moved per request when servers are added or removed")
+    parser.add_argument('--rebalance-rate-mb', type=float, default=5,
+                        help="rate limit (in MB/s) for moving keys, 0 for unlimited")
+    parser.add_argument('--replicas', type=int, default=1, help="number of kv stores holding each key")
+    parser.add_argument('--read-quorum', type=int, default=1,
+                        help="replicas that must answer a read; 1 reads from the fastest replica")
+    parser.add_argument('--write-quorum', type=int, default=1, help="replicas that must acknowledge a write")
+    parser.add_argument('--weights', nargs='*', default=[], metavar='PORT=WEIGHT',
+                        help="relative capacity of kv stores, which get a proportional share of the keys")
+    parser.add_argument('--bounded-load', type=float, default=0, metavar='EPSILON',
+                        help="route reads to replicas with at most (1 + EPSILON) times the average "
+                             "in-flight requests, 0 disables it")
+    parser.add_argument('--cache-entries', type=int, default=0,
+                        help="size of the distributor's hot key cache, 0 disables it")
+    parser.add_argument('--cache-mb', type=int, default=64, help="maximum size (in MB) of the cached keys and values")
+    parser.add_argument('--cache-ttl', type=float, default=0, help="seconds a cached value may be served, 0 for no expiry")
+    parser.add_argument('--cache-policy', choices=sorted(POLICIES), default='tinylfu')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='sharded',
+                        help="in-memory storage engine of the kv stores")
+    parser.add_argument('--max-memory-mb', type=float, default=0,
+                        help="compact engine: memory limit of the in-memory entries of each kv store, 0 for none")
+    parser.add_argument('--eviction', choices=['lru', 'lfu'], default='lru',
+                        help="compact engine: which copies of snapshot values to evict at the memory limit")
+    parser.add_argument('--compress-min', type=int, default=256,
+                        help="compact engine: zlib-compress values of at least this many bytes, 0 disables it")
+    parser.add_argument('--binary-offset', type=int, default=0,
+                        help="also serve the binary protocol on every HTTP port + this offset, 0 disables it")
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO')
+    parser.add_argument('--log-sample', type=float, default=0.01,
+                        help="fraction of the requests that are logged (at DEBUG, or WARNING for server errors)")
+    args = parser.parse_args()
+    try:
+        weights = {port: MyDistributor._parse_weight(weight) for port, weight in (item.split('=') for item in args.weights)}
+    except ValueError:
+        parser.error("--weights takes PORT=WEIGHT pairs with positive weights")
+    if args.workers > 1 and args.cache_entries > 0 and args.cache_ttl <= 0:
+        # a worker's cache is not invalidated by the writes going through the other workers
+        parser.error("the hot key cache needs a --cache-ttl with more than one worker")
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    # the Flask development server logs every request, the sampled request log replaces it
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    engine_options = {}
+    if args.engine == 'compact':
+        engine_options = {'max_bytes': int(args.max_memory_mb * 1024 * 1024), 'eviction': args.eviction,
+                          'compress_min': args.compress_min}
+    elif args.max_memory_mb:
+        parser.error("--max-memory-mb needs --engine compact")
+    store_options = {'fsync_policy': args.fsync, 'compact_bytes': args.compact_mb * 1024 * 1024,
+                     'engine': args.engine, 'log_sample': args.log_sample, 'binary_offset': args.binary_offset,
+                     'engine_options': engine_options}
+    replication = {'replicas': args.replicas, 'read_quorum': args.read_quorum, 'write_quorum': args.write_quorum,
+                   'bounded_load': args.bounded_load}
+    health_options = None
+    if args.health_interval > 0:
+        health_options = {'interval': args.health_interval, 'timeout': args.health_timeout,
+                          'failure_threshold': args.failure_threshold, 'reset_timeout': args.breaker_reset}
+    cache = None
+    if args.cache_entries > 0:
+        cache = HotKeyCache(max_entries=args.cache_entries, max_bytes=args.cache_mb * 1024 * 1024,
+                            ttl=args.cache_ttl, policy=args.cache_policy)
+    rebalance_options = {'chunk_size': args.rebalance_chunk, 'rate_limit': int(args.rebalance_rate_mb * 1024 * 1024)}
+    
     nodes = [] 
     port_number_tracker = 1
     number_of_servers = 5
@@ -332,15 +1857,34 @@ if __name__ == '__main__':
     while port_number_tracker <= number_of_servers:
         nodes.append(f"500{port_number_tracker}")    
         port_number_tracker += 1    
-    ring = HashRing(nodes, vnodes=100)
+    ring = HashRing(nodes, vnodes=100, weights=weights)
     
-    servers = [create_server(node) for node in nodes]
+    servers = [create_server(node, **store_options) for node in nodes]
     servers_process = [
         Process(target=start_server, args=(server, )) for server in servers
     ]
         
-    myDistributor = MyDistributor(ring, port_number_tracker, servers)
-    servers_process.append(Process(target=myDistributor.run_server))
+    shared = SharedRingState() if args.workers > 1 else None
+    for _ in range(args.workers):
+        if args.mode == 'async':
+            if args.python_http_parser:
+                # read by aiohttp when it is first imported
+                os.environ['AIOHTTP_NO_EXTENSIONS'] = '1'
+            from myAsyncDistributor import MyAsyncDistributor
+            myDistributor = MyAsyncDistributor(ring, port_number_tracker, servers, pool_size=args.pool_size,
+                                               connect_timeout=args.connect_timeout, read_timeout=args.read_timeout,
+                                               store_options=store_options, rebalance_options=rebalance_options,
+                                               cache=cache, log_sample=args.log_sample,
+                                               binary_offset=args.binary_offset, shared=shared,
+                                               health_options=health_options, **replication)
+        else:
+            pool = ConnectionPool(max_size=args.pool_size, connect_timeout=args.connect_timeout,
+                                  read_timeout=args.read_timeout)
+            myDistributor = MyDistributor(ring, port_number_tracker, servers, pool=pool, store_options=store_options,
+                                          rebalance_options=rebalance_options, cache=cache, log_sample=args.log_sample,
+                                          binary_offset=args.binary_offset, shared=shared,
+                                          health_options=health_options, **replication)
+        servers_process.append(Process(target=myDistributor.run_server))
     
     # Start all servers
     for server in servers_process:
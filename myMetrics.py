@@ -0,0 +1,164 @@
+import bisect
+import logging
+import random
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# request latency buckets in seconds, from 100 microseconds to 10 seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# buckets for slow background work such as compactions
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    A monotonically increasing count per combination of label values.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = dict()
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in sorted(values):
+            yield self.name + _format_labels(self.labels, label_values), value
+
+
+class Histogram:
+    """
+    Observations counted into fixed buckets per combination of label values, reported
+    as cumulative Prometheus buckets with their sum and count. Observing costs one
+    binary search and one lock.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = dict()
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                # one count per bucket, then +Inf, the sum and the total count
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def samples(self):
+        with self.lock:
+            values = [(label_values, list(counts)) for label_values, counts in self.values.items()]
+        bounds = [_format_value(bound) for bound in self.buckets] + ['+Inf']
+        for label_values, counts in sorted(values):
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                yield self.name + '_bucket' + _format_labels(self.labels, label_values, f'le="{bound}"'), cumulative
+            yield self.name + '_sum' + _format_labels(self.labels, label_values), counts[-2]
+            yield self.name + '_count' + _format_labels(self.labels, label_values), counts[-1]
+
+
+class Gauge:
+    """
+    A value read when the metrics are scraped: read() returns a number, or a dict from
+    tuples of label values to numbers. kind='counter' reports a total that is counted
+    elsewhere (such as the cache hits) as a counter.
+    """
+    def __init__(self, name, help, read, labels=(), kind='gauge'):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.labels = tuple(labels)
+        self.kind = kind
+
+    def samples(self):
+        values = self.read()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in sorted(values.items()):
+            yield self.name + _format_labels(self.labels, label_values), value
+
+
+class Registry:
+    """
+    The metrics of one server process, rendered in the Prometheus text format by render().
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, read, labels=(), kind='gauge'):
+        return self.register(Gauge(name, help, read, labels, kind))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for sample, value in metric.samples():
+                lines.append(f"{sample} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+class RequestMetrics:
+    """
+    Request counts (by route and status) and latency histograms (by route) of one server,
+    named {prefix}_requests_total and {prefix}_request_duration_seconds, plus a request
+    log that is cheap enough for the hot path: a request is only logged with probability
+    log_sample, at DEBUG level, or WARNING if it failed with a server error.
+    Routes are the URL rules, not the URLs, so keys never become label values.
+    """
+    def __init__(self, registry, prefix, logger, log_sample=0.0):
+        self.requests = registry.counter(f"{prefix}_requests_total", "Requests served by route and status",
+                                         ('route', 'status'))
+        self.latency = registry.histogram(f"{prefix}_request_duration_seconds", "Request latency by route",
+                                          ('route',))
+        self.logger = logger
+        self.log_sample = log_sample
+
+    def observe(self, route, method, status, seconds):
+        self.requests.inc(route, str(status))
+        self.latency.observe(seconds, route)
+        if self.log_sample and random.random() < self.log_sample:
+            level = logging.WARNING if status >= 500 else logging.DEBUG
+            if self.logger.isEnabledFor(level):
+                self.logger.log(level, "%s %s answered %d in %.3f ms", method, route, status, seconds * 1000)
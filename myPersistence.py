@@ -0,0 +1,609 @@
+import glob
+import heapq
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from myExpiry import TimerWheel
+from myStorage import DictEngine
+
+# record types of the append-only log
+OP_PUT = 1
+OP_DEL = 2
+OP_EXPIRE = 3
+
+# every record is framed as: payload length, crc32 of the payload, payload,
+# and the payload is: record type, key length, key, value (empty for OP_DEL, the expiry
+# time in seconds since the epoch for OP_EXPIRE, which follows the OP_PUT of its key)
+_FRAME = struct.Struct('>II')
+_PAYLOAD = struct.Struct('>BI')
+
+FSYNC_POLICIES = ('always', 'batched', 'interval')
+
+# a snapshot file is: header, data region (key and value bytes of every entry,
+# back to back), index (one fixed size entry per key, sorted by key), expiry table (the
+# index position and expiry time of every key that has one). Version 1 files have no
+# expiry table and a shorter header
+_SNAPSHOT_MAGIC_V1 = b'CHSNAP01'
+_SNAPSHOT_MAGIC = b'CHSNAP02'
+_SNAPSHOT_HEADER_V1 = struct.Struct('>8sQQ')  # magic, number of keys, index offset
+_SNAPSHOT_HEADER = struct.Struct('>8sQQQ')    # magic, number of keys, index offset, expiring keys
+_INDEX_ENTRY = struct.Struct('>QII')          # data offset, key length, value length
+_EXPIRY_ENTRY = struct.Struct('>Qd')          # index position, expiry time
+_WRITE_CHUNK = 1024 * 1024
+
+
+def encode_record(op, key, value=''):
+    key_bytes = key.encode('utf-8')
+    payload = _PAYLOAD.pack(op, len(key_bytes)) + key_bytes + value.encode('utf-8')
+    return _FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def iter_records(data):
+    """
+    Decode the records of a log segment. Yields (op, key, value, end_offset) and stops
+    at the first incomplete or corrupted record, which is what a crash in the middle
+    of an append leaves behind.
+    """
+    view = memoryview(data)
+    unpack_frame = _FRAME.unpack_from
+    unpack_payload = _PAYLOAD.unpack_from
+    crc32 = zlib.crc32
+    header_size = _FRAME.size
+    payload_header_size = _PAYLOAD.size
+    offset = 0
+    size = len(data)
+    while offset + header_size <= size:
+        length, checksum = unpack_frame(data, offset)
+        start = offset + header_size
+        end = start + length
+        if end > size or length < payload_header_size or crc32(view[start:end]) != checksum:
+            return
+        op, key_length = unpack_payload(data, start)
+        key_start = start + payload_header_size
+        key_end = key_start + key_length
+        yield op, str(view[key_start:key_end], 'utf-8'), str(view[key_end:end], 'utf-8'), end
+        offset = end
+
+
+class AppendOnlyLog:
+    """
+    A write-ahead log of PUT/DEL records for one MyKVStore, written as numbered segments
+    {base}.log.1, {base}.log.2, ... Records are appended to the newest segment; rotate()
+    starts a new segment so that the older ones can be deleted once a snapshot covering
+    them has been written.
+
+    fsync: 'always'   fsync after every append (no acknowledged write is ever lost)
+           'batched'  fsync once batch_size records have been appended since the last one
+           'interval' fsync every interval seconds from a background thread
+    With 'batched' the background thread also syncs leftover records every interval
+    seconds. Every append reaches the OS immediately, so only a machine crash (not a
+    process crash) can lose the records written since the last fsync.
+    """
+    def __init__(self, base, fsync='interval', batch_size=64, interval=1.0):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync policy must be one of {FSYNC_POLICIES}, not {fsync}")
+        self.base = base
+        self.fsync = fsync
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.file = None
+        self.segment = 0
+        self.unsynced = 0
+        self._closed = threading.Event()
+
+    def segments(self):
+        """
+        The existing segment numbers in ascending order
+        """
+        numbers = []
+        for path in glob.glob(glob.escape(self.base) + '.log.*'):
+            suffix = path.rsplit('.', 1)[1]
+            if suffix.isdigit():
+                numbers.append(int(suffix))
+        return sorted(numbers)
+
+    def segment_path(self, number):
+        return f"{self.base}.log.{number}"
+
+    def replay(self, apply):
+        """
+        Replay every existing segment in order, calling apply(op, key, value) per record.
+        A torn record at the end of a segment is cut off. Returns the number of records.
+        """
+        count = 0
+        for number in self.segments():
+            path = self.segment_path(number)
+            with open(path, 'rb') as file:
+                data = file.read()
+            good_end = 0
+            for op, key, value, end in iter_records(data):
+                apply(op, key, value)
+                good_end = end
+                count += 1
+            if good_end < len(data):
+                print(f"Truncating {len(data) - good_end} bytes of a torn record from {path}")
+                with open(path, 'r+b') as file:
+                    file.truncate(good_end)
+        return count
+
+    # open a new segment after the existing ones and start the background sync thread
+    def open(self):
+        existing = self.segments()
+        self.segment = existing[-1] + 1 if existing else 1
+        self.file = open(self.segment_path(self.segment), 'ab', buffering=0)
+        if self.fsync != 'always':
+            threading.Thread(target=self._sync_periodically, daemon=True).start()
+
+    def _sync_periodically(self):
+        while not self._closed.wait(self.interval):
+            with self.lock:
+                if self.unsynced:
+                    self._sync()
+
+    def _sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def _write(self, data, records):
+        with self.lock:
+            self.file.write(data)
+            self.unsynced += records
+            if self.fsync == 'always' or (self.fsync == 'batched' and self.unsynced >= self.batch_size):
+                self._sync()
+
+    # a put with an expiry time is written as two records in one write call
+    def append_put(self, key, value, expires_at=None):
+        if expires_at is None:
+            self._write(encode_record(OP_PUT, key, value), 1)
+        else:
+            self._write(encode_record(OP_PUT, key, value) + encode_record(OP_EXPIRE, key, repr(expires_at)), 2)
+
+    def append_delete(self, key):
+        self._write(encode_record(OP_DEL, key), 1)
+
+    # a whole batch is written with a single write call (and at most one fsync);
+    # expires holds the expiry times of the keys that have one
+    def append_puts(self, items, expires=None):
+        if not items:
+            return
+        records = [encode_record(OP_PUT, key, value) for key, value in items.items()]
+        if expires:
+            records += [encode_record(OP_EXPIRE, key, repr(expires_at)) for key, expires_at in expires.items()]
+        self._write(b''.join(records), len(records))
+
+    def append_deletes(self, keys):
+        if keys:
+            self._write(b''.join(encode_record(OP_DEL, key) for key in keys), len(keys))
+
+    def rotate(self):
+        """
+        Sync and close the current segment and continue in a new one. Returns the
+        numbers of the segments that are now closed.
+        """
+        with self.lock:
+            self._sync()
+            self.file.close()
+            closed = [number for number in self.segments() if number <= self.segment]
+            self.segment += 1
+            self.file = open(self.segment_path(self.segment), 'ab', buffering=0)
+        return closed
+
+    # total size of the log on disk
+    def size(self):
+        total = 0
+        for number in self.segments():
+            try:
+                total += os.path.getsize(self.segment_path(number))
+            except FileNotFoundError:
+                pass
+        return total
+
+    def remove_segments(self, numbers):
+        for number in numbers:
+            try:
+                os.remove(self.segment_path(number))
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        self._closed.set()
+        with self.lock:
+            if self.file is not None:
+                self._sync()
+                self.file.close()
+                self.file = None
+
+
+def write_file_atomically(path, write):
+    """
+    Write a file through a temporary file and rename it over path, so a crash never
+    leaves a half written file behind. write(file) fills the open binary file.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as file:
+        write(file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+
+def write_snapshot(path, items, deadlines=None):
+    """
+    Write a snapshot file from (key bytes, value bytes) pairs given in ascending key order.
+    deadlines maps the key bytes of the keys that expire to their expiry times.
+    """
+    # the data is written in large chunks: every write releases the GIL, and a thread that
+    # gives up the GIL thousands of times is starved by threads serving requests
+    def write(file):
+        file.write(bytes(_SNAPSHOT_HEADER.size))
+        index = bytearray()
+        chunk = bytearray()
+        pack_entry = _INDEX_ENTRY.pack
+        offset = _SNAPSHOT_HEADER.size
+        expiry = bytearray()
+        pack_expiry = _EXPIRY_ENTRY.pack
+        count = 0
+        for key, value in items:
+            if deadlines and key in deadlines:
+                expiry += pack_expiry(count, deadlines[key])
+            chunk += key
+            chunk += value
+            index += pack_entry(offset, len(key), len(value))
+            offset += len(key) + len(value)
+            count += 1
+            if len(chunk) >= _WRITE_CHUNK:
+                file.write(chunk)
+                chunk.clear()
+        file.write(chunk)
+        file.write(index)
+        file.write(expiry)
+        file.seek(0)
+        file.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, count, offset, len(expiry) // _EXPIRY_ENTRY.size))
+    write_file_atomically(path, write)
+
+
+class MappedSnapshot:
+    """
+    A read-only snapshot file mapped into memory. Opening it only maps the file, so the
+    cost does not depend on the number of keys; lookups binary search the sorted index
+    and read the key and value straight from the mapping.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic = self.map[:len(_SNAPSHOT_MAGIC)]
+        if magic == _SNAPSHOT_MAGIC:
+            _, self.count, self.index_offset, self.expiring = _SNAPSHOT_HEADER.unpack_from(self.map, 0)
+        elif magic == _SNAPSHOT_MAGIC_V1:
+            _, self.count, self.index_offset = _SNAPSHOT_HEADER_V1.unpack_from(self.map, 0)
+            self.expiring = 0
+        else:
+            raise ValueError(f"{path} is not a snapshot file")
+
+    def __len__(self):
+        return self.count
+
+    def _entry(self, position):
+        return _INDEX_ENTRY.unpack_from(self.map, self.index_offset + position * _INDEX_ENTRY.size)
+
+    def get(self, key):
+        target = key.encode('utf-8')
+        data = self.map
+        entry = self._entry
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            offset, key_length, value_length = entry(middle)
+            found = data[offset:offset + key_length]
+            if found < target:
+                low = middle + 1
+            elif found > target:
+                high = middle
+            else:
+                start = offset + key_length
+                return data[start:start + value_length].decode('utf-8')
+        return None
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def iter_from(self, start):
+        """
+        The (key bytes, value bytes) pairs with keys from start (bytes) on, in ascending order
+        """
+        data = self.map
+        entry = self._entry
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            offset, key_length, _ = entry(middle)
+            if data[offset:offset + key_length] < start:
+                low = middle + 1
+            else:
+                high = middle
+        for position in range(low, self.count):
+            offset, key_length, value_length = entry(position)
+            key_end = offset + key_length
+            yield data[offset:key_end], data[key_end:key_end + value_length]
+
+    def iter_expiry(self):
+        """
+        The (key, expiry time) of every key that expires
+        """
+        data = self.map
+        start = self.index_offset + self.count * _INDEX_ENTRY.size
+        for position, expires_at in _EXPIRY_ENTRY.iter_unpack(data[start:start + self.expiring * _EXPIRY_ENTRY.size]):
+            offset, key_length, _ = self._entry(position)
+            yield data[offset:offset + key_length].decode('utf-8'), expires_at
+
+    def iter_raw(self):
+        """
+        All (key bytes, value bytes) pairs in ascending key order
+        """
+        data = self.map
+        for offset, key_length, value_length in _INDEX_ENTRY.iter_unpack(
+                data[self.index_offset:self.index_offset + self.count * _INDEX_ENTRY.size]):
+            key_end = offset + key_length
+            yield data[offset:key_end], data[key_end:key_end + value_length]
+
+
+class _Tombstone:
+    """
+    The memtable value of a key deleted since the snapshot was written
+    """
+    def __repr__(self):
+        return 'TOMBSTONE'
+
+
+TOMBSTONE = _Tombstone()
+
+
+class LayeredStore:
+    """
+    The key-value store of a MyKVStore: an in-memory map layered over a MappedSnapshot.
+    It behaves like a dict of str keys and values.
+
+    self.memtable: a storage engine (myStorage) holding the values changed since the snapshot
+                   was written, TOMBSTONE for keys deleted since, and hot keys that were read
+                   from the snapshot and promoted into memory. Every change of a key is
+                   applied with the engine's compute(), which only locks that key's shard
+    self.snapshot: the current MappedSnapshot, or None. It is only replaced while all
+                   shards of the memtable are locked
+    self._counts: the change of the number of keys, per memtable shard. Range scans merge
+                  the sorted keys of the memtable (its keys_from(), which leaves out the
+                  promoted keys) with the sorted keys of the snapshot
+    self.expiry: the expiry times of the keys that have one (TimerWheel). A key is hidden
+                 from reads once its time has passed; the MyKVStore deletes it for good when
+                 the wheel reports it due. A key's expiry time changes together with its
+                 value, under the lock of its memtable shard
+    """
+    def __init__(self, engine=None):
+        self.memtable = engine if engine is not None else DictEngine()
+        self.snapshot = None
+        self._base_count = 0
+        self._counts = [0] * self.memtable.shard_count
+        self.expiry = TimerWheel()
+
+    def open_snapshot(self, path):
+        self.snapshot = MappedSnapshot(path)
+        self._base_count = len(self.snapshot)
+        for key, expires_at in self.snapshot.iter_expiry():
+            self.expiry.schedule(key, expires_at)
+
+    # the expiry time of a key, or None if it has none
+    def expires_at(self, key):
+        return self.expiry.deadlines.get(key)
+
+    # give a key an expiry time, as read from the log
+    def set_expiry(self, key, expires_at):
+        self.expiry.schedule(key, expires_at)
+
+    def _in_snapshot(self, key):
+        return self.snapshot is not None and key in self.snapshot
+
+    def get(self, key, default=None):
+        if self.expiry.deadlines and self.expiry.expired(key, time.time()):
+            return default
+        value = self.memtable.get(key)
+        if value is not None:
+            return default if value is TOMBSTONE else value
+        snapshot = self.snapshot
+        if snapshot is None:
+            return default
+        value = snapshot.get(key)
+        if value is None:
+            return default
+
+        # promote the key unless it was changed or the snapshot replaced in the meantime
+        def promote(current):
+            if current is not None:
+                return current, current
+            if self.snapshot is snapshot:
+                return value, value
+            return None, value
+        value = self.memtable.compute(key, promote, evictable=True)
+        return default if value is TOMBSTONE else value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    # store a value that expires at expires_at, or never if it is None
+    def put(self, key, value, expires_at=None):
+        def store(current):
+            if current is TOMBSTONE or (current is None and not self._in_snapshot(key)):
+                self._counts[self.memtable.shard_index(key)] += 1
+            if expires_at is not None:
+                self.expiry.schedule(key, expires_at)
+            elif key in self.expiry.deadlines:
+                self.expiry.cancel(key)
+            return value, None
+        self.memtable.compute(key, store)
+
+    def update(self, items):
+        for key, value in items.items():
+            self[key] = value
+
+    def pop(self, key, default=None):
+        def remove(current):
+            if key in self.expiry.deadlines:
+                self.expiry.cancel(key)
+            if current is TOMBSTONE:
+                return current, None
+            snapshot_value = self.snapshot.get(key) if self.snapshot is not None else None
+            if current is None and snapshot_value is None:
+                return None, None
+            self._counts[self.memtable.shard_index(key)] -= 1
+            new = TOMBSTONE if snapshot_value is not None else None
+            return new, current if current is not None else snapshot_value
+        value = self.memtable.compute(key, remove)
+        return default if value is None else value
+
+    def __delitem__(self, key):
+        if self.pop(key) is None:
+            raise KeyError(key)
+
+    def __len__(self):
+        return self._base_count + sum(self._counts)
+
+    def _freeze(self):
+        with self.memtable.locked():
+            return self.memtable.freeze(), self.snapshot
+
+    # like _freeze, with a copy of the expiry times taken at the same point
+    def _freeze_with_expiry(self):
+        with self.memtable.locked():
+            return self.memtable.freeze(), self.snapshot, self.expiry.copy()
+
+    def items(self):
+        """
+        Iterate over a point-in-time view of all (key, value) pairs
+        """
+        memtable, snapshot = self._freeze()
+        now = time.time()
+        expired = self.expiry.expired
+        for key, value in memtable.items():
+            if value is not TOMBSTONE and not expired(key, now):
+                yield key, value
+        if snapshot is not None:
+            for key, value in snapshot.iter_raw():
+                key = key.decode('utf-8')
+                if key not in memtable and not expired(key, now):
+                    yield key, value.decode('utf-8')
+
+    def __iter__(self):
+        return (key for key, _ in self.items())
+
+    def scan(self, prefix='', start='', limit=100):
+        """
+        Up to limit (key, value) pairs with keys starting with prefix, in ascending key
+        order from start on (included), and the key the next page starts at (None after
+        the last page). The written keys of the memtable and the snapshot are merged as they
+        are read, so a page costs O(limit) however many keys come after it. A scan is not
+        a point-in-time view: a change made while it runs may or may not be seen.
+        """
+        start = max(start, prefix)
+        snapshot = self.snapshot
+        written = ((key, None) for key in self.memtable.keys_from(start))
+        stored = ()
+        if snapshot is not None:
+            stored = ((key.decode('utf-8'), value) for key, value in snapshot.iter_from(start.encode('utf-8')))
+        items = []
+        last = None
+        now = time.time()
+        for key, raw in heapq.merge(written, stored, key=lambda pair: pair[0]):
+            if not key.startswith(prefix):
+                break
+            if key == last:
+                continue
+            last = key
+            if self.expiry.expired(key, now):
+                continue
+            # a snapshot value without a newer one in memory is read from the mapping, so a
+            # scan does not promote the keys it passes
+            value = self.memtable.get(key)
+            if value is None:
+                if raw is not None and self.snapshot is snapshot:
+                    value = raw.decode('utf-8')
+                elif self.snapshot is not None:
+                    value = self.snapshot.get(key)
+            if value is None or value is TOMBSTONE:
+                continue
+            if len(items) == limit:
+                return items, key
+            items.append((key, value))
+        return items, None
+
+    def keys(self):
+        return iter(self)
+
+    def write_snapshot(self, path):
+        """
+        Merge the current snapshot with the in-memory changes into a new snapshot file at
+        path and switch to it. Changes made while the file is written stay in memory.
+        """
+        memtable, snapshot, deadlines = self._freeze_with_expiry()
+        deadlines = {key.encode('utf-8'): expires_at for key, expires_at in deadlines.items()}
+        changes = []
+        removed = set()
+        for key, value in memtable.items():
+            if value is TOMBSTONE:
+                removed.add(key.encode('utf-8'))
+            else:
+                changes.append((key.encode('utf-8'), value.encode('utf-8')))
+        changes.sort()
+        old_entries = snapshot.iter_raw() if snapshot is not None else iter(())
+        write_snapshot(path, _merge_sorted(old_entries, changes, removed), deadlines)
+        new_snapshot = MappedSnapshot(path)
+        with self.memtable.locked():
+            # entries (and tombstones) that are unchanged since the freeze are now part of
+            # the new snapshot, and entries deleted since need a tombstone to hide them in it.
+            # The old mapping is not closed: lookups that started before the swap may
+            # still be reading it, and it is released with its last reference.
+            self.snapshot = new_snapshot
+            for key, value in memtable.items():
+                if self.memtable.unchanged_locked(memtable, key, value):
+                    self.memtable.remove_locked(key)
+                elif self.memtable.get(key) is None:
+                    self.memtable.put_locked(key, TOMBSTONE)
+
+
+def _merge_sorted(old_entries, changes, removed):
+    """
+    Merge sorted snapshot entries with sorted changed entries (which win on equal keys),
+    leaving out removed keys
+    """
+    changes = iter(changes)
+    change = next(changes, None)
+    for key, value in old_entries:
+        while change is not None and change[0] < key:
+            yield change
+            change = next(changes, None)
+        if change is not None and change[0] == key:
+            yield change
+            change = next(changes, None)
+        elif key not in removed:
+            yield key, value
+    while change is not None:
+        yield change
+        change = next(changes, None)
@@ -0,0 +1,288 @@
+import bisect
+import json
+import queue
+import threading
+import time
+
+from myConnectionPool import ConnectionPoolError
+
+
+class RebalanceInProgress(Exception):
+    """
+    Raised when a topology change is requested while keys are still being moved.
+    """
+
+
+class TokenBucket:
+    """
+    Limits a stream to rate bytes per second (0 means unlimited), allowing bursts of
+    up to one second worth of bytes.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+
+    def consume(self, amount):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= amount
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.rate)
+
+
+class RangeSet:
+    """
+    A set of [start, end) ranges of the 128 bit hash space with a binary search
+    membership test. In JSON the bounds are hex strings, since they do not fit in a double.
+    """
+    def __init__(self, ranges):
+        ranges = sorted(ranges)
+        self.starts = [start for start, _ in ranges]
+        self.ends = [end for _, end in ranges]
+
+    def __contains__(self, hash_val):
+        index = bisect.bisect(self.starts, hash_val) - 1
+        return index >= 0 and hash_val < self.ends[index]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def to_json(self):
+        return [[format(start, 'x'), format(end, 'x')] for start, end in zip(self.starts, self.ends)]
+
+    @classmethod
+    def from_json(cls, ranges):
+        return cls((int(start, 16), int(end, 16)) for start, end in ranges)
+
+
+class _Move:
+    """
+    The keys of the hash ranges that are copied from the server at port source to target,
+    and then deleted from source if delete_source is set.
+    """
+    def __init__(self, source, target, delete_source, ranges):
+        self.source = source
+        self.target = target
+        self.delete_source = delete_source
+        self.ranges = RangeSet(ranges)
+        self.state = 'pending'
+        self.keys_moved = 0
+        self.bytes_moved = 0
+        self.error = None
+
+    def status(self):
+        return {
+            'source': self.source,
+            'target': self.target,
+            'delete_source': self.delete_source,
+            'ranges': len(self.ranges),
+            'state': self.state,
+            'keys_moved': self.keys_moved,
+            'bytes_moved': self.bytes_moved,
+            'error': self.error,
+        }
+
+
+class Rebalancer:
+    """
+    Moves keys between MyKVStore servers after the distributor's HashRing changed.
+    start() takes the ranges whose replicas changed (HashRing.changed_ranges) and, in a
+    background thread, streams the keys of those ranges out of each old owner (/export),
+    writes them to the new owner in chunks of chunk_size keys (/mput, without overwriting
+    keys the new owner already got from clients) and then deletes them from the old owner
+    (/mdel) unless it still holds a replica. The stream is throttled to rate_limit bytes
+    per second.
+
+    While keys are moving the distributor keeps serving: the ring already routes to the
+    new owners, and previous_owner(key) tells it where to read a key the new owner does
+    not have yet. Keys deleted by clients in the meantime are recorded with
+    record_delete() so a chunk that is already in flight does not bring them back.
+    With several distributor workers, the workers that did not start a move follow() it:
+    previous_owner() answers for its ranges, no key is moved, and the keys deleted
+    through them are sent over the deletes queue to the worker moving the keys.
+    """
+    def __init__(self, pool, hash_key, chunk_size=500, rate_limit=5 * 1024 * 1024, deletes=None):
+        self.pool = pool
+        self.hash_key = hash_key
+        self.chunk_size = chunk_size
+        self.rate_limit = rate_limit
+        self.deletes = deletes
+        self.following = False
+        self.moves = []
+        self.deleted = set()
+        self.state = 'idle'
+        self.started = None
+        self.finished = None
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self.state == 'running'
+
+    @property
+    def succeeded(self):
+        return all(move.state == 'done' for move in self.moves)
+
+    def start(self, changed_ranges, on_done=None):
+        """
+        Start moving the keys of changed_ranges, a list of
+        (start, end, source, target, delete_source).
+        on_done(rebalancer) is called from the background thread once every move finished.
+        """
+        # deletes sent during an earlier move are not about this one
+        self._drain_deletes()
+        with self.lock:
+            if self.running:
+                raise RebalanceInProgress("keys from the last topology change are still moving")
+            self.moves = self._plan(changed_ranges)
+            self.deleted = set()
+            self.following = False
+            self.state = 'running'
+            self.started = time.time()
+            self.finished = None
+        self._thread = threading.Thread(target=self._run, args=(on_done,), daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _plan(changed_ranges):
+        grouped = dict()
+        for start, end, source, target, delete_source in changed_ranges:
+            grouped.setdefault((source, target, delete_source), []).append((start, end))
+        return [_Move(*move, ranges) for move, ranges in grouped.items()]
+
+    def follow(self, changed_ranges):
+        """
+        Track the move of changed_ranges run by another distributor worker, until
+        stop_following() is called with the state it ended in.
+        """
+        with self.lock:
+            self.moves = self._plan(changed_ranges)
+            self.deleted = set()
+            self.following = True
+            self.state = 'running'
+            self.started = time.time()
+            self.finished = None
+
+    def stop_following(self, state):
+        with self.lock:
+            for move in self.moves:
+                move.state = state
+            self.following = False
+            self.state = state
+            self.finished = time.time()
+
+    # add the keys deleted through the other workers to the deleted keys
+    def _drain_deletes(self):
+        if self.deletes is None:
+            return
+        keys = []
+        try:
+            while True:
+                keys.append(self.deletes.get_nowait())
+        except queue.Empty:
+            pass
+        if keys:
+            with self.lock:
+                self.deleted.update(keys)
+
+    def _run(self, on_done):
+        bucket = TokenBucket(self.rate_limit)
+        for move in self.moves:
+            move.state = 'moving'
+            try:
+                self._move(move, bucket)
+                move.state = 'done'
+            except (ConnectionPoolError, ValueError) as e:
+                move.state = 'failed'
+                move.error = str(e)
+                print(f"Moving keys from {move.source} to {move.target} failed: {e}")
+        with self.lock:
+            self.state = 'done' if self.succeeded else 'failed'
+            self.finished = time.time()
+        if on_done is not None:
+            on_done(self)
+
+    def _move(self, move, bucket):
+        lines = self.pool.stream_lines(move.source, 'POST', '/export', json_body={'ranges': move.ranges.to_json()})
+        chunk = dict()
+        expires = dict()
+        chunk_bytes = 0
+        # keys with a ttl come as [key, value, expiry time] and keep it on the target
+        for line in lines:
+            record = json.loads(line)
+            chunk[record[0]] = record[1]
+            if len(record) > 2:
+                expires[record[0]] = record[2]
+            chunk_bytes += len(line)
+            if len(chunk) >= self.chunk_size:
+                bucket.consume(chunk_bytes)
+                self._write_chunk(move, chunk, chunk_bytes, expires)
+                chunk = dict()
+                expires = dict()
+                chunk_bytes = 0
+        if chunk:
+            bucket.consume(chunk_bytes)
+            self._write_chunk(move, chunk, chunk_bytes, expires)
+
+    def _write_chunk(self, move, chunk, chunk_bytes, expires=None):
+        self._drain_deletes()
+        with self.lock:
+            items = {key: value for key, value in chunk.items() if key not in self.deleted}
+        body = {'items': items, 'only_missing': True}
+        if expires:
+            body['expires'] = expires
+        response = self.pool.request(move.target, 'PUT', '/mput', json_body=body)
+        if response.status_code != 200:
+            raise ValueError(f"server at port {move.target} answered {response.status_code}")
+        # a key deleted by a client while this chunk was on its way must not survive on the target
+        self._drain_deletes()
+        with self.lock:
+            resurrected = [key for key in items if key in self.deleted]
+        if resurrected:
+            self.pool.request(move.target, 'DEL', '/mdel', json_body={'keys': resurrected})
+        if move.delete_source:
+            response = self.pool.request(move.source, 'DEL', '/mdel', json_body={'keys': list(chunk)})
+            if response.status_code != 200:
+                raise ValueError(f"server at port {move.source} answered {response.status_code}")
+        move.keys_moved += len(chunk)
+        move.bytes_moved += chunk_bytes
+
+    def previous_owner(self, key):
+        """
+        The server a key is being moved away from, if it is part of a move that has not
+        finished yet, otherwise None
+        """
+        if not self.running:
+            return None
+        hash_val = self.hash_key(key)
+        for move in self.moves:
+            if move.state in ('pending', 'moving') and hash_val in move.ranges:
+                return move.source
+        return None
+
+    def record_delete(self, key):
+        if self.running:
+            if self.following:
+                if self.deletes is not None:
+                    self.deletes.put(key)
+                return
+            with self.lock:
+                self.deleted.add(key)
+
+    def status(self):
+        moves = [move.status() for move in self.moves]
+        end = self.finished or time.time()
+        return {
+            'state': self.state,
+            'elapsed_s': round(end - self.started, 3) if self.started else 0,
+            'moves_done': sum(1 for move in self.moves if move.state == 'done'),
+            'moves_total': len(self.moves),
+            'keys_moved': sum(move['keys_moved'] for move in moves),
+            'bytes_moved': sum(move['bytes_moved'] for move in moves),
+            'moves': moves,
+        }
@@ -0,0 +1,577 @@
+import argparse
+import collections
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from myBenchmark import DISTRIBUTIONS, OPERATIONS, WORKLOADS, Workload, percentile
+from myConnectionPool import BackendResponse, ConnectionPoolError
+from myKVServer import HashRing, LoadTracker, MyDistributor, MyKVStore
+
+MODES = ('ring', 'cluster', 'load')
+# read routings compared in load mode
+LOAD_STRATEGIES = ('ring', 'weighted', 'bounded')
+# the requests of clients, whose spread over the kv stores is the load
+CLIENT_PATHS = ('/get', '/put', '/del')
+
+
+# A trace is a sequence of records, one per line in a trace file, with keys without whitespace:
+#   get KEY / put KEY VALUE_SIZE / del KEY / join NODE WEIGHT / leave NODE
+def read_trace(path):
+    with open(path) as file:
+        for line in file:
+            parts = line.split()
+            if not parts:
+                continue
+            op = parts[0]
+            if op == 'put':
+                yield op, parts[1], int(parts[2])
+            elif op == 'join':
+                yield op, parts[1], float(parts[2]) if len(parts) > 2 else 1.0
+            elif op in ('get', 'del', 'leave'):
+                yield op, parts[1]
+            else:
+                raise ValueError(f"unknown trace record {line.strip()!r}")
+
+
+def write_trace(path, trace):
+    with open(path, 'w') as file:
+        for record in trace:
+            file.write(' '.join(str(part) for part in record) + '\n')
+
+
+# an event of a synthetic trace: 'join@0.5' (weight 1), 'join:2@0.5' (weight 2), 'leave@0.75'
+# (the first node still on the ring) or 'leave:5003@0.75', at a fraction of the operations
+def parse_event(text):
+    action, _, position = text.partition('@')
+    op, _, argument = action.partition(':')
+    if op not in ('join', 'leave') or not position:
+        raise ValueError(f"events look like join@0.5, join:2@0.5, leave@0.75 or leave:5003@0.75, not {text}")
+    return float(position), op, argument or None
+
+
+def synthetic_trace(workload, ops, events, nodes):
+    """
+    The records of a synthetic trace: the puts loading workload.record_count keys, then ops
+    operations picked by workload, with the join and leave events (parse_event) at their
+    positions. Reads are gets, updates and inserts are puts, a scan gets its keys one by one
+    and a read-modify-write is a get and a put. Joining nodes get the next free ports.
+    """
+    for number in range(workload.record_count):
+        yield 'put', f"user{number}", workload.rnd.randint(workload.value_min, workload.value_max)
+    nodes = list(nodes)
+    next_port = max(int(node) for node in nodes) + 1
+    pending = sorted((int(position * ops), op, argument) for position, op, argument in events)
+    for count in range(ops):
+        while pending and pending[0][0] <= count:
+            _, op, argument = pending.pop(0)
+            if op == 'join':
+                node = str(next_port)
+                next_port += 1
+                nodes.append(node)
+                yield 'join', node, float(argument) if argument else 1.0
+            else:
+                node = argument or nodes[0]
+                nodes.remove(node)
+                yield 'leave', node
+        op = workload.next_operation()
+        size = workload.rnd.randint(workload.value_min, workload.value_max)
+        if op == 'read':
+            yield 'get', workload.next_key()
+        elif op == 'update':
+            yield 'put', workload.next_key(), size
+        elif op == 'insert':
+            yield 'put', workload.next_insert_key(), size
+        elif op == 'delete':
+            yield 'del', workload.next_key()
+        elif op == 'scan':
+            for key in workload.next_scan():
+                yield 'get', key
+        else:
+            key = workload.next_key()
+            yield 'get', key
+            yield 'put', key, size
+
+
+def imbalance(counts):
+    values = list(counts.values())
+    mean = sum(values) / len(values) if values else 0
+    return round(max(values) / mean, 3) if mean else 0.0
+
+
+class RingModel:
+    """
+    Replays a trace against a HashRing alone, which takes seconds for millions of
+    operations. Writes count as load on all replicas of their key and reads on the first
+    read_quorum of them. The lookups of a run of operations are timed in one loop, apart
+    from the bookkeeping. A join or leave compares the preference lists of all stored keys
+    before and after the change: a key moves when it gets a new replica, which is sent its
+    key and value.
+
+    self.sizes: {key: value size} of the stored keys
+    self.load: {node: client requests}
+    """
+    def __init__(self, nodes, weights, vnodes, replicas, read_quorum):
+        self.ring = HashRing(nodes, vnodes=vnodes, weights=weights)
+        self.replicas = replicas
+        self.read_quorum = read_quorum
+        self.sizes = dict()
+        self.load = collections.Counter()
+        self.lookups = 0
+        self.lookup_seconds = 0.0
+
+    def run(self, records):
+        get_preference_list = self.ring.get_preference_list
+        replicas = self.replicas
+        started = time.perf_counter()
+        preference_lists = [get_preference_list(record[1], replicas) for record in records]
+        self.lookup_seconds += time.perf_counter() - started
+        self.lookups += len(records)
+        for record, nodes in zip(records, preference_lists):
+            op = record[0]
+            if op == 'get':
+                nodes = nodes[:self.read_quorum]
+            elif op == 'put':
+                self.sizes[record[1]] = record[2]
+            else:
+                self.sizes.pop(record[1], None)
+            self.load.update(nodes)
+
+    def change(self, op, node, weight=None):
+        old = self.ring.copy()
+        if op == 'join':
+            self.ring.add_node(node, weight)
+        else:
+            self.ring.remove_node(node)
+        keys = list(self.sizes)
+        before = old.get_preference_lists(keys, self.replicas)
+        after = self.ring.get_preference_lists(keys, self.replicas)
+        moved = 0
+        migration_bytes = 0
+        for key, old_nodes, new_nodes in zip(keys, before, after):
+            gained = len(set(new_nodes).difference(old_nodes))
+            if gained:
+                moved += 1
+                migration_bytes += (len(key) + self.sizes[key]) * gained
+        return {'moved_keys': moved, 'migration_bytes': migration_bytes}
+
+    def key_count(self):
+        return len(self.sizes)
+
+    def node_keys(self):
+        counts = collections.Counter({node: 0 for node in self.ring.nodes})
+        for nodes in self.ring.get_preference_lists(list(self.sizes), self.replicas):
+            counts.update(nodes)
+        return counts
+
+    def stats(self):
+        return {'throughput_ops': round(self.lookups / self.lookup_seconds) if self.lookup_seconds else 0}
+
+    def close(self):
+        pass
+
+
+class LocalTransport:
+    """
+    A ConnectionPool for kv stores in the same process: requests are handed to the Flask
+    app of the MyKVStore of the node through a test client, without sockets. A /shutdown
+    takes the kv store away instead of stopping the process.
+
+    self.stores: {node: MyKVStore}
+    self.requests: {node: client requests (CLIENT_PATHS)}
+    self.clients: the test clients of every thread, per node
+    """
+    def __init__(self, max_size=8):
+        self.max_size = max_size
+        self.connect_timeout = None
+        self.read_timeout = None
+        self.stores = dict()
+        self.requests = collections.Counter()
+        self.clients = threading.local()
+
+    def add(self, node, store):
+        self.stores[node] = store
+
+    def remove(self, node):
+        store = self.stores.pop(node, None)
+        if store is not None:
+            store.log.close()
+
+    def _open(self, node, method, path, params, json_body):
+        store = self.stores.get(str(node))
+        if store is None:
+            raise ConnectionPoolError(f"request to backend {node} failed: no such kv store")
+        if path in CLIENT_PATHS:
+            self.requests[str(node)] += 1
+        clients = self.clients.__dict__
+        client = clients.get(store)
+        if client is None:
+            client = clients[store] = store.app.test_client()
+        return client.open(path, method=method, query_string=params, json=json_body)
+
+    def request(self, node, method, path, params=None, json_body=None, timeout=None):
+        if path == '/shutdown':
+            self.remove(str(node))
+            return BackendResponse(200, b'Server shutting down...')
+        response = self._open(node, method, path, params, json_body)
+        return BackendResponse(response.status_code, response.get_data())
+
+    def stream_lines(self, node, method, path, params=None, json_body=None, timeout=None):
+        response = self._open(node, method, path, params, json_body)
+        if response.status_code != 200:
+            raise ConnectionPoolError(f"backend {node} answered {response.status_code}")
+        yield from response.get_data().splitlines(keepends=True)
+
+    def abort(self, node):
+        pass
+
+    def close(self, node=None):
+        pass
+
+    def stats(self):
+        return {node: {'requests': count} for node, count in self.requests.items()}
+
+
+class ClusterModel:
+    """
+    Replays a trace against MyKVStores and a MyDistributor in one process: the operations
+    are sent to the distributor's Flask app through a test client, and the distributor
+    reaches the kv stores through a LocalTransport, so requests take the same code paths as
+    in a deployment (replication, quorums, the Rebalancer) at in-memory speed. A join or
+    leave changes the ring as /add_server and /remove_server do and waits until the keys
+    moved. Every kv store writes its log into a temporary directory.
+
+    self.stores: {node: MyKVStore} of the nodes on the ring
+    """
+    def __init__(self, nodes, weights, vnodes, replicas, read_quorum, write_quorum, store_options=None):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store_options = store_options or {}
+        self.transport = LocalTransport()
+        self.stores = dict()
+        for node in nodes:
+            self._start_store(node)
+        ring = HashRing(nodes, vnodes=vnodes, weights=weights)
+        self.distributor = MyDistributor(ring, len(nodes) + 1, [], pool=self.transport, replicas=replicas,
+                                         read_quorum=read_quorum, write_quorum=write_quorum,
+                                         rebalance_options={'rate_limit': 0})
+        self.distributor.routes()
+        self.client = self.distributor.app.test_client()
+        self.operations = 0
+        self.seconds = 0.0
+        self.errors = 0
+
+    def _start_store(self, node):
+        store = MyKVStore(f"MyKVServer{node}", os.path.join(self.directory.name, f"storage{node}.json"), node,
+                          **self.store_options)
+        store.routes()
+        store.start_persistence()
+        self.stores[node] = store
+        self.transport.add(node, store)
+
+    def run(self, records):
+        client = self.client
+        started = time.perf_counter()
+        for record in records:
+            op, key = record[0], record[1]
+            if op == 'get':
+                response = client.get('/get', query_string={'key': key})
+                ok = response.status_code in (200, 404)
+            elif op == 'put':
+                response = client.put('/put', query_string={'key': key, 'value': 'x' * record[2]})
+                ok = response.status_code == 200
+            else:
+                response = client.open('/del', method='DEL', query_string={'key': key})
+                ok = response.status_code in (200, 404)
+            if not ok:
+                self.errors += 1
+        self.seconds += time.perf_counter() - started
+        self.operations += len(records)
+
+    # the nodes holding each key
+    def _holders(self):
+        holders = collections.defaultdict(set)
+        for node, store in self.stores.items():
+            for key in store.server_kv_store:
+                holders[key].add(node)
+        return holders
+
+    def change(self, op, node, weight=None):
+        distributor = self.distributor
+        before = self._holders()
+        with distributor.topology_lock:
+            if op == 'join':
+                self._start_store(node)
+                distributor.server_tracker += 1
+                distributor._change_ring(lambda ring: ring.add_node(node, weight))
+            else:
+                distributor._change_ring(lambda ring: ring.remove_node(node), distributor._finish_removal(int(node)))
+        distributor.rebalancer._thread.join()
+        if op == 'leave' and node not in self.transport.stores:
+            del self.stores[node]
+        after = self._holders()
+        moved = sum(1 for key, nodes in after.items() if nodes.difference(before.get(key, ())))
+        return {
+            'moved_keys': moved,
+            'migration_bytes': sum(move.bytes_moved for move in distributor.rebalancer.moves),
+            'rebalance': distributor.rebalancer.state,
+        }
+
+    @property
+    def ring(self):
+        return self.distributor.HashRing
+
+    def key_count(self):
+        keys = set()
+        for store in self.stores.values():
+            keys.update(store.server_kv_store)
+        return len(keys)
+
+    def node_keys(self):
+        return collections.Counter({node: len(store.server_kv_store) for node, store in self.stores.items()})
+
+    @property
+    def load(self):
+        return self.transport.requests
+
+    def stats(self):
+        return {
+            'throughput_ops': round(self.operations / self.seconds) if self.seconds else 0,
+            'errors': self.errors,
+        }
+
+    def close(self):
+        self.distributor.executor.shutdown()
+        for node in list(self.transport.stores):
+            self.transport.remove(node)
+        self.directory.cleanup()
+
+
+def simulate(model, trace, replicas, segment=100000):
+    """
+    Replay trace against a RingModel or ClusterModel and report the key movement and the
+    migration bytes of every join and leave, the client load and its imbalance over the
+    nodes (max / mean) in every phase between two of them, the spread of the stored key
+    copies at the end, and the throughput: lookups per second for a RingModel, operations
+    per second through the distributor for a ClusterModel.
+    """
+    events = []
+    phases = []
+    records = []
+    operations = 0
+    counted = dict()
+
+    def flush():
+        nonlocal operations, records
+        if records:
+            model.run(records)
+            operations += len(records)
+            records = []
+
+    # the load of the nodes on the ring since the last phase ended
+    def end_phase():
+        load = {node: model.load.get(node, 0) - counted.get(node, 0) for node in model.ring.nodes}
+        counted.update(model.load)
+        phases.append({
+            'until_operation': operations,
+            'nodes': len(load),
+            'load': load,
+            'load_max_over_mean': imbalance(load),
+        })
+
+    for record in trace:
+        if record[0] not in ('join', 'leave'):
+            records.append(record)
+            if len(records) >= segment:
+                flush()
+            continue
+        flush()
+        end_phase()
+        op, node = record[0], record[1]
+        # the share of the keys the node takes or leaves behind
+        total = sum(model.ring.weights.get(name, 1) for name in model.ring.nodes)
+        weight = record[2] if op == 'join' else model.ring.weights.get(node, 1)
+        share = weight / (total + weight) if op == 'join' else weight / total
+        keys = model.key_count()
+        started = time.perf_counter()
+        event = model.change(op, node, weight if op == 'join' else None)
+        event.update({
+            'event': op,
+            'node': node,
+            'after_operation': operations,
+            'keys': keys,
+            'moved_fraction': round(event['moved_keys'] / keys, 4) if keys else 0.0,
+            'ideal_fraction': round(min(1.0, replicas * share), 4),
+            'seconds': round(time.perf_counter() - started, 3),
+        })
+        events.append(event)
+    flush()
+    end_phase()
+    node_keys = model.node_keys()
+    result = {
+        'operations': operations,
+        'vnodes': model.ring.vnodes,
+        'events': events,
+        'phases': phases,
+        'node_keys': dict(node_keys),
+        'keys_max_over_mean': imbalance(node_keys),
+    }
+    result.update(model.stats())
+    return result
+
+
+def simulate_load(strategy, nodes, weights, vnodes, workload, replicas=3, read_quorum=1, epsilon=0.25,
+                  ticks=5000, utilization=0.7, rate_per_weight=20):
+    """
+    The load the distributor puts on kv stores of different capacities, in ticks of 1 ms: a
+    kv store of weight w serves rate_per_weight * w requests per tick from a FIFO queue.
+    Writes go to all replicas of their key and reads to read_quorum of them, and client
+    operations arrive at the rate that offers utilization times the capacity of the cluster.
+    'ring': the ring without weights, reads go to the first replicas of the preference list
+    'weighted': virtual nodes proportional to the weights, reads as with 'ring'
+    'bounded': the weighted ring, and the read replicas are chosen by a LoadTracker from
+               the requests queued on each kv store
+    """
+    node_weights = {node: weights.get(node, 1) for node in nodes}
+    ring = HashRing(nodes, vnodes=vnodes, weights=node_weights if strategy != 'ring' else None)
+    loads = LoadTracker(epsilon) if strategy == 'bounded' else None
+    capacity = {node: rate_per_weight * weight for node, weight in node_weights.items()}
+    queues = {node: collections.deque() for node in nodes}
+    credit = dict.fromkeys(nodes, 0.0)
+    served = dict.fromkeys(nodes, 0)
+    peak_queue = dict.fromkeys(nodes, 0)
+    waits = []
+    read_share = workload.proportions.get('read', 0) / sum(workload.proportions.values())
+    fan_out = read_share * min(read_quorum, replicas) + (1 - read_share) * replicas
+    arrivals_per_tick = utilization * sum(capacity.values()) / fan_out
+    arrivals = 0.0
+    for tick in range(ticks):
+        arrivals += arrivals_per_tick
+        while arrivals >= 1:
+            arrivals -= 1
+            op = workload.next_operation()
+            key = workload.next_insert_key() if op == 'insert' else workload.next_key()
+            targets = ring.get_preference_list(key, replicas)
+            if op == 'read' and read_quorum < len(targets):
+                targets = loads.choose(targets, read_quorum, ring) if loads is not None else targets[:read_quorum]
+            for node in targets:
+                queues[node].append(tick)
+                if loads is not None:
+                    loads.begin(node)
+        for node in nodes:
+            queue = queues[node]
+            peak_queue[node] = max(peak_queue[node], len(queue))
+            # unused capacity is not saved up while a kv store is idle
+            credit[node] = min(credit[node], 1.0) + capacity[node]
+            while queue and credit[node] >= 1:
+                credit[node] -= 1
+                waits.append(tick - queue.popleft())
+                served[node] += 1
+                if loads is not None:
+                    loads.end(node)
+    waits.sort()
+    utilizations = {node: served[node] / (capacity[node] * ticks) for node in nodes}
+    mean_utilization = sum(utilizations.values()) / len(nodes)
+    return {
+        'strategy': strategy,
+        'weights': node_weights,
+        'vnodes': {node: ring.vnode_count(node) for node in nodes},
+        'requests': served,
+        'utilization': {node: round(value, 3) for node, value in utilizations.items()},
+        'max_over_mean_utilization': round(max(utilizations.values()) / mean_utilization, 3),
+        'peak_queue': peak_queue,
+        'backlog': sum(len(queue) for queue in queues.values()),
+        'wait_p50_ms': percentile(waits, 0.50),
+        'wait_p99_ms': percentile(waits, 0.99),
+        'wait_max_ms': waits[-1] if waits else 0,
+        'spills': loads.spills if loads is not None else 0,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a trace against a hash ring or a whole cluster in one process")
+    parser.add_argument('--mode', choices=MODES, default='ring',
+                        help="ring: the HashRing alone (fast); cluster: MyKVStores and a MyDistributor; "
+                             "load: the queues of kv stores of different weights under each read routing")
+    parser.add_argument('--vnodes', type=int, nargs='+', default=[100], help="virtual node counts to compare, one run each")
+    parser.add_argument('--nodes', type=int, default=5, help="kv stores at the start, on ports 5001 and up")
+    parser.add_argument('--weights', type=float, nargs='*', default=[], help="weights of the first nodes")
+    parser.add_argument('--replicas', type=int, default=1,
+                        help="replicas per key, 1 by default like the distributors")
+    parser.add_argument('--read-quorum', type=int, default=1)
+    parser.add_argument('--write-quorum', type=int, default=1)
+    parser.add_argument('--trace', help="replay this trace file instead of a synthetic trace")
+    parser.add_argument('--record', help="write the synthetic trace to this file and exit")
+    parser.add_argument('--workload', choices=sorted(WORKLOADS) + ['custom'], default='b',
+                        help="a YCSB core workload, or custom mixes of the --<operation> proportions")
+    for op in OPERATIONS:
+        parser.add_argument(f"--{op}", type=float, default=0.0, help=f"share of {op} operations in a custom workload")
+    parser.add_argument('--distribution', choices=DISTRIBUTIONS, help="key distribution, overrides the workload's")
+    parser.add_argument('--record-count', type=int, default=100000, help="keys loaded before the operations")
+    parser.add_argument('--ops', type=int, default=1000000, help="operations after the load")
+    parser.add_argument('--value-size', default='100', help="value length, fixed ('100') or a uniform range ('10-1000')")
+    parser.add_argument('--scan-length', type=int, default=10)
+    parser.add_argument('--events', nargs='*', default=['join@0.5', 'leave@0.75'],
+                        help="join@FRACTION, join:WEIGHT@FRACTION, leave@FRACTION or leave:NODE@FRACTION")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--strategies', nargs='+', choices=LOAD_STRATEGIES, default=list(LOAD_STRATEGIES),
+                        help="load mode: the read routings to compare")
+    parser.add_argument('--epsilon', type=float, default=0.25, help="load mode: the bounded load factor")
+    parser.add_argument('--utilization', type=float, default=0.7,
+                        help="load mode: offered load over the cluster's capacity")
+    parser.add_argument('--ticks', type=int, default=5000, help="load mode: simulated milliseconds")
+    args = parser.parse_args()
+
+    if args.workload == 'custom':
+        proportions = {op: getattr(args, op) for op in OPERATIONS if getattr(args, op) > 0}
+        if not proportions:
+            parser.error("a custom workload needs at least one of --" + ", --".join(OPERATIONS))
+        distribution = 'uniform'
+    else:
+        proportions, distribution = WORKLOADS[args.workload]
+    distribution = args.distribution or distribution
+    try:
+        events = [parse_event(event) for event in args.events]
+    except ValueError as e:
+        parser.error(str(e))
+    nodes = [str(5001 + index) for index in range(args.nodes)]
+    weights = dict(zip(nodes, args.weights))
+
+    def trace():
+        if args.trace:
+            return read_trace(args.trace)
+        workload = Workload(proportions, distribution, args.record_count, args.value_size, args.scan_length, args.seed)
+        return synthetic_trace(workload, args.ops, events, nodes)
+
+    if args.record:
+        write_trace(args.record, trace())
+        raise SystemExit
+
+    if args.mode == 'load':
+        for vnodes in args.vnodes:
+            for strategy in args.strategies:
+                workload = Workload(proportions, distribution, args.record_count, args.value_size,
+                                    args.scan_length, args.seed)
+                result = simulate_load(strategy, nodes, weights, vnodes, workload, args.replicas, args.read_quorum,
+                                       args.epsilon, args.ticks, args.utilization)
+                print(json.dumps(result))
+        raise SystemExit
+
+    for vnodes in args.vnodes:
+        # the status messages of the kv stores and the distributor go to stderr, the results to stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            if args.mode == 'ring':
+                model = RingModel(nodes, weights, vnodes, args.replicas, args.read_quorum)
+            else:
+                model = ClusterModel(nodes, weights, vnodes, args.replicas, args.read_quorum, args.write_quorum)
+            try:
+                started = time.perf_counter()
+                result = simulate(model, trace(), args.replicas)
+                result['seconds'] = round(time.perf_counter() - started, 2)
+            finally:
+                model.close()
+        result['mode'] = args.mode
+        print(json.dumps(result))
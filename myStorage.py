@@ -0,0 +1,755 @@
+import bisect
+import heapq
+import random
+import struct
+import threading
+import weakref
+import zlib
+from array import array
+from contextlib import contextmanager
+
+
+class DictEngine:
+    """
+    The in-memory map of a LayeredStore as a single dict guarded by a single lock.
+    Reads are lock-free; every change takes the lock, and a point-in-time copy for
+    persistence is a full copy of the dict made while holding it, so writers wait for
+    the whole copy.
+
+    self.index: the sorted keys of the entries that were not stored as evictable
+                (SortedKeys), for keys_from()
+    """
+    shard_count = 1
+
+    def __init__(self):
+        self.data = dict()
+        self.lock = threading.Lock()
+        self.index = SortedKeys(self.lock)
+
+    def shard_index(self, key):
+        return 0
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def compute(self, key, update, evictable=False):
+        """
+        Atomically replace the value of key: update(current) is called with the lock held
+        and returns (new, result). new is stored (None removes the key, returning current
+        unchanged changes nothing) and result is returned. evictable marks a new value
+        the engine may drop under memory pressure (a copy of a snapshot value); engines
+        without a memory limit ignore it, but leave it out of keys_from().
+        """
+        with self.lock:
+            current = self.data.get(key)
+            new, result = update(current)
+            if new is not current:
+                if new is None:
+                    del self.data[key]
+                    self.index.discard(key)
+                else:
+                    self.data[key] = new
+                    if not evictable:
+                        self.index.add(key)
+            return result
+
+    def keys_from(self, start):
+        """
+        The keys from start on in ascending order, of the entries that were not stored as
+        evictable; see SortedKeys.iter_from
+        """
+        return self.index.iter_from(start)
+
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            yield
+
+    # the following methods require locked() to be held
+
+    def freeze(self):
+        """
+        A point-in-time mapping of all entries that later changes do not affect
+        """
+        return self.data.copy()
+
+    def put_locked(self, key, value):
+        self.data[key] = value
+        self.index.add(key)
+
+    def remove_locked(self, key):
+        self.data.pop(key, None)
+        self.index.discard(key)
+
+    def unchanged_locked(self, frozen, key, value):
+        """
+        Whether the entry (key, value) of the frozen view is still the current one
+        """
+        return self.data.get(key) is value
+
+    def __len__(self):
+        return len(self.data)
+
+
+class _Shard:
+    """
+    One dict of a ShardedEngine, its lock and the SortedKeys of its keys. shared is set
+    while the dict is referenced by a frozen view, which the next change must not modify:
+    it copies the dict first.
+    """
+    __slots__ = ('data', 'lock', 'shared', 'index')
+
+    def __init__(self):
+        self.data = dict()
+        self.lock = threading.Lock()
+        self.shared = False
+        self.index = SortedKeys(self.lock)
+
+    def writable(self):
+        if self.shared:
+            self.data = self.data.copy()
+            self.shared = False
+        return self.data
+
+
+class FrozenShards:
+    """
+    A read-only point-in-time view of a ShardedEngine, made of the dicts its shards held
+    when it was frozen.
+    """
+    def __init__(self, dicts, shard_index):
+        self.dicts = dicts
+        self.shard_index = shard_index
+
+    def get(self, key, default=None):
+        return self.dicts[self.shard_index(key)].get(key, default)
+
+    def __contains__(self, key):
+        return key in self.dicts[self.shard_index(key)]
+
+    def __len__(self):
+        return sum(len(data) for data in self.dicts)
+
+    def items(self):
+        for data in self.dicts:
+            yield from data.items()
+
+
+class ShardedEngine:
+    """
+    The in-memory map of a LayeredStore split into `shards` dicts (a power of two), each
+    with its own lock, so writers of different keys rarely wait for each other.
+    Reads are lock-free. freeze() is copy-on-write: it only marks every shard as shared
+    (taking all locks for a moment, so the view is consistent across shards), and the
+    first change of a shard after that copies just that shard. A background snapshot
+    therefore never holds up writers for longer than copying 1/shards of the data.
+    """
+    def __init__(self, shards=64):
+        if shards < 1 or shards & (shards - 1):
+            raise ValueError(f"the number of shards must be a power of two, not {shards}")
+        self.shards = [_Shard() for _ in range(shards)]
+        self.shard_count = shards
+        self._mask = shards - 1
+
+    def shard_index(self, key):
+        return hash(key) & self._mask
+
+    def get(self, key, default=None):
+        return self.shards[hash(key) & self._mask].data.get(key, default)
+
+    def compute(self, key, update, evictable=False):
+        """
+        Atomically replace the value of key, see DictEngine.compute
+        """
+        shard = self.shards[hash(key) & self._mask]
+        with shard.lock:
+            current = shard.data.get(key)
+            new, result = update(current)
+            if new is not current:
+                if new is None:
+                    del shard.writable()[key]
+                    shard.index.discard(key)
+                else:
+                    shard.writable()[key] = new
+                    if not evictable:
+                        shard.index.add(key)
+            return result
+
+    # the keys from start on, see DictEngine.keys_from; each shard is read under its own lock
+    def keys_from(self, start):
+        return heapq.merge(*(shard.index.iter_from(start) for shard in self.shards))
+
+    @contextmanager
+    def locked(self):
+        for shard in self.shards:
+            shard.lock.acquire()
+        try:
+            yield
+        finally:
+            for shard in reversed(self.shards):
+                shard.lock.release()
+
+    # the following methods require locked() to be held
+
+    def freeze(self):
+        for shard in self.shards:
+            shard.shared = True
+        return FrozenShards([shard.data for shard in self.shards], self.shard_index)
+
+    def put_locked(self, key, value):
+        shard = self.shards[hash(key) & self._mask]
+        shard.writable()[key] = value
+        shard.index.add(key)
+
+    def remove_locked(self, key):
+        shard = self.shards[hash(key) & self._mask]
+        if key in shard.data:
+            del shard.writable()[key]
+            shard.index.discard(key)
+
+    def unchanged_locked(self, frozen, key, value):
+        return self.get(key) is value
+
+    def __len__(self):
+        return sum(len(shard.data) for shard in self.shards)
+
+
+# the arena entry header: flags, access (LRU clock or LFU counter), key length, value length
+_ENTRY = struct.Struct('<BIII')
+_ACCESS = struct.Struct('<I')
+_COMPRESSED = 1
+_EVICTABLE = 2
+_OBJECT = 4
+_EMPTY = -1
+_DELETED = -2
+_MAX_ACCESS = 0xFFFFFFFF
+
+
+class FrozenCompact:
+    """
+    A read-only point-in-time view of a CompactEngine: a copy of its table over its arena,
+    which is only appended to (and not rewritten) while the view exists.
+    """
+    def __init__(self, engine, table):
+        self.engine = engine
+        self.table = table
+
+    def get(self, key, default=None):
+        offset = self.engine._offset(self.table, key)
+        return default if offset is None else self.engine._value(self.table[2], offset)
+
+    def __contains__(self, key):
+        return self.engine._offset(self.table, key) is not None
+
+    def __len__(self):
+        return sum(1 for offset in self.table[0] if offset >= 0)
+
+    def items(self):
+        arena = self.table[2]
+        for offset in self.table[0]:
+            if offset >= 0:
+                _, _, key_length, _ = _ENTRY.unpack_from(arena, offset)
+                start = offset + _ENTRY.size
+                yield arena[start:start + key_length].decode('utf-8'), self.engine._value(arena, offset)
+
+
+class CompactEngine:
+    """
+    The in-memory map of a LayeredStore packed into bytes instead of a dict of str objects,
+    which costs 100+ bytes of overhead per entry: every entry is appended to one bytearray
+    arena as a 13 byte header, the UTF-8 key and the value, and found through an open
+    addressing table (linear probing) of arena offsets and key hashes, two arrays of
+    8 byte ints kept between 1/2 and 2/3 full. Values of compress_min bytes or more (0 disables
+    it) are zlib-compressed if that makes them smaller. Values that are not str (the
+    TOMBSTONE of the LayeredStore) are stored as a reference to a small object table.
+    
+    A change appends a new entry and points the table at it; the old entries are garbage
+    that is dropped by rewriting the arena once there is more garbage than live data,
+    unless a frozen view still reads from the arena. Reads are lock-free, changes take
+    a single lock.
+    
+    self.max_bytes: bounds the live entries (0 for no limit). Entries stored as evictable
+                    (copies of snapshot values promoted by reads) are evicted to stay under
+                    it, the least recently (eviction='lru') or least frequently ('lfu') read
+                    of a few sampled ones first. Other entries cannot be dropped without
+                    losing data: when they alone exceed the limit, on_pressure() is called
+                    so the store writes a snapshot, after which they leave the memtable.
+                    The index counts towards the limit
+    self.on_pressure: set by the MyKVStore, None otherwise
+    self.index: the arena offsets of the keys whose entries were not stored as evictable,
+                sorted by key (SortedKeys), for keys_from(). An overwritten entry keeps its
+                offset there until the arena is rewritten, so only new keys are sorted in
+    """
+    shard_count = 1
+
+    def __init__(self, max_bytes=0, eviction='lru', compress_min=256, samples=5):
+        if eviction not in ('lru', 'lfu'):
+            raise ValueError(f"unknown eviction policy {eviction!r}, expected 'lru' or 'lfu'")
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+        self.compress_min = compress_min
+        self.samples = samples
+        self.on_pressure = None
+        self.lock = threading.Lock()
+        self._objects = []
+        self._views = weakref.WeakSet()
+        self._clock = 0
+        self._count = 0
+        self._deleted = 0
+        self._live_bytes = 0
+        self._evictable_bytes = 0
+        self._garbage_bytes = 0
+        self.compressed = 0
+        self.evictions = 0
+        self._table = self._new_table(8, bytearray())
+        self.index = SortedKeys(self.lock, key=self._key_at, typecode='q')
+
+    @staticmethod
+    def _new_table(capacity, arena):
+        return array('q', [_EMPTY]) * capacity, array('q', [0]) * capacity, arena, capacity - 1
+
+    def shard_index(self, key):
+        return 0
+
+    # the UTF-8 key of the entry at offset of the current arena
+    def _key_at(self, offset):
+        arena = self._table[2]
+        start = offset + _ENTRY.size
+        return arena[start:start + _ENTRY.unpack_from(arena, offset)[2]]
+
+    @staticmethod
+    def _has_key(arena, offset, encoded_key):
+        key_length = _ENTRY.unpack_from(arena, offset)[2]
+        start = offset + _ENTRY.size
+        return key_length == len(encoded_key) and arena[start:start + key_length] == encoded_key
+
+    # the table index and arena offset of key's entry in table, or (None, None)
+    @classmethod
+    def _find(cls, table, key):
+        slots, hashes, arena, mask = table
+        key_hash = hash(key)
+        index = key_hash & mask
+        encoded = key.encode('utf-8')
+        while True:
+            offset = slots[index]
+            if offset == _EMPTY:
+                return None, None
+            if offset >= 0 and hashes[index] == key_hash and cls._has_key(arena, offset, encoded):
+                return index, offset
+            index = (index + 1) & mask
+
+    @classmethod
+    def _offset(cls, table, key):
+        return cls._find(table, key)[1]
+
+    def _value(self, arena, offset):
+        flags, _, key_length, value_length = _ENTRY.unpack_from(arena, offset)
+        start = offset + _ENTRY.size + key_length
+        value = arena[start:start + value_length]
+        if flags & _OBJECT:
+            return self._objects[value[0]]
+        if flags & _COMPRESSED:
+            value = zlib.decompress(value)
+        return value.decode('utf-8')
+
+    def get(self, key, default=None):
+        table = self._table
+        offset = self._offset(table, key)
+        if offset is None:
+            return default
+        arena = table[2]
+        if self.max_bytes and arena[offset] & _EVICTABLE:
+            self._touch(arena, offset)
+        return self._value(arena, offset)
+
+    # record a read of an evictable entry; races between readers only lose a count
+    def _touch(self, arena, offset):
+        if self.eviction == 'lru':
+            self._clock = (self._clock + 1) & _MAX_ACCESS
+            _ACCESS.pack_into(arena, offset + 1, self._clock)
+        else:
+            access = _ACCESS.unpack_from(arena, offset + 1)[0]
+            if access < _MAX_ACCESS:
+                _ACCESS.pack_into(arena, offset + 1, access + 1)
+
+    def compute(self, key, update, evictable=False):
+        """
+        Atomically replace the value of key, see DictEngine.compute
+        """
+        with self.lock:
+            current = self.get(key)
+            new, result = update(current)
+            if new is not current:
+                if new is None:
+                    self.remove_locked(key)
+                else:
+                    self._store(key, new, evictable)
+            return result
+
+    # the keys from start on, see DictEngine.keys_from
+    def keys_from(self, start):
+        return (key.decode('utf-8') for key in self.index.iter_from(start.encode('utf-8')))
+
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            yield
+
+    def _encode(self, value):
+        if not isinstance(value, str):
+            if value not in self._objects:
+                self._objects.append(value)
+            return _OBJECT, bytes([self._objects.index(value)])
+        encoded = value.encode('utf-8')
+        if self.compress_min and len(encoded) >= self.compress_min:
+            packed = zlib.compress(encoded, 1)
+            if len(packed) < len(encoded):
+                return _COMPRESSED, packed
+        return 0, encoded
+
+    def _entry_size(self, arena, offset):
+        _, _, key_length, value_length = _ENTRY.unpack_from(arena, offset)
+        return _ENTRY.size + key_length + value_length
+
+    # account for the entry at offset leaving the table
+    def _drop(self, arena, offset):
+        size = self._entry_size(arena, offset)
+        flags = arena[offset]
+        self._live_bytes -= size
+        self._garbage_bytes += size
+        if flags & _EVICTABLE:
+            self._evictable_bytes -= size
+        if flags & _COMPRESSED:
+            self.compressed -= 1
+
+    def _store(self, key, value, evictable):
+        flags, encoded_value = self._encode(value)
+        if evictable:
+            flags |= _EVICTABLE
+        encoded_key = key.encode('utf-8')
+        slots, hashes, arena, mask = self._table
+        offset = len(arena)
+        access = self._clock if self.eviction == 'lru' else 1
+        arena += _ENTRY.pack(flags, access, len(encoded_key), len(encoded_value))
+        arena += encoded_key
+        arena += encoded_value
+        size = len(arena) - offset
+        key_hash = hash(key)
+        index = key_hash & mask
+        free = None
+        indexed = False
+        while True:
+            current = slots[index]
+            if current == _EMPTY:
+                if free is not None:
+                    index = free
+                    self._deleted -= 1
+                break
+            if current == _DELETED:
+                if free is None:
+                    free = index
+            elif hashes[index] == key_hash and self._has_key(arena, current, encoded_key):
+                indexed = not arena[current] & _EVICTABLE
+                self._drop(arena, current)
+                self._count -= 1
+                break
+            index = (index + 1) & mask
+        hashes[index] = key_hash
+        slots[index] = offset
+        # the index keeps the offset of the replaced entry, whose key is still in the arena
+        if not evictable and not indexed:
+            self.index.add(offset)
+        elif evictable and indexed:
+            self.index.discard(encoded_key)
+        self._count += 1
+        self._live_bytes += size
+        if flags & _EVICTABLE:
+            self._evictable_bytes += size
+        if flags & _COMPRESSED:
+            self.compressed += 1
+        if (self._count + self._deleted) * 3 > (mask + 1) * 2:
+            self._rebuild()
+        elif self._garbage_bytes > max(self._live_bytes, 1 << 20) and not self._views:
+            self._rebuild()
+        self._enforce_limit()
+
+    # a new table for the live entries, half full, and a new arena without
+    # the garbage unless a frozen view reads from the current one
+    def _rebuild(self):
+        slots, hashes, arena, mask = self._table
+        rewrite = not self._views
+        capacity = 8
+        while capacity < self._count * 2:
+            capacity *= 2
+        new_slots, new_hashes, new_arena, new_mask = self._new_table(capacity, bytearray() if rewrite else arena)
+        moved = dict()
+        for index, offset in enumerate(slots):
+            if offset < 0:
+                continue
+            if rewrite:
+                size = self._entry_size(arena, offset)
+                new_offset = len(new_arena)
+                new_arena += arena[offset:offset + size]
+                moved[offset] = new_offset
+            else:
+                new_offset = offset
+            position = hashes[index] & new_mask
+            while new_slots[position] != _EMPTY:
+                position = (position + 1) & new_mask
+            new_slots[position] = new_offset
+            new_hashes[position] = hashes[index]
+        new_table = (new_slots, new_hashes, new_arena, new_mask)
+        if rewrite:
+            self._garbage_bytes = 0
+
+            # the index may hold the offset of an older entry of a key, which is not copied
+            def new_offset(offset):
+                if offset in moved:
+                    return moved[offset]
+                start = offset + _ENTRY.size
+                key = arena[start:start + _ENTRY.unpack_from(arena, offset)[2]]
+                return self._offset(new_table, key.decode('utf-8'))
+            self.index.remap(new_offset)
+        self._deleted = 0
+        self._table = new_table
+
+    # the live entries and the index, which the memory limit bounds
+    def _used_bytes(self):
+        return self._live_bytes + 8 * len(self.index)
+
+    def _enforce_limit(self):
+        if not self.max_bytes or self._used_bytes() <= self.max_bytes:
+            return
+        while self._used_bytes() > self.max_bytes and self._evictable_bytes > 0:
+            if not self._evict():
+                break
+        if self._used_bytes() > self.max_bytes and self.on_pressure is not None:
+            self.on_pressure()
+
+    # evict the least recently or frequently read of a few evictable entries, sampled from
+    # a random position of the table on; with lfu the others are aged by halving their count.
+    # Returns False if no evictable entry was found among the slots scanned
+    def _evict(self):
+        slots, hashes, arena, mask = self._table
+        index = random.getrandbits(62) & mask
+        sampled = []
+        for _ in range(min(mask + 1, 64 * self.samples)):
+            offset = slots[index]
+            if offset >= 0 and arena[offset] & _EVICTABLE:
+                sampled.append((_ENTRY.unpack_from(arena, offset)[1], index, offset))
+                if len(sampled) >= self.samples:
+                    break
+            index = (index + 1) & mask
+        if not sampled:
+            return False
+        _, index, offset = min(sampled)
+        self._drop(arena, offset)
+        slots[index] = _DELETED
+        self._count -= 1
+        self._deleted += 1
+        self.evictions += 1
+        if self.eviction == 'lfu':
+            for access, _, other in sampled:
+                if other != offset:
+                    _ACCESS.pack_into(arena, other + 1, access // 2)
+        return True
+
+    # the following methods require locked() to be held
+
+    def freeze(self):
+        slots, hashes, arena, mask = self._table
+        view = FrozenCompact(self, (array('q', slots), array('q', hashes), arena, mask))
+        self._views.add(view)
+        return view
+
+    def put_locked(self, key, value):
+        self._store(key, value, False)
+
+    def remove_locked(self, key):
+        index, offset = self._find(self._table, key)
+        if offset is None:
+            return
+        slots, _, arena, _ = self._table
+        self._drop(arena, offset)
+        slots[index] = _DELETED
+        self._count -= 1
+        self._deleted += 1
+        self.index.discard(key.encode('utf-8'))
+
+    def unchanged_locked(self, frozen, key, value):
+        offset = self._offset(self._table, key)
+        frozen_offset = self._offset(frozen.table, key)
+        if offset is None:
+            # an evicted copy of a snapshot value is as good as unchanged
+            return frozen_offset is not None and bool(frozen.table[2][frozen_offset] & _EVICTABLE)
+        return offset == frozen_offset
+
+    def __len__(self):
+        return self._count
+
+    def memory_stats(self):
+        slots, hashes, arena, _ = self._table
+        table_bytes = slots.itemsize * len(slots) + hashes.itemsize * len(hashes)
+        index_bytes = 8 * len(self.index)
+        return {
+            'keys': self._count,
+            'live_bytes': self._live_bytes,
+            'arena_bytes': len(arena),
+            'table_bytes': table_bytes,
+            'index_bytes': index_bytes,
+            'bytes_per_key': round((len(arena) + table_bytes + index_bytes) / self._count, 1) if self._count else 0.0,
+            'compressed_values': self.compressed,
+            'evictions': self.evictions,
+        }
+
+
+ENGINES = {'dict': DictEngine, 'sharded': ShardedEngine, 'compact': CompactEngine}
+
+
+def create_engine(name, **options):
+    if name not in ENGINES:
+        raise ValueError(f"unknown storage engine {name!r}, expected one of {sorted(ENGINES)}")
+    return ENGINES[name](**options)
+
+
+class StripedLock:
+    """
+    A fixed set of locks that keys are hashed onto. Holding the lock of a key orders all
+    changes of that key (and the keys sharing its stripe) without serializing the rest.
+    """
+    def __init__(self, stripes=1):
+        self.locks = [threading.Lock() for _ in range(stripes)]
+
+    def for_key(self, key):
+        return self.locks[hash(key) % len(self.locks)]
+
+    @contextmanager
+    def for_keys(self, keys):
+        # locks are always taken in ascending order, so two batches cannot deadlock
+        indexes = sorted({hash(key) % len(self.locks) for key in keys})
+        for index in indexes:
+            self.locks[index].acquire()
+        try:
+            yield
+        finally:
+            for index in reversed(indexes):
+                self.locks[index].release()
+
+
+class SortedKeys:
+    """
+    The sorted keys of one shard of a storage engine, for range scans, kept as a list of
+    sorted blocks of at most 2 * load items, so adding or removing a key moves at most one
+    block instead of the whole list. Keys are str, whose order is the byte order of their
+    UTF-8 encoding. The items are the keys themselves, or, with key, something the key is
+    read from: the CompactEngine keeps the arena offsets of its entries in arrays of
+    typecode 'q', 8 bytes per key, and its keys are UTF-8 bytes.
+
+    Changes are made with lock (the lock of the shard) held by the caller, as part of the
+    change of the entry; reads take it for one batch of keys at a time.
+
+    self.blocks: the sorted blocks, in order
+    self.maxes: the last key of every block, which is bisected to find a key's block
+    """
+    def __init__(self, lock, key=None, typecode=None, load=512):
+        self.lock = lock
+        self.key = key
+        self.typecode = typecode
+        self.load = load
+        self.blocks = []
+        self.maxes = []
+        self.count = 0
+
+    def _key(self, item):
+        return item if self.key is None else self.key(item)
+
+    def _block(self, items):
+        return array(self.typecode, items) if self.typecode else list(items)
+
+    # the position of key in block, before equal keys or, with after, behind them; bisect
+    # only takes a key function from Python 3.10 on
+    def _find(self, block, key, after=False):
+        if self.key is None:
+            return bisect.bisect_right(block, key) if after else bisect.bisect_left(block, key)
+        key_of = self.key
+        low, high = 0, len(block)
+        while low < high:
+            middle = (low + high) // 2
+            found = key_of(block[middle])
+            if found < key or (after and found == key):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # add the item of a key, replacing the item of the same key if there is one
+    def add(self, item):
+        key = self._key(item)
+        if not self.blocks:
+            self.blocks.append(self._block([item]))
+            self.maxes.append(key)
+            self.count = 1
+            return
+        index = bisect.bisect_left(self.maxes, key)
+        if index == len(self.maxes):
+            index -= 1
+        block = self.blocks[index]
+        position = self._find(block, key)
+        if position < len(block) and self._key(block[position]) == key:
+            block[position] = item
+            return
+        block.insert(position, item)
+        self.maxes[index] = self._key(block[-1])
+        self.count += 1
+        if len(block) > 2 * self.load:
+            self.blocks[index:index + 1] = [block[:self.load], block[self.load:]]
+            self.maxes[index:index + 1] = [self._key(block[self.load - 1]), self._key(block[-1])]
+
+    def discard(self, key):
+        index = bisect.bisect_left(self.maxes, key)
+        if index == len(self.maxes):
+            return
+        block = self.blocks[index]
+        position = self._find(block, key)
+        if position == len(block) or self._key(block[position]) != key:
+            return
+        del block[position]
+        self.count -= 1
+        if block:
+            self.maxes[index] = self._key(block[-1])
+        else:
+            del self.blocks[index]
+            del self.maxes[index]
+
+    # replace every item by new_item(item), keeping the order; for arena offsets after the
+    # arena was rewritten
+    def remap(self, new_item):
+        self.blocks = [self._block(new_item(item) for item in block) for block in self.blocks]
+
+    # up to count keys from start on, start itself included unless after is set
+    def _batch(self, start, count, after):
+        with self.lock:
+            find = bisect.bisect_right if after else bisect.bisect_left
+            index = find(self.maxes, start)
+            result = []
+            while index < len(self.blocks) and len(result) < count:
+                block = self.blocks[index]
+                position = self._find(block, start, after) if not result else 0
+                result.extend(self._key(item) for item in block[position:position + count - len(result)])
+                index += 1
+            return result
+
+    def iter_from(self, start, batch=16, max_batch=256):
+        """
+        The keys from start on in ascending order, read batch keys at a time, doubling up to
+        max_batch, so a short scan over many shards reads few keys of each: keys added or
+        removed meanwhile may or may not be seen
+        """
+        keys = self._batch(start, batch, False)
+        while keys:
+            yield from keys
+            batch = min(2 * batch, max_batch)
+            keys = self._batch(keys[-1], batch, True)
+
+    def __len__(self):
+        return self.count
@@ -0,0 +1,56 @@
+import json
+import multiprocessing
+import socket
+
+
+class SharedRingState:
+    """
+    The topology shared by the distributor worker processes, kept in shared memory so
+    that a change made by the worker that served /add_server or /remove_server reaches
+    all the others: a version number, which every worker compares with the version of
+    its own HashRing on each request, and the JSON state of that version, which is only
+    read when the version moved.
+
+    self.topology_lock: serializes the topology changes of all workers
+    self.deletes: keys deleted through the other workers while a worker moves keys, so
+                  its Rebalancer does not bring them back
+    """
+    def __init__(self, size=1024 * 1024):
+        self._version = multiprocessing.RawValue('Q', 0)
+        self._length = multiprocessing.RawValue('I', 0)
+        self._buffer = multiprocessing.RawArray('c', size)
+        self._lock = multiprocessing.Lock()
+        self.topology_lock = multiprocessing.Lock()
+        self.deletes = multiprocessing.Queue()
+
+    # read without the lock: the workers check it on every request
+    @property
+    def version(self):
+        return self._version.value
+
+    # store a new state and return its version
+    def publish(self, state):
+        data = json.dumps(state).encode('utf-8')
+        if len(data) > len(self._buffer):
+            raise ValueError(f"the ring state takes {len(data)} bytes, more than {len(self._buffer)}")
+        with self._lock:
+            self._buffer[:len(data)] = data
+            self._length.value = len(data)
+            self._version.value += 1
+            return self._version.value
+
+    # the current (version, state)
+    def read(self):
+        with self._lock:
+            return self._version.value, json.loads(self._buffer[:self._length.value])
+
+
+# a listening socket that other processes can bind to the same address as well; the kernel
+# spreads the incoming connections over them
+def reuse_port_socket(host, port, backlog=1024):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock